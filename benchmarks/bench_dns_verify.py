@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Benchmark for served DNS verification against a local stand-in nameserver
+
+Builds a synthetic estate of public zones, serves it from
+benchmarks/dns_standin.py with a few records changed, and checks the estate
+at several concurrency levels, reporting queries per second and the
+mismatches found. Each zone is checked against two nameservers that both
+map to the stand-in.
+
+    python3 benchmarks/bench_dns_verify.py [zones] [records_per_zone] [delay_ms]
+"""
+
+import logging
+import os
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from dns_standin import serve
+from dnsmonitor.dns_verify import AsyncDNSClient, verify_zones
+
+NAMESERVERS = ["ns-1.example.net.", "ns-2.example.org."]
+
+
+def make_zones(count, per_zone):
+    zones = {}
+    for z in range(count):
+        zone = "zone%i.example.com." % z
+        records = ["%s 172800 IN NS %s" % (zone, ns) for ns in NAMESERVERS]
+        records.append('%s 300 IN TXT "v=spf1 include:_spf.example.com ~all"' % zone)
+        records.append("%s 300 IN MX 10 mx.%s" % (zone, zone))
+        for r in range(per_zone):
+            records.append(
+                "host%i.%s 300 IN A 10.%i.%i.%i" % (r, zone, z % 256, r // 256, r % 256)
+            )
+        zones[zone] = sorted(records)
+    return zones
+
+
+def tamper(zones, every):
+    """A copy of zones where every nth zone serves one different address"""
+    served = {}
+    for i, (zone, records) in enumerate(zones.items()):
+        records = list(records)
+        if i % every == 0:
+            for j, entry in enumerate(records):
+                if " IN A " in entry:
+                    records[j] = entry.rsplit(" ", 1)[0] + " 192.0.2.1"
+                    break
+        served[zone] = records
+    return served
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    per_zone = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    delay = float(sys.argv[3]) / 1000 if len(sys.argv) > 3 else 0.0
+    logging.basicConfig(level=logging.WARNING)
+    zones = make_zones(count, per_zone)
+    server = serve(tamper(zones, every=10), delay=delay)
+    addresses = {ns: server.address for ns in NAMESERVERS}
+    checks = [
+        (zone, "public_records_aws", records, NAMESERVERS)
+        for zone, records in zones.items()
+    ]
+    try:
+        for concurrency in (1, 20, 200):
+            client = AsyncDNSClient(
+                concurrency=concurrency,
+                server_concurrency=concurrency,
+                timeout=2,
+                retries=2,
+                addresses=addresses,
+            )
+            start = perf_counter()
+            mismatches = verify_zones(checks, client)
+            elapsed = perf_counter() - start
+            found = sum(len(z) for z in mismatches.values())
+            print(
+                "concurrency %3i: %6i queries in %6.2fs = %7.0f q/s, "
+                "%i mismatched zones, %i failures"
+                % (
+                    concurrency,
+                    client.queries,
+                    elapsed,
+                    client.queries / elapsed,
+                    found,
+                    client.failures,
+                )
+            )
+    finally:
+        server.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmark of a scan over a synthetic estate
+
+Runs the real DNSMonitor, DNSMonitor_diff, state serialization and sinks
+against the in-process stand-ins in standins.py, over a deterministic
+estate from estate.py, and reports wall time, throughput, peak traced
+memory and stand-in API calls for each phase:
+
+    collect      DNSMonitor.run over version 0 of the estate
+    save_file    save_to_file          load_file    load_from_file
+    save_s3      save_to_s3            load_s3      load_from_s3
+    collect_new  DNSMonitor.run over version 1 (with churn)
+    diff         DNSMonitor_diff.run against the state loaded from S3
+    deliver      the changes through a SinkPipeline to Slack and Sumo
+
+    python3 benchmarks/bench_estate.py [--zones 5000] [--records 1000000]
+        [--churn 0.05] [--latency route53=20 ...] [--env STATE_FORMAT=indexed]
+        [--save-baseline FILE | --baseline FILE [--tolerance 0.25]]
+        [--no-memory]
+
+--save-baseline stores the results as JSON. --baseline compares against
+such a file and exits non-zero when a phase got slower (by more than the
+tolerance and --min-seconds) or used more memory than the tolerance allows,
+or when a phase processed a different number of items, which for a
+deterministic estate means behavior changed. Peak memory comes from
+tracemalloc, which slows everything down; --no-memory skips it for
+untraced timings.
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import tracemalloc
+from time import perf_counter
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+sys.path.insert(0, HERE)
+
+from estate import Estate
+from standins import StandIns, DEFAULT_LATENCY
+
+BENCH_ENV = {
+    "AWS_ACCESS_KEY_ID": "bench",
+    "AWS_SECRET_ACCESS_KEY": "bench",
+    "CF_API_EMAIL": "bench@example.com",
+    "CF_API_KEY": "bench",
+    "SLACK_WEBHOOK": "https://hooks.slack.invalid/bench",
+    "SUMO_HTTP_ENDPOINT": "https://sumo.invalid/bench",
+    # The stand-ins do not rate limit, so only their latency counts
+    "SLACK_MESSAGES_PER_SECOND": "1000",
+    "ROUTE53_REQUESTS_PER_SECOND": "1000",
+    "CF_REQUESTS_PER_SECOND": "1000",
+    "WHOIS_REQUESTS_PER_SECOND": "1000",
+    "WHOIS_TOTAL_REQUESTS_PER_SECOND": "1000",
+}
+BUCKET = "bench-bucket"
+OBJECT = "dnsmonitor/state.json"
+
+
+class Phases:
+    def __init__(self, standins, memory):
+        self.standins = standins
+        self.memory = memory
+        self.results = {}
+
+    def run(self, name, fn, unit):
+        """Time fn(), which returns how many units it processed"""
+        self.standins.reset()
+        if self.memory:
+            tracemalloc.reset_peak()
+        start = perf_counter()
+        items = fn()
+        elapsed = perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] if self.memory else None
+        result = {
+            "seconds": round(elapsed, 4),
+            "items": items,
+            "unit": unit,
+            "rate": round(items / elapsed, 1) if elapsed else None,
+            "peak_mb": round(peak / 1048576.0, 1) if peak is not None else None,
+            "calls": {
+                name: counter
+                for name, counter in self.standins.counters().items()
+                if counter["calls"]
+            },
+        }
+        self.results[name] = result
+        print(
+            "%-12s %8.2fs %10i %-8s %10.0f/s  peak %8s  %s"
+            % (
+                name,
+                elapsed,
+                items,
+                unit,
+                result["rate"] or 0,
+                "%.1f MB" % result["peak_mb"] if peak is not None else "-",
+                " ".join(
+                    "%s=%i" % (service, counter["calls"])
+                    for service, counter in sorted(result["calls"].items())
+                ),
+            )
+        )
+        sys.stdout.flush()
+
+
+def record_count(monitor):
+    return sum(
+        len(records)
+        for collection in ("public_records_aws", "public_records_cloudflare")
+        for records in getattr(monitor, collection).values()
+    ) + sum(len(records) for records in monitor.private_records_aws.values())
+
+
+def bench(args, env):
+    from dnsmonitor import DNSMonitor, DNSMonitor_diff, SinkPipeline
+
+    estate = Estate(args.zones, args.records, args.churn, args.seed)
+    latency = dict(DEFAULT_LATENCY)
+    for item in args.latency:
+        service, _, ms = item.partition("=")
+        latency[service] = float(ms) / 1000.0
+    standins = StandIns(estate, latency)
+    standins.install()
+    if args.memory:
+        tracemalloc.start()
+    phases = Phases(standins, args.memory)
+    workdir = tempfile.mkdtemp(prefix="bench-estate-")
+    path = os.path.join(workdir, "dnsmonitor.json")
+    try:
+        old = DNSMonitor(env=env)
+        phases.run("collect", lambda: old.run() or record_count(old), "records")
+        phases.run(
+            "save_file",
+            lambda: old.save_to_file(path) or os.path.getsize(path),
+            "bytes",
+        )
+        loaded = DNSMonitor(env=env)
+        phases.run(
+            "load_file",
+            lambda: loaded.load_from_file(path) or len(loaded.public_zones),
+            "zones",
+        )
+        del loaded
+        phases.run(
+            "save_s3",
+            lambda: old.save_to_s3(BUCKET, OBJECT) or standins.services["s3"].bytes,
+            "bytes",
+        )
+        del old
+        previous = DNSMonitor(env=env)
+        phases.run(
+            "load_s3",
+            lambda: previous.load_from_s3(BUCKET, OBJECT) or len(previous.public_zones),
+            "zones",
+        )
+        standins.estate = estate.version(1)
+        new = DNSMonitor(env=env)
+        phases.run("collect_new", lambda: new.run() or record_count(new), "records")
+        differ = DNSMonitor_diff(new=new, old=previous, env=env)
+        phases.run("diff", lambda: differ.run() or len(differ.changes), "changes")
+
+        def deliver():
+            with SinkPipeline.from_env(env) as pipeline:
+                for change in differ.changes:
+                    pipeline.emit(change)
+            return len(differ.changes)
+
+        phases.run("deliver", deliver, "changes")
+    finally:
+        standins.close()
+        for name in os.listdir(workdir):
+            os.remove(os.path.join(workdir, name))
+        os.rmdir(workdir)
+    return phases.results
+
+
+def compare(results, baseline, tolerance, min_seconds):
+    """Print how each phase moved against the baseline; True if it regressed"""
+    regressed = False
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print("%-12s not in baseline" % name)
+            continue
+        notes = []
+        ratio = result["seconds"] / base["seconds"] if base["seconds"] else 1.0
+        notes.append("time %+.0f%%" % ((ratio - 1) * 100))
+        # Phases of a few milliseconds are too noisy to judge by ratio alone
+        slower = result["seconds"] - base["seconds"] > min_seconds
+        if ratio > 1 + tolerance and slower:
+            notes[-1] += " REGRESSED"
+            regressed = True
+        if result["peak_mb"] is not None and base.get("peak_mb"):
+            ratio = result["peak_mb"] / base["peak_mb"]
+            notes.append("memory %+.0f%%" % ((ratio - 1) * 100))
+            if ratio > 1 + tolerance:
+                notes[-1] += " REGRESSED"
+                regressed = True
+        if result["items"] != base["items"]:
+            notes.append(
+                "%s %i != %i CHANGED" % (result["unit"], result["items"], base["items"])
+            )
+            regressed = True
+        print("%-12s %s" % (name, ", ".join(notes)))
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--zones", type=int, default=5000)
+    parser.add_argument("--records", type=int, default=1000000)
+    parser.add_argument("--churn", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--latency",
+        action="append",
+        default=[],
+        metavar="SERVICE=MS",
+        help="per-call latency of a stand-in: %s" % ", ".join(DEFAULT_LATENCY),
+    )
+    parser.add_argument(
+        "--env",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="extra DNSMonitor environment, e.g. STATE_FORMAT=indexed",
+    )
+    parser.add_argument("--no-memory", dest="memory", action="store_false")
+    parser.add_argument("--save-baseline", metavar="FILE")
+    parser.add_argument("--baseline", metavar="FILE")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--min-seconds", type=float, default=0.05)
+    args = parser.parse_args()
+
+    env = dict(BENCH_ENV)
+    for item in args.env:
+        name, _, value = item.partition("=")
+        env[name] = value
+    logging.basicConfig(level=logging.WARNING)
+    config = {
+        "zones": args.zones,
+        "records": args.records,
+        "churn": args.churn,
+        "seed": args.seed,
+        "latency": sorted(args.latency),
+        "env": sorted(args.env),
+        "memory": args.memory,
+    }
+    print(
+        "%i zones, %i records, churn %.2f, seed %i"
+        % (args.zones, args.records, args.churn, args.seed)
+    )
+    results = bench(args, env)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as fh:
+            json.dump({"config": config, "phases": results}, fh, indent=2)
+        print("baseline saved to %s" % args.save_baseline)
+    if args.baseline:
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)
+        if baseline["config"] != config:
+            print("warning: baseline was recorded with %s" % baseline["config"])
+        if compare(results, baseline["phases"], args.tolerance, args.min_seconds):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
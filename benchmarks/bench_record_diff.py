@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Benchmark the sorted-merge record diff against the old difflib path
+
+Builds a synthetic zone of N records, applies churn (value changes, TTL
+changes, removals and additions) and times both engines on it.
+
+    python3 benchmarks/bench_record_diff.py [records] [churn_percent]
+"""
+
+from difflib import unified_diff
+import os
+import random
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from dnsmonitor.record_diff import diff_sorted
+
+
+def make_zone(n, rng):
+    records = []
+    for i in range(n):
+        records.append(
+            "host%06i.example.com. 300 IN A 10.%i.%i.%i"
+            % (i, i >> 16 & 255, i >> 8 & 255, i & 255)
+        )
+        if i % 10 == 0:
+            records.append('host%06i.example.com. 300 IN TXT "v=%i"' % (i, i))
+    records.sort()
+    return records
+
+
+def churn(records, percent, rng):
+    records = list(records)
+    changes = max(1, len(records) * percent // 100)
+    for _ in range(changes):
+        i = rng.randrange(len(records))
+        op = rng.randrange(4)
+        if op == 0:
+            records[i] = records[i].replace(" 300 IN ", " 60 IN ")
+        elif op == 1:
+            records[i] = records[i].rsplit(" ", 1)[0] + " 192.0.2.%i" % rng.randrange(
+                256
+            )
+        elif op == 2:
+            del records[i]
+        else:
+            records.append("new%06i.example.com. 300 IN A 198.51.100.1" % i)
+    return sorted(set(records))
+
+
+def legacy_diff(old, new):
+    """The unified_diff + prefix filter DNSMonitor_diff.diff used to run"""
+    mydiff = []
+    for line in unified_diff(old, new, fromfile="before", tofile="after"):
+        if not line.startswith(
+            (" ", "@@", "+++", "---", "->>>", "+>>>", "+% WHOIS", "-% WHOIS")
+        ):
+            mydiff.append(line.rstrip())
+    return mydiff
+
+
+def timed(fn, *args):
+    start = perf_counter()
+    result = fn(*args)
+    return perf_counter() - start, result
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    percent = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    rng = random.Random(42)
+    old = make_zone(n, rng)
+    new = churn(old, percent, rng)
+    legacy_time, legacy = timed(legacy_diff, old, new)
+    merge_time, result = timed(diff_sorted, old, new)
+    print("zone: %i -> %i records, %i%% churn" % (len(old), len(new), percent))
+    print("difflib:      %8.1f ms, %i lines" % (legacy_time * 1000, len(legacy)))
+    print(
+        "sorted merge: %8.1f ms, %i added, %i removed, %i modified (%.0fx)"
+        % (
+            merge_time * 1000,
+            len(result.added),
+            len(result.removed),
+            len(result.modified),
+            legacy_time / merge_time,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
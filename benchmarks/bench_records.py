@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Compare record representations by collection time and peak RSS
+
+    legacy   format each record as a string and insert it into a per-zone
+             SortedList, the way DNSMonitor used to
+    tuple    (name, ttl, type, value) namedtuples with interned fields,
+             appended and sorted once per zone
+    current  DNSMonitor.save_aws_record + sort_records: text entries
+             appended to a plain list and sorted once per zone
+
+Each mode runs in its own process so peak RSS is measured independently.
+
+    python3 benchmarks/bench_records.py [zones] [records_per_zone]
+"""
+
+from collections import namedtuple
+import os
+import resource
+import subprocess
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+Record = namedtuple("Record", ("name", "ttl", "type", "value"))
+
+
+def synthetic(zones, per_zone):
+    for z in range(zones):
+        zone = "zone%05i.example.com" % z
+        for r in range(per_zone):
+            yield (
+                zone,
+                "host%05i.%s." % (r, zone),
+                "A" if r % 4 else "CNAME",
+                "10.%i.%i.%i" % (z >> 8 & 255, z & 255, r & 255),
+                300,
+            )
+
+
+def legacy(zones, per_zone):
+    from sortedcontainers import SortedDict, SortedList
+
+    collected = SortedDict()
+    for zone, dnsname, dnstype, target, ttl in synthetic(zones, per_zone):
+        if zone not in collected:
+            collected[zone] = SortedList()
+        collected[zone].add("%s %s IN %s %s" % (dnsname, ttl, dnstype, target))
+    return collected
+
+
+def tuples(zones, per_zone):
+    collected = {}
+    for zone, dnsname, dnstype, target, ttl in synthetic(zones, per_zone):
+        record = Record(
+            sys.intern(dnsname), sys.intern(str(ttl)), sys.intern(dnstype), target
+        )
+        collected.setdefault(zone, []).append(record)
+    for records in collected.values():
+        records.sort()
+    return collected
+
+
+def current(zones, per_zone):
+    from dnsmonitor import DNSMonitor
+
+    monitor = DNSMonitor(env={})
+    monitor.public_records_aws = {}
+    for zone, dnsname, dnstype, target, ttl in synthetic(zones, per_zone):
+        monitor.save_aws_record(zone, dnsname, dnstype, target, ttl)
+    monitor.sort_records()
+    return monitor.public_records_aws
+
+
+def measure(mode, zones, per_zone):
+    import dnsmonitor  # keep import cost out of the numbers
+
+    modes = {"legacy": legacy, "tuple": tuples, "current": current}
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = perf_counter()
+    modes[mode](zones, per_zone)
+    elapsed = perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print("%f %i" % (elapsed, peak - baseline))
+
+
+def main():
+    zones = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    per_zone = int(sys.argv[2]) if len(sys.argv) > 2 else 250
+    print("%i zones x %i records" % (zones, per_zone))
+    for mode in ("legacy", "tuple", "current"):
+        out = subprocess.check_output(
+            [sys.executable, __file__, "--measure", mode, str(zones), str(per_zone)]
+        )
+        elapsed, rss_kb = out.decode().split()
+        print(
+            "%-8s %6.2f s  peak RSS +%7.1f MB"
+            % (mode, float(elapsed), int(rss_kb) / 1024.0)
+        )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--measure":
+        measure(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))
+    else:
+        main()
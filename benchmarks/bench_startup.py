@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Cold-start cost: time to import main and build a DNSMonitor, each sample in
+a fresh interpreter, and which heavy modules that pulled in
+
+    python3 benchmarks/bench_startup.py [samples] [--max-ms N]
+
+Provider and sink libraries should only load once their environment
+variables are used, so importing any of LAZY, or a median above --max-ms,
+exits non-zero to catch cold-start regressions.
+"""
+
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+LAZY = ("boto3", "botocore", "CloudFlare", "requests", "asyncio")
+
+SAMPLE = """
+import sys
+from time import perf_counter
+start = perf_counter()
+import main
+import dnsmonitor
+dnsmonitor.DNSMonitor(env={})
+elapsed = perf_counter() - start
+print(elapsed * 1000, ",".join(m for m in %r if m in sys.modules))
+""" % (LAZY,)
+
+
+def sample():
+    out = subprocess.check_output([sys.executable, "-c", SAMPLE], cwd=ROOT, env={})
+    elapsed, _, loaded = out.decode().strip().partition(" ")
+    return float(elapsed), [m for m in loaded.split(",") if m]
+
+
+def main():
+    args = sys.argv[1:]
+    max_ms = None
+    if "--max-ms" in args:
+        i = args.index("--max-ms")
+        max_ms = float(args[i + 1])
+        del args[i : i + 2]
+    samples = int(args[0]) if args else 10
+    times = []
+    loaded = set()
+    for _ in range(samples):
+        elapsed, modules = sample()
+        times.append(elapsed)
+        loaded.update(modules)
+    median = statistics.median(times)
+    print(
+        "import + DNSMonitor(): median %6.1f ms  min %6.1f ms  max %6.1f ms  (%i runs)"
+        % (median, min(times), max(times), samples)
+    )
+    failed = False
+    if loaded:
+        print("eagerly imported: %s" % ", ".join(sorted(loaded)))
+        failed = True
+    if max_ms is not None and median > max_ms:
+        print("median above %.1f ms" % max_ms)
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for NICClient response handling on large whois bodies
+
+Compares the original read loop (bytes += chunk, then decoding the whole
+response to look for a referral) against the current NICClient.whois, both
+reading from a local server that streams a multi-hundred-KB response.
+
+    python3 benchmarks/bench_whois.py [size_kb] [rounds]
+"""
+
+import os
+import socket
+import socketserver
+import sys
+import threading
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from dnsmonitor.whois import NICClient
+
+
+def make_body(size_kb):
+    line = b"Remarks: lorem ipsum dolor sit amet, consectetur adipiscing elit\r\n"
+    body = line * (size_kb * 1024 // len(line))
+    return b"Domain Name: EXAMPLE.COM\r\nRegistrar: Example Inc\r\n" + body
+
+
+def serve(body):
+    class Handler(socketserver.BaseRequestHandler):
+        def handle(self):
+            self.request.recv(1024)
+            # Dribble the body out like a slow registry would
+            for i in range(0, len(body), 1460):
+                self.request.sendall(body[i : i + 1460])
+
+    class Server(socketserver.ThreadingTCPServer):
+        allow_reuse_address = True
+        daemon_threads = True
+
+    server = Server(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def legacy_whois(client, query, hostname, port):
+    """The read loop and referral search as NICClient originally did them"""
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.settimeout(5)
+    s.connect((hostname, port))
+    s.send((query + "\r\n").encode())
+    response = b""
+    while True:
+        d = s.recv(4096)
+        response += d
+        if not d:
+            break
+    s.close()
+    client.findwhois_server(response.decode(), hostname)
+    return response
+
+
+def current_whois(client, query, hostname, port):
+    return client.whois(query, hostname, NICClient.WHOIS_RECURSE)
+
+
+def bench(fn, rounds, port):
+    client = NICClient(port=port)
+    best = None
+    for _ in range(rounds):
+        start = perf_counter()
+        fn(client, "example.com", "127.0.0.1", port)
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    size_kb = int(sys.argv[1]) if len(sys.argv) > 1 else 512
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    server = serve(make_body(size_kb))
+    port = server.server_address[1]
+    legacy = bench(legacy_whois, rounds, port)
+    current = bench(current_whois, rounds, port)
+    print("response size: %i KB, best of %i" % (size_kb, rounds))
+    print("legacy:  %8.2f ms" % (legacy * 1000))
+    print("current: %8.2f ms (%.1fx)" % (current * 1000, legacy / current))
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""
+A local stand-in for authoritative nameservers, for benchmarks and tests
+
+Serves zones given as the same record lists DNSMonitor keeps, over UDP and
+TCP on one port. Answers that do not fit the client's UDP payload size set
+the TC bit, so clients have to retry over TCP. A delay and a drop rate
+imitate slow or lossy servers.
+
+    server = serve({"example.com": ["example.com. 300 IN A 192.0.2.1"]})
+    host, port = server.address
+    ...
+    server.close()
+"""
+
+import os
+import random
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from dnsmonitor.dns_wire import HEADER, RR, TYPES, CLASS_IN, encode_name
+from dnsmonitor.dns_wire import FLAG_QR, FLAG_AA, FLAG_TC, decode_name, unescape_name
+from dnsmonitor.record_diff import split_record
+
+
+def _strings(value):
+    """TXT values as character strings, quoted or not"""
+    if not value.startswith('"'):
+        raw = value.encode()
+        return [raw[i : i + 255] for i in range(0, len(raw), 255)] or [b""]
+    return [p.encode() for i, p in enumerate(value.split('"')) if i % 2]
+
+
+def encode_rdata(dnstype, value):
+    tokens = value.split()
+    if dnstype == "A":
+        return socket.inet_pton(socket.AF_INET, value)
+    if dnstype == "AAAA":
+        return socket.inet_pton(socket.AF_INET6, value)
+    if dnstype in ("NS", "CNAME", "PTR"):
+        return encode_name(value)
+    if dnstype == "MX":
+        return struct.pack(">H", int(tokens[0])) + encode_name(tokens[1])
+    if dnstype in ("TXT", "SPF"):
+        return b"".join(bytes([len(s)]) + s for s in _strings(value))
+    if dnstype == "SRV":
+        head = struct.pack(">HHH", *(int(t) for t in tokens[:3]))
+        return head + encode_name(tokens[3])
+    if dnstype == "CAA":
+        tag = tokens[1].encode()
+        return bytes([int(tokens[0]), len(tag)]) + tag + tokens[2].strip('"').encode()
+    if dnstype == "SOA":
+        names = encode_name(tokens[0]) + encode_name(tokens[1])
+        return names + struct.pack(">IIIII", *(int(t) for t in tokens[2:7]))
+    raise ValueError("Cannot serve %s records" % dnstype)
+
+
+def build_answers(zones):
+    """{(wire name, type code): [(ttl, rdata)]} for every servable record"""
+    answers = {}
+    for records in zones.values():
+        for entry in records:
+            name, ttl, dnstype, value = split_record(entry)
+            if dnstype not in TYPES or ttl == "":
+                continue
+            try:
+                rdata = encode_rdata(dnstype, value)
+            except (ValueError, IndexError, OSError):
+                # Left unserved, like records a real server would not load
+                continue
+            key = (encode_name(name).lower(), TYPES[dnstype])
+            answers.setdefault(key, []).append((int(ttl), rdata))
+    return answers
+
+
+class StandInDNS:
+    def __init__(self, zones, delay=0, drop=0.0, host="127.0.0.1"):
+        self.answers = build_answers(zones)
+        self.names = {name for name, _ in self.answers}
+        self.delay = delay
+        self.drop = drop
+        self.queries = 0
+        self.tcp_queries = 0
+        owner = self
+
+        class UDPHandler(socketserver.BaseRequestHandler):
+            def handle(self):
+                data, sock = self.request
+                owner.queries += 1
+                if owner.drop and random.random() < owner.drop:
+                    return
+                if owner.delay:
+                    time.sleep(owner.delay)
+                response = owner.respond(data, tcp=False)
+                if response:
+                    sock.sendto(response, self.client_address)
+
+        class TCPHandler(socketserver.BaseRequestHandler):
+            def handle(self):
+                length = self.request.recv(2)
+                if len(length) < 2:
+                    return
+                size = int.from_bytes(length, "big")
+                data = b""
+                while len(data) < size:
+                    chunk = self.request.recv(size - len(data))
+                    if not chunk:
+                        return
+                    data += chunk
+                owner.tcp_queries += 1
+                response = owner.respond(data, tcp=True)
+                if response:
+                    self.request.sendall(len(response).to_bytes(2, "big") + response)
+
+        class UDPServer(socketserver.ThreadingUDPServer):
+            daemon_threads = True
+
+        class TCPServer(socketserver.ThreadingTCPServer):
+            allow_reuse_address = True
+            daemon_threads = True
+
+        self.udp = UDPServer((host, 0), UDPHandler)
+        self.address = self.udp.server_address
+        self.tcp = TCPServer(self.address, TCPHandler)
+        for server in (self.udp, self.tcp):
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def respond(self, data, tcp):
+        try:
+            qid, _, qdcount, _, _, arcount = HEADER.unpack_from(data)
+            name, offset = decode_name(data, HEADER.size)
+            qtype, _ = struct.unpack_from(">HH", data, offset)
+        except (struct.error, ValueError, IndexError):
+            return None
+        question = data[HEADER.size : offset + 4]
+        # Queries carrying an EDNS0 OPT record may take larger UDP answers
+        limit = 65535 if tcp else (4096 if arcount else 512)
+        wire = encode_name(unescape_name(name)).lower()
+        records = self.answers.get((wire, qtype), [])
+        flags = FLAG_QR | FLAG_AA
+        if not records and wire not in self.names:
+            flags |= 3
+        body = b"".join(
+            b"\xc0\x0c" + RR.pack(qtype, CLASS_IN, ttl, len(rdata)) + rdata
+            for ttl, rdata in records
+        )
+        message = HEADER.pack(qid, flags, 1, len(records), 0, 0) + question + body
+        if len(message) > limit:
+            flags |= FLAG_TC
+            message = HEADER.pack(qid, flags, 1, 0, 0, 0) + question
+        return message
+
+    def close(self):
+        for server in (self.udp, self.tcp):
+            server.shutdown()
+            server.server_close()
+
+
+def serve(zones, **kwargs):
+    return StandInDNS(zones, **kwargs)
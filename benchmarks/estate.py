@@ -0,0 +1,141 @@
+"""
+Deterministic synthetic DNS estates for benchmarks
+
+An Estate describes zones and their records as pure functions of a seed, a
+zone index and a version, so a 1M record estate costs no memory until a
+stand-in provider pages through it, and every run sees the same data.
+
+Zone sizes are skewed like real estates: a few zones hold many records and
+most hold a handful. Zones are spread over Route53 public, Route53 private
+and Cloudflare. Version 1 of an estate differs from version 0 by churn:
+that fraction of zones has about 2% of its records edited, added or
+removed, and a tenth of that fraction of zones is deleted and replaced by
+new ones.
+
+    old = Estate(zones=5000, records=1000000, churn=0.05)
+    new = old.version(1)
+"""
+
+import hashlib
+
+RECORD_TYPES = ("A", "A", "A", "CNAME", "AAAA", "TXT", "MX")
+PRIVATE_SHARE = 0.1
+CLOUDFLARE_SHARE = 0.3
+RECORD_CHURN = 0.02
+
+
+def unit(*key):
+    """A deterministic float in [0, 1) for any key"""
+    digest = hashlib.blake2b(repr(key).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") / 2.0**64
+
+
+class Estate:
+    def __init__(self, zones=5000, records=1000000, churn=0.05, seed=1, version=0):
+        self.zone_count = zones
+        self.record_count = records
+        self.churn = churn
+        self.seed = seed
+        self.current = version
+        # Zipf-like sizes, at least 3 records (apex NS, SOA and one host)
+        weights = [1.0 / (i + 1) ** 0.9 for i in range(zones)]
+        total = sum(weights)
+        self.sizes = [max(3, int(records * w / total)) for w in weights]
+        # Rounding leftovers go to the biggest zone, so the total is exact
+        self.sizes[0] += max(0, records - sum(self.sizes))
+        # Big zones land anywhere in the listing, not just at the start
+        order = sorted(range(zones), key=lambda z: unit(seed, "order", z))
+        self.sizes = [self.sizes[i] for i in order]
+
+    def version(self, version):
+        return Estate(
+            self.zone_count, self.record_count, self.churn, self.seed, version
+        )
+
+    def __changed(self, *key):
+        return self.current > 0 and unit(self.seed, self.current, *key) < self.churn
+
+    def zone_indexes(self):
+        """Zones present in this version; replaced zones get new indexes"""
+        indexes = []
+        replaced = 0
+        for z in range(self.zone_count):
+            if self.__changed("zone", z) and unit(self.seed, "drop", z) < 0.1:
+                replaced += 1
+            else:
+                indexes.append(z)
+        indexes.extend(range(self.zone_count, self.zone_count + replaced))
+        return indexes
+
+    def provider(self, z):
+        """'aws', 'aws-private' or 'cloudflare'"""
+        u = unit(self.seed, "provider", z)
+        if u < PRIVATE_SHARE:
+            return "aws-private"
+        if u < PRIVATE_SHARE + CLOUDFLARE_SHARE:
+            return "cloudflare"
+        return "aws"
+
+    def zone_name(self, z):
+        return "zone%05i.example%i.com" % (z, z % 7)
+
+    def size(self, z):
+        return self.sizes[z % self.zone_count]
+
+    def zone_changed(self, z):
+        return self.__changed("records", z)
+
+    def records(self, z):
+        """Yield (name, type, ttl, value) for every record of zone z"""
+        zone = self.zone_name(z)
+        yield (zone + ".", "NS", 172800, "ns1.example-dns.net.")
+        yield (
+            zone + ".",
+            "SOA",
+            900,
+            "ns1.example-dns.net. hostmaster.%s. 1 7200 900 1209600 86400" % zone,
+        )
+        changed = self.zone_changed(z)
+        count = self.size(z) - 2
+        if changed:
+            # Removed and added records
+            count += int(count * RECORD_CHURN / 2)
+        for r in range(count):
+            edited = False
+            if changed:
+                u = unit(self.seed, self.current, z, r)
+                if u < RECORD_CHURN / 4:
+                    continue
+                edited = u < RECORD_CHURN
+            yield self.record(z, r, edited)
+
+    def record(self, z, r, edited=False):
+        name = "host%05i.%s." % (r, self.zone_name(z))
+        dnstype = RECORD_TYPES[(z + r) % len(RECORD_TYPES)]
+        salt = self.current if edited else 0
+        if dnstype == "A":
+            value = "10.%i.%i.%i" % (z % 256, r >> 8 & 255, (r + salt) & 255)
+        elif dnstype == "AAAA":
+            value = "2001:db8:%x::%x" % (z, r + salt)
+        elif dnstype == "CNAME":
+            value = "lb%i.%s." % ((r + salt) % 17, self.zone_name(z))
+        elif dnstype == "TXT":
+            value = '"v=spf1 include:_spf%i.example.com ~all"' % (r + salt)
+        else:
+            value = "%i mx%i.%s." % (10 * (r % 3 + 1), salt, self.zone_name(z))
+        return name, dnstype, 300 if r % 5 else 60, value
+
+    def whois(self, z):
+        """Registry whois text; a changed zone may have been renewed"""
+        zone = self.zone_name(z)
+        year = 2030 + (1 if self.__changed("whois", z) else 0)
+        return (
+            "Domain Name: %s\r\n"
+            "Registrar: Example Registrar %i, Inc.\r\n"
+            "Creation Date: 2015-0%i-01T00:00:00Z\r\n"
+            "Registry Expiry Date: %i-01-01T00:00:00Z\r\n"
+            "Domain Status: clientTransferProhibited https://icann.org/epp\r\n"
+            "Name Server: NS1.EXAMPLE-DNS.NET\r\n"
+            "Name Server: NS2.EXAMPLE-DNS.NET\r\n"
+            "DNSSEC: unsigned\r\n" % (zone.upper(), z % 4, z % 9 + 1, year)
+        )
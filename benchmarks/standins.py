@@ -0,0 +1,323 @@
+"""
+In-process stand-ins for every service DNSMonitor talks to
+
+StandIns.install() puts fake boto3 and CloudFlare modules in sys.modules,
+points whois lookups at a local whois server and swaps the Slack and Sumo
+HTTP sessions, so DNSMonitor, DNSMonitor_diff and the sinks run unchanged
+against an Estate (see estate.py) without touching the network. Every
+service sleeps for its configured latency per call, which releases the GIL
+the way waiting on a socket does, and counts its calls and bytes.
+
+    standins = StandIns(Estate(), latency={"route53": 0.02})
+    standins.install()
+    ...
+    standins.close()
+"""
+
+import io
+import itertools
+import re
+import socketserver
+import sys
+import threading
+import time
+import types
+
+DEFAULT_LATENCY = {
+    "route53": 0.02,
+    "cloudflare": 0.02,
+    "whois": 0.03,
+    "s3": 0.01,
+    "slack": 0.005,
+    "sumo": 0.01,
+}
+R53_ZONES_PER_PAGE = 100
+R53_RECORDS_PER_PAGE = 300
+
+
+class Service:
+    """Latency and call/byte counters shared by one stand-in service"""
+
+    def __init__(self, name, latency):
+        self.name = name
+        self.latency = latency
+        self.calls = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def call(self, size=0):
+        with self.lock:
+            self.calls += 1
+            self.bytes += size
+        if self.latency:
+            time.sleep(self.latency)
+
+    def reset(self):
+        with self.lock:
+            self.calls = 0
+            self.bytes = 0
+
+
+class Route53StandIn:
+    def __init__(self, standins):
+        self.standins = standins
+        self.service = standins.services["route53"]
+        # Record generators of truncated listings, keyed by where they resume
+        self.cursors = {}
+        self.lock = threading.Lock()
+
+    def list_hosted_zones(self, Marker=None):
+        self.service.call()
+        estate = self.standins.estate
+        zones = [z for z in estate.zone_indexes() if estate.provider(z) != "cloudflare"]
+        start = int(Marker) if Marker else 0
+        page = []
+        for z in zones[start : start + R53_ZONES_PER_PAGE]:
+            page.append(
+                {
+                    "Id": "/hostedzone/Z%08i" % z,
+                    "Name": estate.zone_name(z) + ".",
+                    "CallerReference": "ref-%i" % z,
+                    "Config": {"PrivateZone": estate.provider(z) == "aws-private"},
+                    "ResourceRecordSetCount": self.standins.count(z),
+                }
+            )
+        response = {"HostedZones": page, "IsTruncated": False}
+        if start + R53_ZONES_PER_PAGE < len(zones):
+            response.update(
+                IsTruncated=True, NextMarker=str(start + R53_ZONES_PER_PAGE)
+            )
+        return response
+
+    def list_resource_record_sets(
+        self, HostedZoneId, StartRecordName=None, StartRecordType=None
+    ):
+        self.service.call()
+        key = (HostedZoneId, StartRecordName, StartRecordType)
+        with self.lock:
+            records = self.cursors.pop(key, None)
+        if records is None:
+            z = int(HostedZoneId.rpartition("Z")[2])
+            records = self.standins.estate.records(z)
+        page = []
+        for name, dnstype, ttl, value in records:
+            if len(page) == R53_RECORDS_PER_PAGE:
+                # Resume the same generator for the next page, as if seeking
+                with self.lock:
+                    self.cursors[HostedZoneId, name, dnstype] = itertools.chain(
+                        [(name, dnstype, ttl, value)], records
+                    )
+                return {
+                    "ResourceRecordSets": page,
+                    "IsTruncated": True,
+                    "NextRecordName": name,
+                    "NextRecordType": dnstype,
+                }
+            page.append(
+                {
+                    "Name": name,
+                    "Type": dnstype,
+                    "TTL": ttl,
+                    "ResourceRecords": [{"Value": value}],
+                }
+            )
+        return {"ResourceRecordSets": page, "IsTruncated": False}
+
+
+class _NoSuchKey(Exception):
+    pass
+
+
+class S3StandIn:
+    exceptions = types.SimpleNamespace(NoSuchKey=_NoSuchKey)
+
+    def __init__(self, standins):
+        self.service = standins.services["s3"]
+        self.objects = {}
+
+    def upload_fileobj(self, fh, bucket, key):
+        self.put_object(Bucket=bucket, Key=key, Body=fh.read())
+
+    def put_object(self, Bucket, Key, Body):
+        if isinstance(Body, str):
+            Body = Body.encode()
+        self.service.call(len(Body))
+        self.objects[Bucket, Key] = bytes(Body)
+
+    def get_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise _NoSuchKey(Key)
+        body = self.objects[Bucket, Key]
+        self.service.call(len(body))
+        return {"Body": io.BytesIO(body), "ContentLength": len(body)}
+
+    def delete_object(self, Bucket, Key):
+        self.service.call()
+        self.objects.pop((Bucket, Key), None)
+
+
+class _CloudflareZones:
+    def __init__(self, standins):
+        self.standins = standins
+        self.service = standins.services["cloudflare"]
+        self.dns_records = types.SimpleNamespace(get=self.records)
+
+    def __page(self, items, params):
+        self.service.call()
+        per_page = params.get("per_page", 20)
+        page = params.get("page", 1)
+        return {
+            "result": items[(page - 1) * per_page : page * per_page],
+            "result_info": {
+                "page": page,
+                "per_page": per_page,
+                "total_pages": max(1, -(-len(items) // per_page)),
+                "total_count": len(items),
+            },
+        }
+
+    def get(self, params=None):
+        estate = self.standins.estate
+        zones = [
+            {
+                "id": "cf%08i" % z,
+                "name": estate.zone_name(z),
+                "modified_on": "2024-01-01T00:00:00Z",
+                "name_servers": ["ns1.example-dns.net", "ns2.example-dns.net"],
+            }
+            for z in estate.zone_indexes()
+            if estate.provider(z) == "cloudflare"
+        ]
+        return self.__page(zones, params or {})
+
+    def records(self, zone_id, params=None):
+        z = int(zone_id[2:])
+        records = [
+            {"name": name.rstrip("."), "type": dnstype, "ttl": ttl, "content": value}
+            for name, dnstype, ttl, value in self.standins.estate.records(z)
+        ]
+        return self.__page(records, params or {})
+
+
+class _Response:
+    status_code = 200
+    headers = {}
+    text = "ok"
+
+
+class HTTPStandIn:
+    """Replaces a sink's pooled requests session"""
+
+    def __init__(self, service):
+        self.service = service
+
+    def post(self, url, data=None, headers=None, timeout=None):
+        size = len(data.encode() if isinstance(data, str) else data or b"")
+        self.service.call(size)
+        return _Response()
+
+
+ZONE_INDEX = re.compile(rb"zone(\d+)\.", re.I)
+
+
+class StandIns:
+    def __init__(self, estate, latency=None):
+        self.estate = estate
+        self.services = {}
+        for name, default in DEFAULT_LATENCY.items():
+            value = (latency or {}).get(name, default)
+            self.services[name] = Service(name, value)
+        self.route53 = Route53StandIn(self)
+        self.s3 = S3StandIn(self)
+        self.whois_server = None
+        self.__restore = []
+
+    def count(self, z):
+        if self.estate.zone_changed(z):
+            return sum(1 for _ in self.estate.records(z))
+        return self.estate.size(z)
+
+    def client(self, service, **kwargs):
+        if service == "route53":
+            return self.route53
+        if service == "s3":
+            return self.s3
+        raise NotImplementedError(service)
+
+    def install(self):
+        # Provider libraries are imported lazily, so fake modules are enough
+        self.__set(sys.modules, "boto3", types.SimpleNamespace(client=self.client))
+        cloudflare = types.ModuleType("CloudFlare")
+        cloudflare.CloudFlare = lambda **kwargs: types.SimpleNamespace(
+            zones=_CloudflareZones(self)
+        )
+        self.__set(sys.modules, "CloudFlare", cloudflare)
+        self.__serve_whois()
+
+        from dnsmonitor import async_whois, to_slack, to_sumologic
+        from dnsmonitor.whois import NICClient
+
+        lookup_all = async_whois.lookup_all
+        address = self.whois_server.server_address
+
+        def standin_lookup_all(domains, flags=0, **kwargs):
+            domains = list(domains)
+            # Every whois server the domains map to is the stand-in
+            choose = NICClient().choose_server
+            servers = {choose(domain): address for domain in domains}
+            return lookup_all(domains, flags, addresses=servers, **kwargs)
+
+        self.__set(vars(async_whois), "lookup_all", standin_lookup_all)
+        slack = HTTPStandIn(self.services["slack"])
+        sumo = HTTPStandIn(self.services["sumo"])
+        self.__set(vars(to_slack), "_session", slack)
+        self.__set(vars(to_sumologic), "_session", sumo)
+
+    def __set(self, namespace, key, value):
+        self.__restore.append((namespace, key, namespace.get(key)))
+        namespace[key] = value
+
+    def __serve_whois(self):
+        standins = self
+        service = self.services["whois"]
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                query = self.rfile.readline()
+                service.call(len(query))
+                match = ZONE_INDEX.search(query)
+                if match is None:
+                    body = "No match for %s\r\n" % query.strip().decode()
+                else:
+                    body = standins.estate.whois(int(match.group(1)))
+                self.wfile.write(body.encode())
+
+        class Server(socketserver.ThreadingTCPServer):
+            allow_reuse_address = True
+            daemon_threads = True
+            request_queue_size = 128
+
+        self.whois_server = Server(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.whois_server.serve_forever, daemon=True).start()
+
+    def close(self):
+        if self.whois_server is not None:
+            self.whois_server.shutdown()
+            self.whois_server.server_close()
+            self.whois_server = None
+        for namespace, key, value in reversed(self.__restore):
+            if value is None:
+                namespace.pop(key, None)
+            else:
+                namespace[key] = value
+        self.__restore = []
+
+    def counters(self):
+        return {
+            name: {"calls": s.calls, "bytes": s.bytes}
+            for name, s in self.services.items()
+        }
+
+    def reset(self):
+        for service in self.services.values():
+            service.reset()
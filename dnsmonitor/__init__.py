@@ -1,2 +1,7 @@
 from .dnsmonitor import DNSMonitor
 from .dnsmonitor_diff import DNSMonitor_diff
+from .accounts import load_accounts, state_path
+from .daemon import Daemon
+from .sinks import SinkPipeline
+from .streaming import stream_scan
+from .metrics import Metrics, publish_metrics
@@ -0,0 +1,97 @@
+"""
+Credential sets for scanning several AWS accounts and Cloudflare tenants
+
+DNSMONITOR_ACCOUNTS holds a JSON list of accounts, each a name plus the
+provider variables to scan it with, for example:
+
+    [
+        {"name": "prod", "AWS_ROLE_ARN": "arn:aws:iam::111111111111:role/dns"},
+        {"name": "corp", "CF_API_EMAIL": "dns@example.com", "CF_API_KEY": "..."}
+    ]
+
+Provider credentials are not inherited from the base environment, so an
+account only scans the providers it names. AWS_ROLE_ARN is assumed with
+the base credentials by the account's own scan (see role_session), so a
+role that cannot be assumed only fails that account, and is assumed again
+whenever its credentials near expiry. Everything else (tuning, sinks) is
+inherited.
+"""
+
+import json
+import os
+
+PROVIDER_VARIABLES = (
+    "AWS_ACCESS_KEY_ID",
+    "AWS_SECRET_ACCESS_KEY",
+    "AWS_SESSION_TOKEN",
+    "CF_API_EMAIL",
+    "CF_API_KEY",
+)
+
+
+def load_accounts(env=os.environ):
+    """
+    Return a list of (name, env) pairs to scan. Without DNSMONITOR_ACCOUNTS
+    this is the base environment alone, with a name of None.
+    """
+    if not env.get("DNSMONITOR_ACCOUNTS"):
+        return [(None, env)]
+    accounts = []
+    for account in json.loads(env["DNSMONITOR_ACCOUNTS"]):
+        account = dict(account)
+        name = account.pop("name")
+        account_env = {k: v for k, v in env.items() if k not in PROVIDER_VARIABLES}
+        account_env.pop("DNSMONITOR_ACCOUNTS", None)
+        if account.get("AWS_ROLE_ARN"):
+            # The base credentials, to assume the role with
+            for variable in PROVIDER_VARIABLES[:3]:
+                if variable in env:
+                    account_env[variable] = env[variable]
+            account_env["AWS_ROLE_SESSION_NAME"] = "dnsmonitor-%s" % name
+        account_env.update(account)
+        accounts.append((name, account_env))
+    return accounts
+
+
+def role_session(env):
+    """
+    boto3 Session for env's AWS_ROLE_ARN, assumed with env's credentials.
+    botocore assumes the role again shortly before the credentials expire,
+    so clients made from the session can be kept indefinitely.
+    """
+    import boto3
+    import botocore.session
+    from botocore.credentials import RefreshableCredentials
+
+    sts = boto3.client(
+        "sts",
+        aws_access_key_id=env.get("AWS_ACCESS_KEY_ID"),
+        aws_secret_access_key=env.get("AWS_SECRET_ACCESS_KEY"),
+        aws_session_token=env.get("AWS_SESSION_TOKEN"),
+    )
+
+    def assume():
+        credentials = sts.assume_role(
+            RoleArn=env["AWS_ROLE_ARN"],
+            RoleSessionName=env.get("AWS_ROLE_SESSION_NAME", "dnsmonitor"),
+        )["Credentials"]
+        return {
+            "access_key": credentials["AccessKeyId"],
+            "secret_key": credentials["SecretAccessKey"],
+            "token": credentials["SessionToken"],
+            "expiry_time": credentials["Expiration"].isoformat(),
+        }
+
+    session = botocore.session.get_session()
+    session._credentials = RefreshableCredentials.create_from_metadata(
+        metadata=assume(), refresh_using=assume, method="sts-assume-role"
+    )
+    return boto3.Session(botocore_session=session)
+
+
+def state_path(path, name):
+    """Where an account's state lives, relative to the configured path"""
+    if name is None:
+        return path
+    head, tail = os.path.split(path)
+    return os.path.join(head, name, tail)
@@ -0,0 +1,120 @@
+"""
+Asyncio whois client for looking up many domains in parallel
+
+Server selection and referral handling are inherited from NICClient so the
+text returned for a domain matches NICClient.whois_lookup exactly. Lookups
+are capped globally and per whois server so a registry never sees more than
+a handful of connections from us at once, and when given a RequestScheduler
+every query also waits for its server's quota and backs off when dropped.
+"""
+import asyncio
+
+from .whois import NICClient
+
+DEFAULT_CONCURRENCY = 20
+DEFAULT_SERVER_CONCURRENCY = 2
+DEFAULT_TIMEOUT = 5
+
+
+class AsyncNICClient(NICClient):
+    def __init__(
+        self,
+        concurrency=DEFAULT_CONCURRENCY,
+        server_concurrency=DEFAULT_SERVER_CONCURRENCY,
+        timeout=DEFAULT_TIMEOUT,
+        port=43,
+        addresses=None,
+        scheduler=None,
+        metrics=None,
+    ):
+        """
+        addresses optionally maps a whois hostname to the (host, port) to
+        connect to instead, which lets a local stand-in server answer for
+        the real registries. metrics records the scheduler's retries and
+        waits.
+        """
+        super().__init__(port=port, scheduler=scheduler)
+        self.metrics = metrics
+        self.concurrency = concurrency
+        self.server_concurrency = server_concurrency
+        self.timeout = timeout
+        self.addresses = addresses or {}
+        self._global_limit = None
+        self._server_limits = {}
+
+    def _server_limit(self, hostname):
+        if hostname not in self._server_limits:
+            self._server_limits[hostname] = asyncio.Semaphore(self.server_concurrency)
+        return self._server_limits[hostname]
+
+    async def _query(self, query, hostname):
+        """Send one query to a whois server and return the raw response"""
+        if self.scheduler is None:
+            return await self._send(query, hostname)
+        return await self.scheduler.call_async(
+            "whois", hostname, self._send, query, hostname, metrics=self.metrics
+        )
+
+    async def _send(self, query, hostname):
+        host, port = self.addresses.get(hostname, (hostname, self.port))
+        # Wait for the server's own slot first, so lookups queued on a busy
+        # server do not hold global slots other servers could use
+        async with self._server_limit(hostname), self._global_limit:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(host, port), self.timeout
+            )
+            try:
+                if hostname == NICClient.GERMNICHOST:
+                    writer.write(("-T dn,ace -C US-ASCII " + query + "\r\n").encode())
+                else:
+                    writer.write((query + "\r\n").encode())
+                await asyncio.wait_for(writer.drain(), self.timeout)
+                chunks = []
+                while True:
+                    d = await asyncio.wait_for(reader.read(65536), self.timeout)
+                    if not d:
+                        break
+                    chunks.append(d)
+            finally:
+                writer.close()
+        return b"".join(chunks)
+
+    async def whois_async(self, query, hostname, flags):
+        """Async counterpart of NICClient.whois, following one referral"""
+        response = await self._query(query, hostname)
+        nhost = None
+        if flags & NICClient.WHOIS_RECURSE:
+            nhost = self.findwhois_server(response, hostname)
+        if nhost != None:
+            response += await self.whois_async(query, nhost, 0)
+        return response
+
+    async def whois_lookup_async(self, query_arg, flags=0):
+        """Async counterpart of NICClient.whois_lookup with default options"""
+        if not (flags & NICClient.WHOIS_QUICK):
+            flags |= NICClient.WHOIS_RECURSE
+        nichost = self.choose_server(query_arg)
+        if nichost == None:
+            raise LookupError("No whois server for %s" % query_arg)
+        result = await self.whois_async(query_arg, nichost, flags)
+        return result.decode()
+
+    async def lookup_many(self, domains, flags=0):
+        """
+        Look up every domain concurrently. Returns a dict of domain to either
+        the whois text or the exception raised while looking it up.
+        """
+        self._global_limit = asyncio.Semaphore(self.concurrency)
+        self._server_limits = {}
+        domains = list(domains)
+        results = await asyncio.gather(
+            *[self.whois_lookup_async(domain, flags) for domain in domains],
+            return_exceptions=True,
+        )
+        return dict(zip(domains, results))
+
+
+def lookup_all(domains, flags=0, **kwargs):
+    """Blocking helper that runs AsyncNICClient.lookup_many on a new loop"""
+    client = AsyncNICClient(**kwargs)
+    return asyncio.run(client.lookup_many(domains, flags))
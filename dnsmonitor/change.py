@@ -0,0 +1,81 @@
+"""
+A detected change, serialized lazily by each sink
+
+A Change holds the rendered diff plus references to the old and new state
+it was computed from (the monitors' own lists and dicts, not copies), so
+keeping every change of a run costs little more than the diffs. Each sink
+serializes it when sending, in one of three state modes:
+
+    inline    oldstate/newstate hold the full old and new state
+    truncate  at most limit entries of each, plus the full counts
+    link      only the count and content hash of each side, matching the
+              zone_hashes saved in the state for record changes
+"""
+
+import hashlib
+import json
+import uuid
+
+from .dnsmonitor import DNSMonitorJSONEncoder
+
+STATE_MODES = ("inline", "truncate", "link")
+DEFAULT_STATE_LIMIT = 100
+
+
+def content_hash(state):
+    """sha256 of a state: a zone's records hash the same way as zone_hashes"""
+    h = hashlib.sha256()
+    if isinstance(state, dict):
+        h.update(json.dumps(state, sort_keys=True, default=str).encode())
+    else:
+        for entry in state:
+            h.update(str(entry).encode())
+            h.update(b"\n")
+    return h.hexdigest()
+
+
+class Change:
+    __slots__ = ("id", "service", "diff", "old", "new", "_old_hash", "_new_hash")
+
+    def __init__(self, service, diff, old, new, old_hash=None, new_hash=None):
+        # A random ID makes searching for log changes easier
+        self.id = str(uuid.uuid4())
+        self.service = service
+        self.diff = diff
+        self.old = old
+        self.new = new
+        self._old_hash = old_hash
+        self._new_hash = new_hash
+
+    @property
+    def old_hash(self):
+        if self._old_hash is None:
+            self._old_hash = content_hash(self.old)
+        return self._old_hash
+
+    @property
+    def new_hash(self):
+        if self._new_hash is None:
+            self._new_hash = content_hash(self.new)
+        return self._new_hash
+
+    def to_dict(self, state="inline", limit=DEFAULT_STATE_LIMIT):
+        if state not in STATE_MODES:
+            raise ValueError("Unknown state mode %r" % state)
+        d = {"id": self.id, "service": self.service, "diff": self.diff}
+        for name, value in (("oldstate", self.old), ("newstate", self.new)):
+            if state == "link":
+                digest = self.old_hash if name == "oldstate" else self.new_hash
+                d[name] = {"count": len(value), "sha256": digest}
+            elif state == "truncate" and len(value) > limit:
+                if isinstance(value, dict):
+                    d[name] = dict(list(value.items())[:limit])
+                else:
+                    d[name] = list(value[:limit])
+                d[name + "_count"] = len(value)
+            else:
+                d[name] = value
+        return d
+
+    def to_json(self, state="inline", limit=DEFAULT_STATE_LIMIT):
+        return json.dumps(self.to_dict(state, limit), cls=DNSMonitorJSONEncoder)
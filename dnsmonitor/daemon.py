@@ -0,0 +1,286 @@
+"""
+Long-running monitor with adaptive per-zone polling
+
+Instead of re-scanning everything on a schedule, the daemon keeps its
+DNSMonitor (clients, sessions and state) in memory and polls each zone on
+its own interval. A zone that changed is polled again after
+DAEMON_MIN_INTERVAL seconds; every unchanged poll multiplies its interval by
+DAEMON_BACKOFF up to DAEMON_MAX_INTERVAL. Zone listings and whois are
+refreshed on their own, slower intervals, and the state is saved every
+DAEMON_SAVE_INTERVAL seconds when something changed.
+"""
+
+import copy
+import heapq
+import logging
+import os
+import random
+import threading
+import time
+
+from .dnsmonitor import SERVED_COLLECTIONS
+from .dnsmonitor_diff import DNSMonitor_diff
+from .state_file import RECORD_COLLECTIONS
+
+DEFAULT_MIN_INTERVAL = 60
+DEFAULT_MAX_INTERVAL = 3600
+DEFAULT_BACKOFF = 2.0
+DEFAULT_ZONE_LIST_INTERVAL = 600
+DEFAULT_WHOIS_INTERVAL = 3600
+DEFAULT_SAVE_INTERVAL = 300
+
+
+def restrict(monitor, zones):
+    """
+    A shallow copy of monitor whose record collections only hold the given
+    zones, keyed by collection, so a diff only walks those zones
+    """
+    view = copy.copy(monitor)
+    view.zone_hashes = {}
+    for collection in RECORD_COLLECTIONS:
+        names = zones.get(collection, ())
+        records = getattr(monitor, collection)
+        hashes = monitor.zone_hashes.get(collection, {})
+        setattr(view, collection, {n: records[n] for n in names if n in records})
+        view.zone_hashes[collection] = {n: hashes[n] for n in names if n in hashes}
+    return view
+
+
+class Daemon:
+    def __init__(
+        self,
+        monitor,
+        save,
+        notify,
+        previous=None,
+        env=os.environ,
+        account=None,
+        stop=None,
+        clock=time.monotonic,
+    ):
+        """
+        monitor is the DNSMonitor kept warm between polls and previous the
+        last saved snapshot, if any. save(monitor) persists the state and
+        notify(differ) ships a diff's changes. Setting stop ends run().
+        """
+        self.monitor = monitor
+        self.previous = previous
+        self.save = save
+        self.notify = notify
+        self.env = env
+        self.account = account
+        self.stop = stop if stop is not None else threading.Event()
+        self.clock = clock
+        self.min_interval = float(env.get("DAEMON_MIN_INTERVAL", DEFAULT_MIN_INTERVAL))
+        self.max_interval = float(env.get("DAEMON_MAX_INTERVAL", DEFAULT_MAX_INTERVAL))
+        self.backoff = float(env.get("DAEMON_BACKOFF", DEFAULT_BACKOFF))
+        self.zone_list_interval = float(
+            env.get("DAEMON_ZONE_LIST_INTERVAL", DEFAULT_ZONE_LIST_INTERVAL)
+        )
+        self.whois_interval = float(
+            env.get("DAEMON_WHOIS_INTERVAL", DEFAULT_WHOIS_INTERVAL)
+        )
+        self.save_interval = float(
+            env.get("DAEMON_SAVE_INTERVAL", DEFAULT_SAVE_INTERVAL)
+        )
+        # (due, provider, zone id) heap and each zone's current interval
+        self.queue = []
+        self.intervals = {}
+        self.dirty = False
+        self.polls = 0
+
+    def run(self):
+        """Scan everything once, then poll zones until stop is set"""
+        if not self.__retry(self.scan) or not self.__retry(self.save, self.monitor):
+            return
+        now = self.clock()
+        self.next_zone_list = now + self.zone_list_interval
+        self.next_whois = now + self.whois_interval
+        self.next_save = now + self.save_interval
+        self.schedule_new(now, spread=self.min_interval)
+        while not self.stop.is_set():
+            self.tick(self.clock())
+            self.stop.wait(max(0, self.next_wakeup() - self.clock()))
+        if self.dirty:
+            self.save(self.monitor)
+
+    def scan(self):
+        """The first full scan, reporting what changed since previous"""
+        self.monitor.run(previous=self.previous)
+        if self.previous is not None:
+            differ = self.__differ(self.monitor, self.previous)
+            differ.run()
+            self.__report(differ)
+        self.previous = None
+
+    def tick(self, now):
+        """Run whatever is due at now"""
+        if now >= self.next_zone_list:
+            self.next_zone_list = now + self.zone_list_interval
+            self.__guard(self.sync_zones, now)
+        if now >= self.next_whois:
+            self.next_whois = now + self.whois_interval
+            self.__guard(self.sync_whois)
+        due = []
+        while self.queue and self.queue[0][0] <= now:
+            _, provider, zone_id = heapq.heappop(self.queue)
+            if zone_id in self.monitor.provider_zones[provider]:
+                due.append((provider, zone_id))
+            else:
+                self.intervals.pop((provider, zone_id), None)
+        if due:
+            self.poll(due, now)
+        if self.dirty and now >= self.next_save:
+            self.next_save = now + self.save_interval
+            self.dirty = False
+            self.__guard(self.save, self.monitor)
+
+    def next_wakeup(self):
+        wakeup = min(self.next_zone_list, self.next_whois)
+        if self.queue:
+            wakeup = min(wakeup, self.queue[0][0])
+        if self.dirty:
+            wakeup = min(wakeup, self.next_save)
+        return wakeup
+
+    def schedule_new(self, now, spread=0):
+        """Queue every listed zone that is not scheduled yet"""
+        for provider, zones in self.monitor.provider_zones.items():
+            for zone_id in zones:
+                if (provider, zone_id) in self.intervals:
+                    continue
+                self.intervals[provider, zone_id] = self.min_interval
+                due = now + random.uniform(0, spread)
+                heapq.heappush(self.queue, (due, provider, zone_id))
+
+    def poll(self, due, now):
+        """Re-fetch due zones, report changes and reschedule them"""
+        by_provider = {}
+        for provider, zone_id in due:
+            by_provider.setdefault(provider, []).append(zone_id)
+        for provider, zone_ids in by_provider.items():
+            zones = self.monitor.provider_zones[provider]
+            touched = {}
+            for zone_id in zone_ids:
+                collection, name = self.monitor.zone_location(provider, zones[zone_id])
+                touched.setdefault(collection, set()).add(name)
+            before = restrict(self.monitor, touched)
+            try:
+                changed = set(self.monitor.refresh_zones(provider, zone_ids))
+            except Exception:
+                logging.exception(
+                    "Polling %i %s zones failed" % (len(zone_ids), provider)
+                )
+                changed = set()
+            self.polls += len(zone_ids)
+            if changed:
+                self.dirty = True
+                differ = self.__differ(restrict(self.monitor, touched), before)
+                differ.diff_records()
+                self.__report(differ)
+            if self.monitor.served_mismatches is not None:
+                self.__guard(self.verify, touched)
+            for zone_id in zone_ids:
+                key = (provider, zone_id)
+                if self.monitor.zone_location(provider, zones[zone_id]) in changed:
+                    interval = self.min_interval
+                else:
+                    interval = min(
+                        self.intervals[key] * self.backoff, self.max_interval
+                    )
+                self.intervals[key] = interval
+                heapq.heappush(self.queue, (now + interval, provider, zone_id))
+
+    def verify(self, touched):
+        """Re-check what the polled zones' nameservers serve"""
+        before = copy.copy(self.monitor)
+        before.served_mismatches = copy.deepcopy(self.monitor.served_mismatches)
+        zones = []
+        for collection in SERVED_COLLECTIONS:
+            records = getattr(self.monitor, collection)
+            for name in sorted(touched.get(collection, ())):
+                if name in records:
+                    zones.append((collection, name, records[name]))
+        self.monitor.verify_served(zones)
+        differ = self.__differ(self.monitor, before)
+        differ.diff_served()
+        if differ.changes:
+            self.dirty = True
+        self.__report(differ)
+
+    def sync_zones(self, now):
+        """Re-list zones: report created and deleted ones and drop their records"""
+        before = copy.copy(self.monitor)
+        self.monitor.list_zones()
+        differ = self.__differ(self.monitor, before)
+        differ.diff_zones()
+        self.__report(differ)
+        listed = {
+            self.monitor.zone_location(provider, zone)
+            for provider, zones in self.monitor.provider_zones.items()
+            for zone in zones.values()
+        }
+        removed = {}
+        for collection in RECORD_COLLECTIONS:
+            records = getattr(self.monitor, collection)
+            gone = [name for name in records if (collection, name) not in listed]
+            if gone:
+                removed[collection] = gone
+        if differ.changes or removed:
+            self.dirty = True
+        if removed:
+            old = restrict(self.monitor, removed)
+            for collection, names in removed.items():
+                hashes = self.monitor.zone_hashes.get(collection, {})
+                served = (self.monitor.served_mismatches or {}).get(collection, {})
+                for name in names:
+                    del getattr(self.monitor, collection)[name]
+                    hashes.pop(name, None)
+                    served.pop(name, None)
+            differ = self.__differ(restrict(self.monitor, removed), old)
+            differ.diff_records()
+            self.__report(differ)
+        # New zones are fetched straight away
+        self.schedule_new(now)
+
+    def sync_whois(self):
+        before = copy.copy(self.monitor)
+        self.monitor.refresh_whois(previous=before)
+        differ = self.__differ(self.monitor, before)
+        differ.diff_whois()
+        self.dirty = True
+        self.__report(differ)
+
+    def __differ(self, new, old):
+        return DNSMonitor_diff(new=new, old=old, env=self.env, account=self.account)
+
+    def __report(self, differ):
+        if differ.changes:
+            logging.info("Shipping %i changes" % len(differ.changes))
+            self.__guard(self.notify, differ)
+
+    def __retry(self, call, *args):
+        """
+        Keep trying a step that has to succeed before polling starts, backing
+        off from DAEMON_MIN_INTERVAL to DAEMON_MAX_INTERVAL. False if stop
+        was set first.
+        """
+        delay = self.min_interval
+        while True:
+            try:
+                call(*args)
+                return True
+            except Exception:
+                logging.exception(
+                    "Daemon step %s failed, retrying in %is" % (call.__name__, delay)
+                )
+            if self.stop.wait(delay):
+                return False
+            delay = min(delay * self.backoff, self.max_interval)
+
+    def __guard(self, call, *args):
+        """Log and survive a failed step, so one bad poll does not stop the daemon"""
+        try:
+            call(*args)
+        except Exception:
+            logging.exception("Daemon step %s failed" % call.__name__)
@@ -0,0 +1,431 @@
+"""
+Check what the authoritative nameservers actually serve against the records
+the provider APIs returned
+
+Every RRset of every public zone is asked of each of the zone's
+nameservers over UDP, falling back to TCP for truncated answers. Queries
+are capped globally and per nameserver, time out and are retried. Each
+RRset a nameserver serves differently from the API, or not at all, becomes
+one mismatch line, and the mismatches are kept in the state so that
+DNSMonitor_diff reports them as they appear and clear. A check that goes
+unanswered keeps its previous mismatch lines: only an answer that matches
+clears a mismatch.
+
+Zones are checked by a ServedVerifier: one event loop on a background
+thread, shared by every monitor in the process, whose client keeps its
+limits and resolved nameserver addresses. Zones handed over one at a time,
+as streaming and the daemon do, are therefore checked concurrently while
+the caller moves on, rather than one by one on a fresh loop.
+
+Records that are not served as configured are skipped: SOA (serials
+move), Route53 aliases (no TTL; served as the target's addresses), Route53
+record sets with a routing policy (which set answers varies by query) and
+Cloudflare A/AAAA/CNAME records with the automatic TTL of 1, which is how
+proxied records appear and which are served as Cloudflare's own addresses.
+"""
+
+import asyncio
+import ipaddress
+import logging
+import random
+import socket
+import threading
+import time
+
+from .dns_wire import encode_query, decode_response, unescape_name, DNSFormatError
+from .record_diff import split_record, SET_IDENTIFIER
+
+DEFAULT_CONCURRENCY = 200
+DEFAULT_SERVER_CONCURRENCY = 20
+DEFAULT_TIMEOUT = 2
+DEFAULT_RETRIES = 2
+# Zones submitted but not yet verified before submit() waits
+DEFAULT_MAX_PENDING = 1000
+# How long a nameserver's resolved address is reused
+RESOLVE_SECONDS = 3600
+SKIPPED_TYPES = ("SOA",)
+PROXIED_TYPES = ("A", "AAAA", "CNAME")
+
+
+class DNSQueryError(Exception):
+    pass
+
+
+class _UDPQuery(asyncio.DatagramProtocol):
+    def __init__(self, packet, qid, future):
+        self.packet = packet
+        self.qid = qid
+        self.future = future
+
+    def connection_made(self, transport):
+        transport.sendto(self.packet)
+
+    def datagram_received(self, data, addr):
+        if self.future.done():
+            return
+        try:
+            response = decode_response(data)
+        except (DNSFormatError, IndexError, ValueError) as e:
+            self.future.set_exception(e)
+            return
+        # Ignore stray datagrams that are not the answer to this query
+        if response.id == self.qid:
+            self.future.set_result(response)
+
+    def error_received(self, exc):
+        if not self.future.done():
+            self.future.set_exception(exc)
+
+
+class AsyncDNSClient:
+    def __init__(
+        self,
+        concurrency=DEFAULT_CONCURRENCY,
+        server_concurrency=DEFAULT_SERVER_CONCURRENCY,
+        timeout=DEFAULT_TIMEOUT,
+        retries=DEFAULT_RETRIES,
+        port=53,
+        addresses=None,
+        address=None,
+    ):
+        """
+        addresses optionally maps a nameserver hostname to the (host, port)
+        to query instead, and address is the (host, port) to send every
+        other query to, which lets a local stand-in server answer for the
+        real nameservers.
+        """
+        self.concurrency = concurrency
+        self.server_concurrency = server_concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.port = port
+        self.addresses = addresses or {}
+        self.address = address
+        self.queries = 0
+        self.failures = 0
+        self._loop = None
+
+    def _bind(self):
+        """
+        Limits and resolutions belong to one event loop; start them afresh
+        when used from another
+        """
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._global_limit = asyncio.Semaphore(self.concurrency)
+            self._server_limits = {}
+            self._resolved = {}
+
+    def _server_limit(self, server):
+        if server not in self._server_limits:
+            self._server_limits[server] = asyncio.Semaphore(self.server_concurrency)
+        return self._server_limits[server]
+
+    async def _address(self, server):
+        """Where to send queries for a nameserver, resolved once an hour"""
+        if server in self.addresses:
+            return self.addresses[server]
+        if self.address is not None:
+            return self.address
+        resolved = self._resolved.get(server)
+        if resolved is None or time.monotonic() - resolved[0] > RESOLVE_SECONDS:
+            resolved = self._resolved[server] = (
+                time.monotonic(),
+                asyncio.ensure_future(
+                    asyncio.get_running_loop().getaddrinfo(
+                        server.rstrip("."), self.port, type=socket.SOCK_DGRAM
+                    )
+                ),
+            )
+        try:
+            infos = await resolved[1]
+        except OSError:
+            # Resolve again next time rather than failing for an hour
+            if self._resolved.get(server) is resolved:
+                del self._resolved[server]
+            raise
+        return infos[0][4][:2]
+
+    async def _udp(self, address, packet, qid):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: _UDPQuery(packet, qid, future), remote_addr=address
+        )
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        finally:
+            transport.close()
+
+    async def _tcp(self, address, packet):
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(*address), self.timeout
+        )
+        try:
+            writer.write(len(packet).to_bytes(2, "big") + packet)
+            await asyncio.wait_for(writer.drain(), self.timeout)
+            length = await asyncio.wait_for(reader.readexactly(2), self.timeout)
+            data = await asyncio.wait_for(
+                reader.readexactly(int.from_bytes(length, "big")), self.timeout
+            )
+        finally:
+            writer.close()
+        return decode_response(data)
+
+    async def query(self, server, name, qtype, tally=None):
+        """
+        Ask one nameserver for one RRset, retrying timeouts and errors.
+        tally, a _Tally, also counts the queries made and the failures.
+        """
+        self._bind()
+        tally = tally or _Tally()
+        error = None
+        try:
+            address = await self._address(server)
+        except OSError as e:
+            self.failures += 1
+            tally.failures += 1
+            raise DNSQueryError("%s %s @%s: %r" % (name, qtype, server, e))
+        # Wait for the server's own slot first, so queries queued on a slow
+        # nameserver do not hold global slots other nameservers could use
+        async with self._server_limit(server), self._global_limit:
+            for _ in range(self.retries + 1):
+                qid = random.getrandbits(16)
+                packet = encode_query(qid, name, qtype)
+                self.queries += 1
+                tally.queries += 1
+                try:
+                    response = await self._udp(address, packet, qid)
+                    if response.truncated:
+                        response = await self._tcp(address, packet)
+                    return response
+                except (asyncio.TimeoutError, OSError, EOFError, ValueError) as e:
+                    error = e
+        self.failures += 1
+        tally.failures += 1
+        raise DNSQueryError("%s %s @%s: %r" % (name, qtype, server, error))
+
+    async def query_many(self, queries, tally=None):
+        """
+        Run (server, name, type) queries concurrently. Returns a list, in the
+        same order, of responses or the exception each query raised.
+        """
+        return await asyncio.gather(
+            *[self.query(*q, tally=tally) for q in queries], return_exceptions=True
+        )
+
+
+class _Tally:
+    """Queries, failed queries and RRsets of one verification"""
+
+    def __init__(self):
+        self.queries = 0
+        self.failures = 0
+        self.rrsets = 0
+        self.unanswered = 0
+
+
+def _normalize(dnstype, value):
+    """Canonical text of a record value, so API and wire formats compare equal"""
+    value = value.strip()
+    if dnstype in ("TXT", "SPF"):
+        if not value.startswith('"'):
+            return value
+        # Concatenate the quoted character strings
+        parts = []
+        for i, piece in enumerate(value.split('"')):
+            if i % 2:
+                parts.append(piece)
+        return "".join(parts).replace("\\\\", "\\")
+    if dnstype in ("A", "AAAA"):
+        try:
+            return str(ipaddress.ip_address(value))
+        except ValueError:
+            return value
+    tokens = [t.strip('"').rstrip(".").lower() for t in value.split()]
+    return " ".join(tokens)
+
+
+def _matches(dnstype, expected, served):
+    """
+    Compare normalized value sets. Cloudflare keeps MX and SRV priorities
+    outside the content, so an expected value with fewer fields is matched
+    against the same number of trailing fields of what is served.
+    """
+    if expected == served:
+        return True
+    if dnstype not in ("MX", "SRV"):
+        return False
+    width = max(len(value.split()) for value in expected)
+    trimmed = set()
+    for value in served:
+        tokens = value.split()
+        trimmed.add(" ".join(tokens[max(0, len(tokens) - width) :]))
+    return trimmed == expected
+
+
+def expected_rrsets(collection, records):
+    """Group a zone's records into {(name, type): values} worth verifying"""
+    rrsets = {}
+    for entry in records:
+        name, ttl, dnstype, value = split_record(entry)
+        if dnstype in SKIPPED_TYPES or ttl == "" or SET_IDENTIFIER in value:
+            continue
+        if collection == "public_records_cloudflare":
+            if dnstype in PROXIED_TYPES and ttl == "1":
+                continue
+        key = (unescape_name(name).lower().rstrip(".") + ".", dnstype)
+        rrsets.setdefault(key, set()).add(_normalize(dnstype, value))
+    return rrsets
+
+
+def _served_values(response, name, dnstype):
+    values = {
+        _normalize(dnstype, data)
+        for rname, rtype, _, data in response.answers
+        if rname.lower() == name and rtype == dnstype
+    }
+    if not values and dnstype == "NS":
+        # Delegations are answered with a referral
+        values = {
+            _normalize(dnstype, data)
+            for rname, rtype, _, data in response.authority
+            if rname.lower() == name and rtype == dnstype
+        }
+    return values
+
+
+def _checks(zones):
+    """
+    Every (zone, collection, server, name, type, expected values) to check
+    for zones, an iterable of (zone, collection, records, nameservers)
+    """
+    checks = []
+    for zone, collection, records, nameservers in zones:
+        for (name, dnstype), expected in sorted(
+            expected_rrsets(collection, records).items()
+        ):
+            for server in nameservers:
+                checks.append((zone, collection, server, name, dnstype, expected))
+    return checks
+
+
+def _line_prefix(name, dnstype, server):
+    return "%s %s @%s " % (name, dnstype, server.rstrip(".").lower())
+
+
+async def _verify(checks, client, previous=None):
+    """
+    Run checks; returns {collection: {zone: mismatch lines}} and a _Tally.
+    Checks that go unanswered carry their lines over from previous, the
+    mismatches last found in the same form.
+    """
+    previous = previous or {}
+    tally = _Tally()
+    tally.rrsets = len(checks)
+    results = await client.query_many(
+        [(server, name, t) for _, _, server, name, t, _ in checks], tally
+    )
+    mismatches = {}
+    for (zone, collection, server, name, dnstype, expected), response in zip(
+        checks, results
+    ):
+        if isinstance(response, Exception) or response.rcode not in (
+            "NOERROR",
+            "NXDOMAIN",
+        ):
+            tally.unanswered += 1
+            prefix = _line_prefix(name, dnstype, server)
+            for line in previous.get(collection, {}).get(zone, ()):
+                if line.startswith(prefix):
+                    mismatches.setdefault(collection, {}).setdefault(zone, []).append(
+                        line
+                    )
+            continue
+        if response.rcode == "NXDOMAIN":
+            served = None
+        else:
+            served = _served_values(response, name, dnstype)
+        if served and _matches(dnstype, expected, served):
+            continue
+        line = "%sexpected %s served %s" % (
+            _line_prefix(name, dnstype, server),
+            " | ".join(sorted(expected)),
+            "NXDOMAIN" if served is None else " | ".join(sorted(served)) or "nothing",
+        )
+        mismatches.setdefault(collection, {}).setdefault(zone, []).append(line)
+    for zones_lines in mismatches.values():
+        for lines in zones_lines.values():
+            lines.sort()
+    return mismatches, tally
+
+
+def verify_zones(zones, client, previous=None):
+    """
+    Check zones, an iterable of (zone, collection, records, nameservers),
+    on a new event loop and return {collection: {zone: sorted mismatch lines}}.
+    previous holds the mismatches last found, kept for unanswered checks.
+    """
+    mismatches, tally = asyncio.run(_verify(_checks(zones), client, previous))
+    logging.info(
+        "Verified %i RRsets with %i queries: %i mismatched zones, %i unanswered"
+        % (
+            tally.rrsets,
+            tally.queries,
+            sum(len(z) for z in mismatches.values()),
+            tally.unanswered,
+        )
+    )
+    return mismatches
+
+
+class ServedVerifier:
+    """
+    Checks zones on its own event loop in a background thread, with one
+    client for its whole life, so zones submitted one at a time are checked
+    concurrently and nameservers are resolved once
+    """
+
+    def __init__(self, client, max_pending=DEFAULT_MAX_PENDING):
+        self.client = client
+        self.loop = asyncio.new_event_loop()
+        # Bounds the zones whose checks are waiting in the loop
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def submit(self, zones, previous=None):
+        """
+        Start checking zones, (zone, collection, records, nameservers), and
+        return a concurrent Future of (mismatches, _Tally) like _verify's.
+        The records are not kept, so they may be dropped straight away.
+        """
+        checks = _checks(zones)
+        self.pending.acquire()
+        future = asyncio.run_coroutine_threadsafe(
+            _verify(checks, self.client, previous), self.loop
+        )
+        future.add_done_callback(lambda _: self.pending.release())
+        return future
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+_verifiers = {}
+_verifiers_lock = threading.Lock()
+
+
+def shared_verifier(**settings):
+    """
+    The process-wide ServedVerifier for these AsyncDNSClient settings, so
+    every monitor and daemon poll shares its loop and resolved addresses
+    """
+    key = tuple(sorted(settings.items()))
+    with _verifiers_lock:
+        if key not in _verifiers:
+            _verifiers[key] = ServedVerifier(AsyncDNSClient(**settings))
+        return _verifiers[key]
@@ -0,0 +1,199 @@
+"""
+Just enough of the DNS wire format to ask authoritative servers questions
+
+Queries are built for one name and type. Responses are decoded into their
+rcode, flags and the answer and authority sections, with each record's
+data in the same presentation format zone files and the provider APIs use.
+"""
+
+import socket
+import struct
+
+TYPES = {
+    "A": 1,
+    "NS": 2,
+    "CNAME": 5,
+    "SOA": 6,
+    "PTR": 12,
+    "MX": 15,
+    "TXT": 16,
+    "AAAA": 28,
+    "SRV": 33,
+    "NAPTR": 35,
+    "DS": 43,
+    "SPF": 99,
+    "CAA": 257,
+}
+TYPE_NAMES = {v: k for k, v in TYPES.items()}
+RCODES = {0: "NOERROR", 1: "FORMERR", 2: "SERVFAIL", 3: "NXDOMAIN", 5: "REFUSED"}
+
+HEADER = struct.Struct(">HHHHHH")
+RR = struct.Struct(">HHIH")
+FLAG_QR = 0x8000
+FLAG_AA = 0x0400
+FLAG_TC = 0x0200
+CLASS_IN = 1
+# EDNS0 OPT record advertising 4096 byte UDP responses, so large RRsets
+# rarely need the TCP fallback
+EDNS_OPT = b"\x00" + RR.pack(41, 4096, 0, 0)
+
+
+class DNSFormatError(ValueError):
+    pass
+
+
+def unescape_name(name):
+    """Turn Route53's octal escapes, such as \\052 for *, into the raw text"""
+    if "\\" not in name:
+        return name
+    out = []
+    i = 0
+    while i < len(name):
+        c = name[i]
+        if c == "\\" and name[i + 1 : i + 4].isdigit():
+            out.append(chr(int(name[i + 1 : i + 4], 8)))
+            i += 4
+        elif c == "\\" and i + 1 < len(name):
+            out.append(name[i + 1])
+            i += 2
+        else:
+            out.append(c)
+            i += 1
+    return "".join(out)
+
+
+def encode_name(name):
+    name = unescape_name(name).rstrip(".")
+    out = bytearray()
+    for label in name.split(".") if name else ():
+        raw = label.encode("idna") if not label.isascii() else label.encode()
+        if not 0 < len(raw) < 64:
+            raise DNSFormatError("Bad label in %r" % name)
+        out.append(len(raw))
+        out += raw
+    out.append(0)
+    return bytes(out)
+
+
+def encode_query(qid, name, qtype):
+    """A non-recursive query for one name and type, with EDNS0"""
+    return (
+        HEADER.pack(qid, 0, 1, 0, 0, 1)
+        + encode_name(name)
+        + struct.pack(">HH", TYPES[qtype], CLASS_IN)
+        + EDNS_OPT
+    )
+
+
+def decode_name(msg, offset):
+    """Read a possibly compressed name; returns (name, offset after it)"""
+    labels = []
+    end = None
+    jumps = 0
+    while True:
+        if offset >= len(msg):
+            raise DNSFormatError("Name runs past the message")
+        length = msg[offset]
+        if length & 0xC0 == 0xC0:
+            if end is None:
+                end = offset + 2
+            jumps += 1
+            if jumps > 64:
+                raise DNSFormatError("Compression loop")
+            offset = (length & 0x3F) << 8 | msg[offset + 1]
+            continue
+        offset += 1
+        if length == 0:
+            break
+        label = msg[offset : offset + length].decode("latin-1")
+        labels.append(label.replace("\\", "\\\\").replace(".", "\\."))
+        offset += length
+    return ".".join(labels) + ".", end if end is not None else offset
+
+
+def _character_strings(data):
+    strings = []
+    i = 0
+    while i < len(data):
+        length = data[i]
+        text = data[i + 1 : i + 1 + length].decode("latin-1")
+        strings.append('"%s"' % text.replace("\\", "\\\\").replace('"', '\\"'))
+        i += 1 + length
+    return strings
+
+
+def rdata_text(msg, rtype, start, length):
+    """Presentation format of one record's data"""
+    data = msg[start : start + length]
+    if rtype == TYPES["A"]:
+        return socket.inet_ntop(socket.AF_INET, data)
+    if rtype == TYPES["AAAA"]:
+        return socket.inet_ntop(socket.AF_INET6, data)
+    if rtype in (TYPES["NS"], TYPES["CNAME"], TYPES["PTR"]):
+        return decode_name(msg, start)[0]
+    if rtype == TYPES["MX"]:
+        (preference,) = struct.unpack_from(">H", msg, start)
+        return "%i %s" % (preference, decode_name(msg, start + 2)[0])
+    if rtype in (TYPES["TXT"], TYPES["SPF"]):
+        return " ".join(_character_strings(data))
+    if rtype == TYPES["SRV"]:
+        priority, weight, port = struct.unpack_from(">HHH", msg, start)
+        target = decode_name(msg, start + 6)[0]
+        return "%i %i %i %s" % (priority, weight, port, target)
+    if rtype == TYPES["CAA"]:
+        flags, tag_length = data[0], data[1]
+        tag = data[2 : 2 + tag_length].decode("latin-1")
+        value = data[2 + tag_length :].decode("latin-1")
+        return '%i %s "%s"' % (flags, tag, value)
+    if rtype == TYPES["SOA"]:
+        mname, offset = decode_name(msg, start)
+        rname, offset = decode_name(msg, offset)
+        serial = struct.unpack_from(">IIIII", msg, offset)
+        return "%s %s %i %i %i %i %i" % ((mname, rname) + serial)
+    return "\\# %i %s" % (len(data), data.hex())
+
+
+class Response:
+    __slots__ = ("id", "flags", "rcode", "answers", "authority")
+
+    def __init__(self, qid, flags, answers, authority):
+        self.id = qid
+        self.flags = flags
+        self.rcode = RCODES.get(flags & 0xF, str(flags & 0xF))
+        self.answers = answers
+        self.authority = authority
+
+    @property
+    def truncated(self):
+        return bool(self.flags & FLAG_TC)
+
+    @property
+    def authoritative(self):
+        return bool(self.flags & FLAG_AA)
+
+
+def decode_response(msg):
+    """
+    Decode a response's answer and authority sections into lists of
+    (name, type, ttl, data) tuples
+    """
+    if len(msg) < HEADER.size:
+        raise DNSFormatError("Short message")
+    qid, flags, qdcount, ancount, nscount, _ = HEADER.unpack_from(msg)
+    offset = HEADER.size
+    for _ in range(qdcount):
+        offset = decode_name(msg, offset)[1] + 4
+    sections = []
+    for count in (ancount, nscount):
+        records = []
+        for _ in range(count):
+            name, offset = decode_name(msg, offset)
+            rtype, rclass, ttl, length = RR.unpack_from(msg, offset)
+            offset += RR.size
+            if offset + length > len(msg):
+                raise DNSFormatError("Record runs past the message")
+            text = rdata_text(msg, rtype, offset, length)
+            records.append((name, TYPE_NAMES.get(rtype, str(rtype)), ttl, text))
+            offset += length
+        sections.append(records)
+    return Response(qid, flags, sections[0], sections[1])
@@ -2,19 +2,165 @@ import sys
 
 sys.path.insert(0, "..")
 
-import boto3
+import copy
+import gzip
+import hashlib
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from itertools import islice
 from subprocess import check_output
-import CloudFlare
 import json
 from time import sleep
 from sortedcontainers import SortedList, SortedDict, SortedSet
 import os
-from .whois import NICClient
 import traceback
 import logging
+from time import time
+from .whois_cache import WhoisCache, DEFAULT_EXPIRY_WINDOW_DAYS
+from .whois_parser import parse_whois, LOOKUP_FAIL
+from . import state_file
+from .record_diff import split_record, SET_IDENTIFIER
+from .metrics import Metrics
+from .scheduler import shared_scheduler, is_throttle, THROTTLE_CODES
+from .state_file import LazyZones, RECORD_COLLECTIONS
+from .zone_store import ZoneStore, S3Backend
 
 logger = logging.getLogger()
 
+# Route53 allows roughly 5 requests/second per account, so keep the default
+# pool small; raise AWS_ZONE_CONCURRENCY for accounts with a higher quota.
+DEFAULT_AWS_ZONE_CONCURRENCY = 4
+DEFAULT_CF_ZONE_CONCURRENCY = 4
+# Largest page sizes the Cloudflare v4 API accepts for these listings
+CF_ZONES_PER_PAGE = 50
+CF_RECORDS_PER_PAGE = 5000
+GZIP_MAGIC = b"\x1f\x8b"
+# Private zones are not served to the internet, so there is nothing to verify
+SERVED_COLLECTIONS = ("public_records_aws", "public_records_cloudflare")
+ZONE_ATTRIBUTES = (
+    "public_zones",
+    "public_zones_aws",
+    "public_zones_cloudflare",
+    "private_zones",
+    "private_zones_aws",
+    "provider_zones",
+)
+
+# boto3 S3 clients are thread-safe and costly to build, so make one per set
+# of credentials and reuse it for every load and save in this process
+_s3_clients = {}
+_s3_clients_lock = threading.Lock()
+
+
+def s3_client(env):
+    import boto3
+
+    key = (
+        env["AWS_ACCESS_KEY_ID"],
+        env["AWS_SECRET_ACCESS_KEY"],
+        env.get("AWS_SESSION_TOKEN"),
+    )
+    with _s3_clients_lock:
+        if key not in _s3_clients:
+            _s3_clients[key] = boto3.client(
+                "s3",
+                aws_access_key_id=key[0],
+                aws_secret_access_key=key[1],
+                aws_session_token=key[2],
+            )
+        return _s3_clients[key]
+
+
+# Request parameters that continue a truncated Route53 listing, and the
+# response fields that hold their values
+ROUTE53_ZONE_PAGING = (("Marker", "NextMarker"),)
+ROUTE53_RECORD_PAGING = (
+    ("StartRecordName", "NextRecordName"),
+    ("StartRecordType", "NextRecordType"),
+    ("StartRecordIdentifier", "NextRecordIdentifier"),
+)
+
+
+def count_aws_call(metrics, service, operation, response):
+    """Count one boto3 response and the retries boto3 made to get it"""
+    metrics.count("api_calls", service=service, operation=operation)
+    retries = response.get("ResponseMetadata", {}).get("RetryAttempts", 0)
+    if retries:
+        metrics.count("api_retries", retries, service=service, operation=operation)
+
+
+def count_aws_error(metrics, service, operation, error):
+    """Count a boto3 call that failed for good, telling throttling apart"""
+    code = getattr(error, "response", {}).get("Error", {}).get("Code")
+    if code in THROTTLE_CODES:
+        metrics.count("api_throttles", service=service, operation=operation)
+    metrics.count("api_errors", service=service, operation=operation)
+
+
+def completed(pool, fn, items, window):
+    """
+    Yield (item, fn(item)) as the calls complete, with at most window calls
+    submitted at once so fetched zones never pile up ahead of the consumer
+    """
+    items = iter(items)
+    pending = {pool.submit(fn, item): item for item in islice(items, window)}
+    while pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            item = pending.pop(future)
+            for following in islice(items, 1):
+                pending[pool.submit(fn, following)] = following
+            yield item, future.result()
+
+
+def zone_hash(records):
+    """Stable content hash of a zone's sorted records"""
+    h = hashlib.sha256()
+    for record in records:
+        h.update(record.encode())
+        h.update(b"\n")
+    return h.hexdigest()
+
+
+class _PrefixedStream:
+    """Put bytes already read back in front of a streaming body"""
+
+    def __init__(self, prefix, stream):
+        self.prefix = prefix
+        self.stream = stream
+
+    def read(self, size=-1):
+        if not self.prefix:
+            return self.stream.read(size)
+        if size is None or size < 0:
+            data, self.prefix = self.prefix + self.stream.read(), b""
+            return data
+        data, self.prefix = self.prefix[:size], self.prefix[size:]
+        if len(data) < size:
+            data += self.stream.read(size - len(data))
+        return data
+
+
+class _S3StateWriter(state_file.StateWriter):
+    """Indexed state written zone by zone into memory, uploaded on close"""
+
+    def __init__(self, client, bucket, obj, encoder, metrics):
+        super().__init__(io.BytesIO(), encoder)
+        self.client = client
+        self.bucket = bucket
+        self.obj = obj
+        self.metrics = metrics
+
+    def close(self, data):
+        super().close(data)
+        size = self.fh.tell()
+        self.fh.seek(0)
+        with self.metrics.timed("s3_save"):
+            self.client.upload_fileobj(self.fh, self.bucket, self.obj)
+        self.metrics.count("api_calls", service="s3", operation="PutObject")
+        self.metrics.count("bytes", size, service="s3", direction="out")
+
 
 class DNSMonitorJSONEncoder(json.JSONEncoder):
     def default(self, obj):  # pylint: disable=E0202
@@ -28,6 +174,8 @@ class DNSMonitorJSONEncoder(json.JSONEncoder):
             l = list(obj)
             l.sort()
             return l
+        elif isinstance(obj, LazyZones):
+            return dict(obj.items())
         else:
             return super().default(obj)
 
@@ -39,18 +187,56 @@ class InvalidDNSRecord(LookupError):
 class DNSMonitor:
     """Scrape together all our DNS stuff so we can analyze it and find differences"""
 
-    public_zones = SortedSet()
-    public_zones_aws = SortedSet()
-    public_zones_cloudflare = SortedSet()
-    private_zones = SortedSet()
-    private_zones_aws = SortedSet()
-    whois = SortedDict()
-    public_records_aws = SortedDict()
-    public_records_cloudflare = SortedDict()
-    private_records_aws = SortedDict()
-
-    def __init__(self, env=os.environ):
+    def __init__(self, env=os.environ, storage_env=None, metrics=None):
+        """
+        env holds the provider credentials to scan with; storage_env, if
+        given, holds the credentials used to load and save state in S3.
+        metrics is the Metrics registry to record into, shared by an
+        account's monitors, diff and sinks.
+        """
         self.env = env
+        self.storage_env = storage_env if storage_env is not None else env
+        self.metrics = metrics if metrics is not None else Metrics()
+        # Every provider request waits its turn here, within the quotas
+        self.scheduler = shared_scheduler(env)
+        self.__r53 = None
+        self.__cf = None
+        self.reset()
+        # Per-zone change fingerprints, keyed by provider then zone id
+        self.zone_fingerprints = {"aws": {}, "cloudflare": {}}
+        self.runs_since_full_refresh = 0
+        self.fingerprinting = False
+        self.previous = None
+        self.on_zone = None
+        self.whois_cache = {}
+        # Content hash of every zone, keyed by record collection then zone
+        self.zone_hashes = {c: {} for c in RECORD_COLLECTIONS}
+        # Served DNS mismatch lines keyed by collection then zone, or None
+        # when DNS_VERIFY is off
+        self.served_mismatches = None
+        self.__nameservers = None
+        # Verifications started but not yet collected
+        self.__verifying = []
+        # The previous snapshot's mismatches, while a run verifies
+        self.__previous_mismatches = {}
+
+    def reset(self):
+        """Start from empty zone and record collections"""
+        self.__reset_zones()
+        self.whois = SortedDict()
+        self.public_records_aws = SortedDict()
+        self.public_records_cloudflare = SortedDict()
+        self.private_records_aws = SortedDict()
+
+    def __reset_zones(self):
+        # Replaced rather than cleared, so copies of this monitor keep theirs
+        self.public_zones = SortedSet()
+        self.public_zones_aws = SortedSet()
+        self.public_zones_cloudflare = SortedSet()
+        self.private_zones = SortedSet()
+        self.private_zones_aws = SortedSet()
+        # Provider zone listings, keyed by provider then zone id
+        self.provider_zones = {"aws": {}, "cloudflare": {}}
 
     def save(self):
         """Serialize the data"""
@@ -64,27 +250,75 @@ class DNSMonitor:
             "public_records_aws": self.public_records_aws,
             "public_records_cloudflare": self.public_records_cloudflare,
             "private_records_aws": self.private_records_aws,
+            "zone_fingerprints": self.zone_fingerprints,
+            "runs_since_full_refresh": self.runs_since_full_refresh,
+            "whois_cache": self.whois_cache,
+            "zone_hashes": self.zone_hashes,
+            "served_mismatches": self.served_mismatches,
         }
         return o
 
-    def save_to_file(self, filename="dnsmonitor.json"):
-        data_json = json.dumps(self.save(), indent=4, cls=DNSMonitorJSONEncoder)
-        with open(filename, "w") as fh:
-            fh.write(data_json)
+    def save_to_file(self, filename="dnsmonitor.json", fmt=None):
+        """
+        Write the state as JSON, or as an indexed compressed file when fmt
+        (or STATE_FORMAT) is "indexed"
+        """
+        fmt = fmt or self.env.get("STATE_FORMAT", "json")
+        with self.metrics.timed("file_save"):
+            if fmt == "indexed":
+                state_file.write_state(self.save(), filename, DNSMonitorJSONEncoder)
+            else:
+                data_json = json.dumps(self.save(), indent=4, cls=DNSMonitorJSONEncoder)
+                with open(filename, "w") as fh:
+                    fh.write(data_json)
+        self.metrics.count(
+            "bytes", os.path.getsize(filename), service="file", direction="out"
+        )
 
     def save_to_s3(self, bucket, obj):
-        filename = "/tmp/%s" % "dnsmonitor.json"
-        self.save_to_file(filename)
-        # Save to s3
-        s3 = boto3.resource(
-            "s3",
-            aws_access_key_id=self.env["AWS_ACCESS_KEY_ID"],
-            aws_secret_access_key=self.env["AWS_SECRET_ACCESS_KEY"],
-            aws_session_token=self.env["AWS_SESSION_TOKEN"],
-        )
-        s3.meta.client.upload_file(filename, bucket, obj)
-        # Cleanup
-        os.remove(filename)
+        """
+        Serialize straight into memory and upload, gzip-compressed for JSON;
+        upload_fileobj switches to a multipart upload for large states
+        """
+        client = s3_client(self.storage_env)
+        if self.env.get("STATE_STORAGE") == "zones":
+            with self.metrics.timed("s3_save"):
+                self.save_to_store(ZoneStore(S3Backend(client, bucket), obj))
+            return
+        with self.metrics.timed("s3_save"):
+            buf = io.BytesIO()
+            if self.env.get("STATE_FORMAT", "json") == "indexed":
+                state_file.write_state(self.save(), buf, DNSMonitorJSONEncoder)
+            else:
+                with gzip.GzipFile(fileobj=buf, mode="wb") as gz:
+                    with io.TextIOWrapper(gz, encoding="utf-8") as text:
+                        json.dump(self.save(), text, cls=DNSMonitorJSONEncoder)
+            size = buf.tell()
+            buf.seek(0)
+            try:
+                client.upload_fileobj(buf, bucket, obj)
+            except Exception as e:
+                count_aws_error(self.metrics, "s3", "PutObject", e)
+                raise
+        self.metrics.count("api_calls", service="s3", operation="PutObject")
+        self.metrics.count("bytes", size, service="s3", direction="out")
+
+    def state_writer(self, filename="dnsmonitor.json"):
+        """A writer for run(on_zone=...) that streams an indexed state file"""
+        return state_file.StateWriter(filename, DNSMonitorJSONEncoder)
+
+    def s3_state_writer(self, bucket, obj):
+        """
+        A writer for run(on_zone=...) that saves to S3: zone by zone with
+        STATE_STORAGE=zones, otherwise as a compressed indexed state that is
+        uploaded when closed
+        """
+        client = s3_client(self.storage_env)
+        if self.env.get("STATE_STORAGE") == "zones":
+            store = ZoneStore(S3Backend(client, bucket), obj)
+            store.begin(DNSMonitorJSONEncoder)
+            return store
+        return _S3StateWriter(client, bucket, obj, DNSMonitorJSONEncoder, self.metrics)
 
     def load(self, data):
         """Deserialize the data"""
@@ -93,122 +327,771 @@ class DNSMonitor:
         self.public_zones_cloudflare = SortedSet(data["public_zones_cloudflare"])
         self.private_zones = SortedSet(data["private_zones"])
         self.private_zones_aws = SortedSet(data["private_zones_aws"])
-        self.whois = SortedDict(data["whois"])
-        self.public_records_aws = SortedDict()
-        for k in data["public_records_aws"]:
-            self.public_records_aws[k] = SortedSet(data["public_records_aws"][k])
-        self.public_records_cloudflare = SortedDict()
-        for k in data["public_records_cloudflare"]:
-            self.public_records_cloudflare[k] = SortedSet(
-                data["public_records_cloudflare"][k]
-            )
-        self.private_records_aws = SortedDict()
-        for k in data["private_records_aws"]:
-            self.private_records_aws[k] = SortedSet(data["private_records_aws"][k])
+        # Older state files hold the raw whois text
+        self.whois = SortedDict()
+        for k, v in data["whois"].items():
+            if isinstance(v, str) and v != LOOKUP_FAIL:
+                v = parse_whois(v)
+            self.whois[k] = v
+        self.public_records_aws = self.__load_records(data["public_records_aws"])
+        self.public_records_cloudflare = self.__load_records(
+            data["public_records_cloudflare"]
+        )
+        self.private_records_aws = self.__load_records(data["private_records_aws"])
+        self.zone_fingerprints = {"aws": {}, "cloudflare": {}}
+        self.zone_fingerprints.update(data.get("zone_fingerprints", {}))
+        self.runs_since_full_refresh = data.get("runs_since_full_refresh", 0)
+        self.whois_cache = data.get("whois_cache", {})
+        self.served_mismatches = data.get("served_mismatches")
+        if "zone_hashes" in data:
+            self.zone_hashes = data["zone_hashes"]
+        else:
+            # State saved before zone hashes existed
+            self.hash_zones()
+
+    def __load_records(self, zones):
+        # Indexed state files already hand back per-zone lazy loaders
+        if isinstance(zones, LazyZones):
+            return zones
+        records = SortedDict()
+        for k in zones:
+            records[k] = sorted(set(zones[k]))
+        return records
 
     def load_from_file(self, filename="dnsmonitor.json"):
-        with open(filename, "r") as fh:
-            data = json.load(fh)
-        self.load(data)
+        """Load either state format, detected from the file's header"""
+        with self.metrics.timed("file_load"):
+            if state_file.is_state_file(filename):
+                self.load(state_file.read_state(filename))
+            else:
+                with open(filename, "r") as fh:
+                    data = json.load(fh)
+                self.load(data)
+        self.metrics.count(
+            "bytes", os.path.getsize(filename), service="file", direction="in"
+        )
 
     def load_from_s3(self, bucket, obj):
-        filename = "/tmp/%s.old" % "dnsmonitor.json"
-        s3 = boto3.resource(
-            "s3",
-            aws_access_key_id=self.env["AWS_ACCESS_KEY_ID"],
-            aws_secret_access_key=self.env["AWS_SECRET_ACCESS_KEY"],
-            aws_session_token=self.env["AWS_SESSION_TOKEN"],
+        """
+        Parse the state from the response body as it streams in. Gzipped
+        JSON, indexed and plain JSON states are detected from their header.
+        """
+        client = s3_client(self.storage_env)
+        if self.env.get("STATE_STORAGE") == "zones":
+            with self.metrics.timed("s3_load"):
+                self.load_from_store(ZoneStore(S3Backend(client, bucket), obj))
+            return
+        with self.metrics.timed("s3_load"):
+            try:
+                response = client.get_object(Bucket=bucket, Key=obj)
+            except Exception as e:
+                count_aws_error(self.metrics, "s3", "GetObject", e)
+                raise
+            count_aws_call(self.metrics, "s3", "GetObject", response)
+            self.metrics.count(
+                "bytes", response.get("ContentLength", 0), service="s3", direction="in"
+            )
+            body = response["Body"]
+            head = body.read(len(state_file.MAGIC))
+            if head in state_file.MAGICS:
+                self.load(state_file.read_state(head + body.read()))
+            elif head.startswith(GZIP_MAGIC):
+                with gzip.GzipFile(fileobj=_PrefixedStream(head, body)) as gz:
+                    self.load(json.load(io.TextIOWrapper(gz, encoding="utf-8")))
+            else:
+                self.load(json.load(_PrefixedStream(head, body)))
+
+    def save_to_store(self, store):
+        """Save to a per-zone ZoneStore, uploading only changed zones"""
+        store.save(self.save(), DNSMonitorJSONEncoder)
+        self.metrics.count(
+            "api_calls", store.uploaded, service="s3", operation="PutObject"
+        )
+        logging.info(
+            "Uploaded %i state blocks, %i unchanged" % (store.uploaded, store.skipped)
         )
-        s3.meta.client.download_file(bucket, obj, filename)
-        self.load_from_file(filename)
-        # Cleanup
-        os.remove(filename)
 
-    def run(self, whois=True, records=True):
-        """Reset the public and private zones and update via APIs"""
+    def load_from_store(self, store):
+        self.load(store.load())
+
+    def run(self, whois=True, records=True, previous=None, on_zone=None):
+        """Reset the public and private zones and update via APIs
+
+        When a previous snapshot is given, zones whose fingerprint has not
+        changed since then reuse its records instead of being re-pulled.
+
+        With on_zone, each zone is handed to on_zone(collection, name,
+        records, hash) as soon as its records are complete and is not kept,
+        so only the zones being fetched are ever held in memory.
+        """
         # Reset zones
-        self.public_zones = set()
-        self.private_zones = set()
-        # Fetch from various providers
-        if "AWS_ACCESS_KEY_ID" in self.env:
-            self.__fetch_aws(records)
-        if "CF_API_KEY" in self.env:
-            self.__fetch_cloudflare(records)
+        self.reset()
+        self.on_zone = on_zone
+        self.zone_hashes = {c: {} for c in RECORD_COLLECTIONS}
+        self.served_mismatches = {} if self.env.get("DNS_VERIFY") else None
+        self.__verifying = []
+        # Kept for the checks that go unanswered this run
+        self.__previous_mismatches = (
+            previous.served_mismatches if previous is not None else None
+        ) or {}
+        self.__start_refresh_cycle(previous)
+        try:
+            # Fetch from various providers
+            if self.__aws_configured():
+                with self.metrics.timed("aws"):
+                    self.__fetch_aws(records)
+            if "CF_API_KEY" in self.env:
+                with self.metrics.timed("cloudflare"):
+                    self.__fetch_cloudflare(records)
+        finally:
+            self.on_zone = None
         if whois:
-            for zone in self.public_zones:
-                self.__fetch_whois(zone)
+            with self.metrics.timed("whois"):
+                self.__fetch_cached_whois(self.public_zones, previous)
+        if on_zone is None:
+            with self.metrics.timed("sort"):
+                self.sort_records()
+                self.hash_zones()
+            if self.served_mismatches is not None:
+                self.verify_served(
+                    (collection, name, records)
+                    for collection in SERVED_COLLECTIONS
+                    for name, records in getattr(self, collection).items()
+                )
+        elif self.__verifying:
+            # Streamed zones were checked while collecting and looking up whois
+            self.__wait_verify()
+        self.__previous_mismatches = {}
+
+    def verify_served(self, zones):
+        """
+        Check (collection, name, records) zones against what their
+        authoritative nameservers serve, adding to served_mismatches
+        """
+        self.__submit_verify(zones)
+        self.__wait_verify()
+
+    def __submit_verify(self, zones):
+        """Start checking zones in the background; see __wait_verify"""
+        checks = []
+        cloudflare_nameservers = self.__cloudflare_nameservers()
+        for collection, name, records in zones:
+            if collection == "public_records_cloudflare":
+                nameservers = cloudflare_nameservers.get(name, [])
+            else:
+                nameservers = self.__apex_nameservers(name, records)
+            checks.append((name, collection, records, nameservers))
+        # Each zone's mismatches are found afresh, keeping the earlier ones
+        # only for checks that go unanswered
+        previous = {}
+        for name, collection, _, _ in checks:
+            lines = self.served_mismatches.get(collection, {}).pop(name, None)
+            if lines is None:
+                lines = self.__previous_mismatches.get(collection, {}).get(name)
+            if lines:
+                previous.setdefault(collection, {})[name] = lines
+        self.__verifying.append(self.__verifier().submit(checks, previous))
+
+    def __wait_verify(self):
+        """Collect the mismatches of every zone submitted for checking"""
+        rrsets = queries = unanswered = 0
+        with self.metrics.timed("verify"):
+            for future in self.__verifying:
+                found, tally = future.result()
+                for collection, zones in found.items():
+                    self.served_mismatches.setdefault(collection, {}).update(zones)
+                self.metrics.count("api_calls", tally.queries, service="dns")
+                self.metrics.count("api_errors", tally.failures, service="dns")
+                rrsets += tally.rrsets
+                queries += tally.queries
+                unanswered += tally.unanswered
+        if self.__verifying:
+            logging.info(
+                "Verified %i RRsets with %i queries: %i mismatched zones, "
+                "%i unanswered"
+                % (
+                    rrsets,
+                    queries,
+                    sum(len(z) for z in self.served_mismatches.values()),
+                    unanswered,
+                )
+            )
+        self.__verifying = []
+
+    def __verifier(self):
+        from .dns_verify import (
+            shared_verifier,
+            DEFAULT_CONCURRENCY as DEFAULT_DNS_CONCURRENCY,
+            DEFAULT_SERVER_CONCURRENCY as DEFAULT_DNS_SERVER_CONCURRENCY,
+            DEFAULT_TIMEOUT as DEFAULT_DNS_TIMEOUT,
+            DEFAULT_RETRIES as DEFAULT_DNS_RETRIES,
+        )
+
+        address = None
+        if self.env.get("DNS_VERIFY_SERVER"):
+            # Send every query to one server, such as a local stand-in
+            host, _, port = self.env["DNS_VERIFY_SERVER"].rpartition(":")
+            address = (host, int(port))
+        return shared_verifier(
+            concurrency=int(
+                self.env.get("DNS_VERIFY_CONCURRENCY", DEFAULT_DNS_CONCURRENCY)
+            ),
+            server_concurrency=int(
+                self.env.get(
+                    "DNS_VERIFY_SERVER_CONCURRENCY", DEFAULT_DNS_SERVER_CONCURRENCY
+                )
+            ),
+            timeout=float(self.env.get("DNS_VERIFY_TIMEOUT", DEFAULT_DNS_TIMEOUT)),
+            retries=int(self.env.get("DNS_VERIFY_RETRIES", DEFAULT_DNS_RETRIES)),
+            address=address,
+        )
+
+    def __cloudflare_nameservers(self):
+        """
+        Nameservers of each Cloudflare zone by name, kept until the zone
+        listing changes since streaming verifies one zone at a time
+        """
+        zones = self.provider_zones["cloudflare"]
+        cached = self.__nameservers
+        if cached is None or cached[0] is not zones or cached[1] != len(zones):
+            nameservers = {
+                zone["name"]: zone.get("name_servers", []) for zone in zones.values()
+            }
+            self.__nameservers = cached = (zones, len(zones), nameservers)
+        return cached[2]
+
+    def __apex_nameservers(self, name, records):
+        """The NS records at a zone's apex"""
+        apex = name.rstrip(".").lower() + "."
+        nameservers = set()
+        for record in records:
+            rname, _, dnstype, value = split_record(record)
+            if dnstype == "NS" and rname.lower() == apex:
+                nameservers.add(value)
+        return sorted(nameservers)
+
+    def __zone_done(self, collection, name):
+        """Hand a completed zone to on_zone, when streaming"""
+        if self.on_zone is None:
+            return
+        records = getattr(self, collection).pop(name, None)
+        if records is None:
+            return
+        records.sort()
+        digest = self.zone_hashes[collection][name] = zone_hash(records)
+        if self.served_mismatches is not None and collection in SERVED_COLLECTIONS:
+            # Checked in the background while the next zones are collected
+            self.__submit_verify([(collection, name, records)])
+        self.on_zone(collection, name, records, digest)
+
+    def sort_records(self):
+        """Sort each zone's records once, after they have all been collected"""
+        for collection in RECORD_COLLECTIONS:
+            for records in getattr(self, collection).values():
+                records.sort()
+
+    def hash_zones(self):
+        """Compute the content hash of every zone in every record collection"""
+        self.zone_hashes = {
+            collection: {
+                zone: zone_hash(records)
+                for zone, records in getattr(self, collection).items()
+            }
+            for collection in RECORD_COLLECTIONS
+        }
+
+    def list_zones(self):
+        """
+        Re-list every provider's zones without fetching any records, and
+        return the listings keyed by provider then zone id
+        """
+        current = copy.copy(self)
+        self.__reset_zones()
+        try:
+            if self.__aws_configured():
+                self.__list_aws_zones(self.__route53())
+            if "CF_API_KEY" in self.env:
+                self.__list_cloudflare_zones(self.__cloudflare())
+        except Exception:
+            # Keep the last complete listing
+            for attr in ZONE_ATTRIBUTES:
+                setattr(self, attr, getattr(current, attr))
+            raise
+        return self.provider_zones
+
+    def zone_location(self, provider, zone):
+        """The (record collection, zone name) a provider zone listing maps to"""
+        if provider == "aws":
+            if zone["Config"]["PrivateZone"]:
+                return "private_records_aws", zone["Name"].rstrip(".")
+            return "public_records_aws", zone["Name"].rstrip(".")
+        return "public_records_cloudflare", zone["name"]
 
-    def __fetch_whois(self, zone):
+    def refresh_zones(self, provider, zone_ids):
+        """
+        Re-fetch the records of some listed zones in place, and return the
+        (collection, name) of each zone whose content changed
+        """
+        zones = [self.provider_zones[provider][zone_id] for zone_id in zone_ids]
+        locations = [self.zone_location(provider, zone) for zone in zones]
+        previous = {}
+        for collection, name in locations:
+            previous[collection, name] = getattr(self, collection).pop(name, None)
         try:
-            flags = 0
-            options = {}
-            nic_client = NICClient()
-            whois = nic_client.whois_lookup(options, zone, flags)
-            clean_whois = str(whois).replace("\\r", "\r").replace("\\n", "\n")
-            self.whois[zone] = clean_whois
+            if provider == "aws":
+                self.__pull_aws_zones(self.__route53(), zones)
+            else:
+                self.__fetch_cloudflare_zones(self.__cloudflare(), zones)
         except Exception:
-            logging.error("Exception looking up zone: %s" % zone)
-            logging.error("-" * 60)
-            traceback.print_exc(file=sys.stdout)
-            logging.error("-" * 60)
-            self.whois[zone] = "LOOKUP FAIL"
+            # Keep the last known records rather than a partial fetch
+            for (collection, name), records in previous.items():
+                getattr(self, collection).pop(name, None)
+                if records is not None:
+                    getattr(self, collection)[name] = records
+            raise
+        changed = []
+        for collection, name in locations:
+            hashes = self.zone_hashes.setdefault(collection, {})
+            records = getattr(self, collection).get(name)
+            if records is None:
+                new_hash = None
+                hashes.pop(name, None)
+            else:
+                records.sort()
+                new_hash = hashes[name] = zone_hash(records)
+            old_records = previous[collection, name]
+            old_hash = None if old_records is None else zone_hash(old_records)
+            if old_hash != new_hash:
+                changed.append((collection, name))
+        return changed
+
+    def refresh_whois(self, previous=None):
+        """Look up whois for the current public zones, using previous's cache"""
+        self.whois = SortedDict()
+        self.__fetch_cached_whois(self.public_zones, previous)
+
+    def __start_refresh_cycle(self, previous):
+        """Decide whether this run may reuse unchanged zones from previous"""
+        self.zone_fingerprints = {"aws": {}, "cloudflare": {}}
+        every = int(self.env.get("ZONE_FULL_REFRESH_RUNS", 0))
+        self.fingerprinting = every > 0
+        if previous is None or every <= 0:
+            self.previous = None
+            self.runs_since_full_refresh = 0
+        elif previous.runs_since_full_refresh + 1 >= every:
+            logging.info("Forcing a full refresh of every zone")
+            self.previous = None
+            self.runs_since_full_refresh = 0
+        else:
+            self.previous = previous
+            self.runs_since_full_refresh = previous.runs_since_full_refresh + 1
+
+    def __unchanged(self, provider, zone_id, fingerprint):
+        """
+        Record the fingerprint of a zone and return whether it matches the
+        previous snapshot's
+        """
+        self.zone_fingerprints[provider][zone_id] = fingerprint
+        if self.previous is None:
+            return False
+        return (
+            self.previous.zone_fingerprints.get(provider, {}).get(zone_id)
+            == fingerprint
+        )
+
+    def __reuse_zone(self, provider, collection, name):
+        """
+        Copy the previous snapshot's records for an unchanged zone. Returns
+        True when the zone does not need to be fetched.
+        """
+        old_records = getattr(self.previous, collection)
+        if name not in old_records:
+            return False
+        getattr(self, collection)[name] = list(old_records[name])
+        self.metrics.count("zones", provider=provider, source="reused")
+        self.metrics.count(
+            "records", len(old_records[name]), provider=provider, source="reused"
+        )
+        self.__zone_done(collection, name)
+        return True
+
+    def __fetch_cached_whois(self, zones, previous):
+        """
+        With WHOIS_CACHE_HOURS set, only look up zones whose cached whois is
+        missing or past its TTL and carry the rest over from previous
+        """
+        hours = float(self.env.get("WHOIS_CACHE_HOURS", 0))
+        cache = WhoisCache(
+            previous.whois_cache if previous is not None else {},
+            ttl=hours * 3600,
+            expiry_window_days=int(
+                self.env.get("WHOIS_EXPIRY_WINDOW_DAYS", DEFAULT_EXPIRY_WINDOW_DAYS)
+            ),
+        )
+        if hours <= 0 or previous is None:
+            due = list(zones)
+        else:
+            due = cache.due(
+                zones,
+                previous.whois,
+                time(),
+                limit=int(self.env.get("WHOIS_MAX_LOOKUPS_PER_RUN", 0)),
+            )
+            fresh = set(zones).difference(due)
+            for zone in fresh:
+                if zone in previous.whois:
+                    self.whois[zone] = previous.whois[zone]
+        logging.info("Looking up whois for %i of %i zones" % (len(due), len(zones)))
+        self.__fetch_whois(due)
+        now = time()
+        for zone in due:
+            cache.update(zone, self.whois[zone], now)
+        self.whois_cache = cache.save(zones) if hours > 0 else {}
+
+    def __fetch_whois(self, zones):
+        """Look up all zones in parallel, bounded globally and per whois server"""
+        # asyncio is only worth loading when there is whois to look up
+        from .async_whois import (
+            lookup_all,
+            DEFAULT_CONCURRENCY as DEFAULT_WHOIS_CONCURRENCY,
+            DEFAULT_SERVER_CONCURRENCY as DEFAULT_WHOIS_SERVER_CONCURRENCY,
+        )
+
+        results = lookup_all(
+            zones,
+            concurrency=int(
+                self.env.get("WHOIS_CONCURRENCY", DEFAULT_WHOIS_CONCURRENCY)
+            ),
+            server_concurrency=int(
+                self.env.get(
+                    "WHOIS_SERVER_CONCURRENCY", DEFAULT_WHOIS_SERVER_CONCURRENCY
+                )
+            ),
+            scheduler=self.scheduler,
+            metrics=self.metrics,
+        )
+        self.metrics.count("api_calls", len(results), service="whois")
+        for zone, whois in results.items():
+            if isinstance(whois, Exception):
+                self.metrics.count("api_errors", service="whois")
+                logging.error("Exception looking up zone: %s" % zone)
+                logging.error("-" * 60)
+                traceback.print_exception(
+                    type(whois), whois, whois.__traceback__, file=sys.stdout
+                )
+                logging.error("-" * 60)
+                self.whois[zone] = LOOKUP_FAIL
+            else:
+                clean_whois = str(whois).replace("\\r", "\r").replace("\\n", "\n")
+                self.whois[zone] = parse_whois(clean_whois)
 
     def __fetch_cloudflare(self, records):
         """
-        Connect to Cloudflare via their API and scrape data 
+        Connect to Cloudflare via their API and scrape data
         This autodetects credentials from the environment or ~/.cloudflare
         """
-        cf = CloudFlare.CloudFlare(
-            email=self.env["CF_API_EMAIL"], token=self.env["CF_API_KEY"]
+        cf = self.__cloudflare()
+        zones = self.__list_cloudflare_zones(cf)
+        stale = []
+        for zone in zones:
+            if (
+                self.fingerprinting
+                and self.__worth_probing(zone)
+                and self.__unchanged(
+                    "cloudflare", zone["id"], self.__cloudflare_fingerprint(cf, zone)
+                )
+                and self.__reuse_zone(
+                    "cloudflare", "public_records_cloudflare", zone["name"]
+                )
+            ):
+                continue
+            stale.append(zone)
+        logging.info("Fetching %i of %i Cloudflare zones" % (len(stale), len(zones)))
+        self.__fetch_cloudflare_zones(cf, stale)
+
+    def __worth_probing(self, zone):
+        """
+        A fingerprint probe costs a request, as much as fetching a zone whose
+        records fit on one page, so only zones that took more pages last
+        time are probed; the rest are simply fetched
+        """
+        if self.previous is None:
+            return False
+        fingerprint = self.previous.zone_fingerprints.get("cloudflare", {}).get(
+            zone["id"]
+        )
+        if fingerprint is None:
+            return False
+        return int(fingerprint.rpartition("/")[2]) > CF_RECORDS_PER_PAGE
+
+    def __cloudflare(self):
+        """
+        One client, built once per monitor, means one pooled HTTP session
+        shared by every worker and every run
+        """
+        if self.__cf is None:
+            import CloudFlare
+
+            self.__cf = CloudFlare.CloudFlare(
+                email=self.env["CF_API_EMAIL"],
+                token=self.env["CF_API_KEY"],
+                raw=True,
+                use_sessions=True,
+            )
+        return self.__cf
+
+    def __list_cloudflare_zones(self, cf):
+        zones = list(
+            self.__cloudflare_pages(
+                cf.zones.get, per_page=CF_ZONES_PER_PAGE  # pylint: disable=E1101
+            )
         )
-        zones = cf.zones.get()  # pylint: disable=E1101
         for zone in zones:
             self.public_zones.add(zone["name"])
             self.public_zones_cloudflare.add(zone["name"])
-            self.__get_cloudflare_records(cf, zone)
-
-    def __get_cloudflare_records(self, cf, zone, private=False):
-        for record in cf.zones.dns_records.get(zone["id"]):
-            self.save_cloudflare_record(
-                zone=zone["name"],
-                dnsname=record["name"],
-                target=record["content"],
-                ttl=record["ttl"],
-                dnstype=record["type"],
-                private=private,
+            self.provider_zones["cloudflare"][zone["id"]] = zone
+        return zones
+
+    def __fetch_cloudflare_zones(self, cf, zones):
+        """
+        Pull the records of every zone through a bounded worker pool, saving
+        them on this thread as each zone completes
+        """
+        workers = int(self.env.get("CF_ZONE_CONCURRENCY", DEFAULT_CF_ZONE_CONCURRENCY))
+        workers = max(1, workers)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            fetch = lambda zone: self.__get_cloudflare_records(cf, zone)
+            for zone, records in completed(pool, fetch, zones, 2 * workers):
+                if self.fingerprinting:
+                    # The same fingerprint a probe would give, for next run
+                    self.zone_fingerprints["cloudflare"][zone["id"]] = "%s/%s" % (
+                        zone["modified_on"],
+                        len(records),
+                    )
+                self.metrics.count("zones", provider="cloudflare", source="fetched")
+                self.metrics.count(
+                    "records", len(records), provider="cloudflare", source="fetched"
+                )
+                for record in records:
+                    self.save_cloudflare_record(
+                        zone=zone["name"],
+                        dnsname=record["name"],
+                        target=record["content"],
+                        ttl=record["ttl"],
+                        dnstype=record["type"],
+                    )
+                self.__zone_done("public_records_cloudflare", zone["name"])
+
+    def __cloudflare_pages(self, call, *args, per_page):
+        """Yield every result of a raw Cloudflare listing, following all pages"""
+        page = 1
+        operation = "list_dns_records" if args else "list_zones"
+        while True:
+            response = self.__cloudflare_call(
+                operation, call, *args, params={"page": page, "per_page": per_page}
+            )
+            for item in response["result"]:
+                yield item
+            info = response.get("result_info") or {}
+            if page >= info.get("total_pages", page):
+                break
+            page += 1
+
+    def __cloudflare_call(self, operation, call, *args, **kwargs):
+        self.metrics.count("api_calls", service="cloudflare", operation=operation)
+        try:
+            return self.scheduler.call(
+                "cloudflare",
+                self.env["CF_API_EMAIL"],
+                call,
+                *args,
+                metrics=self.metrics,
+                **kwargs
+            )
+        except Exception as e:
+            if is_throttle("cloudflare", e):
+                self.metrics.count(
+                    "api_throttles", service="cloudflare", operation=operation
+                )
+            self.metrics.count("api_errors", service="cloudflare", operation=operation)
+            raise
+
+    def __cloudflare_fingerprint(self, cf, zone):
+        """
+        The zone's modified_on only moves with zone settings, and the API
+        cannot sort records by modification time, so pair it with the record
+        count from a one-page probe.
+        """
+        probe = self.__cloudflare_call(
+            "list_dns_records",
+            cf.zones.dns_records.get,
+            zone["id"],
+            params={"per_page": 5},
+        )
+        return "%s/%s" % (zone["modified_on"], probe["result_info"]["total_count"])
+
+    def __get_cloudflare_records(self, cf, zone):
+        return list(
+            self.__cloudflare_pages(
+                cf.zones.dns_records.get, zone["id"], per_page=CF_RECORDS_PER_PAGE
             )
+        )
 
     def __fetch_aws(self, records):
         """
-        Connect to AWS Route53 via their API and scrape data 
+        Connect to AWS Route53 via their API and scrape data
         This autodetects credentials from the environment or ~/.aws
         """
-        # List zones
-        r53 = boto3.client(
-            "route53",
-            aws_access_key_id=self.env["AWS_ACCESS_KEY_ID"],
-            aws_secret_access_key=self.env["AWS_SECRET_ACCESS_KEY"],
-            aws_session_token=self.env["AWS_SESSION_TOKEN"],
-        )
-        lhz = r53.list_hosted_zones()
+        r53 = self.__route53()
+        zones = self.__list_aws_zones(r53)
+        self.__fetch_aws_zones(r53, zones)
+
+    def __aws_configured(self):
+        return "AWS_ACCESS_KEY_ID" in self.env or "AWS_ROLE_ARN" in self.env
+
+    def __route53_account(self):
+        """Whose Route53 quota requests count against"""
+        return self.env.get("AWS_ROLE_ARN") or self.env["AWS_ACCESS_KEY_ID"]
+
+    def __route53(self):
+        """
+        Route53 client, built once and kept for the life of the monitor.
+        With AWS_ROLE_ARN its credentials are assumed, and assumed again
+        before they expire, so a long-running daemon keeps working.
+        """
+        if self.__r53 is None and self.env.get("AWS_ROLE_ARN"):
+            from .accounts import role_session
+
+            self.__r53 = role_session(self.env).client("route53")
+        if self.__r53 is None:
+            import boto3
+
+            self.__r53 = boto3.client(
+                "route53",
+                aws_access_key_id=self.env["AWS_ACCESS_KEY_ID"],
+                aws_secret_access_key=self.env["AWS_SECRET_ACCESS_KEY"],
+                aws_session_token=self.env.get("AWS_SESSION_TOKEN"),
+            )
+        return self.__r53
+
+    def __list_aws_zones(self, r53):
+        zones = []
+        for page in self.__route53_pages(
+            "ListHostedZones", r53.list_hosted_zones, ROUTE53_ZONE_PAGING
+        ):
+            zones.extend(page["HostedZones"])
         # Split into public and private
-        for zone in lhz["HostedZones"]:
+        for zone in zones:
             name = zone["Name"].rstrip(".")
             if zone["Config"]["PrivateZone"]:
                 self.private_zones.add(name)
                 self.private_zones_aws.add(name)
-                self.__get_aws_records(r53, zone["Id"], name, private=True)
             else:
                 self.public_zones.add(name)
                 self.public_zones_aws.add(name)
-                self.__get_aws_records(r53, zone["Id"], name, private=False)
+            self.provider_zones["aws"][zone["Id"]] = zone
+        return zones
+
+    def __aws_fingerprint(self, zone):
+        return "%s/%s" % (zone["ResourceRecordSetCount"], zone["CallerReference"])
+
+    def __fetch_aws_zones(self, r53, zones):
+        """
+        Pull the record sets of every zone whose fingerprint changed. Hosted
+        zones sharing a name share its record list, so the name is only
+        reused when every one of them is unchanged.
+        """
+        unchanged = {}
+        for zone in zones:
+            location = self.zone_location("aws", zone)
+            same = self.__unchanged("aws", zone["Id"], self.__aws_fingerprint(zone))
+            unchanged[location] = unchanged.get(location, True) and same
+        if self.previous is not None:
+            # A deleted hosted zone's records may be part of a name that is
+            # still listed, and which name is not known: fetch them all
+            listed = {zone["Id"] for zone in zones}
+            if set(self.previous.zone_fingerprints.get("aws", {})) - listed:
+                unchanged = dict.fromkeys(unchanged, False)
+        reused = {
+            location
+            for location, same in unchanged.items()
+            if same and self.__reuse_zone("aws", *location)
+        }
+        stale = [
+            zone for zone in zones if self.zone_location("aws", zone) not in reused
+        ]
+        logging.info("Fetching %i of %i Route53 zones" % (len(stale), len(zones)))
+        self.__pull_aws_zones(r53, stale)
+
+    def __pull_aws_zones(self, r53, stale):
+        """
+        Pull the record sets of zones through a bounded worker pool.
+        Workers only talk to the API; records are parsed and saved on this
+        thread so the sorted collections are never touched concurrently.
+        """
+        workers = int(
+            self.env.get("AWS_ZONE_CONCURRENCY", DEFAULT_AWS_ZONE_CONCURRENCY)
+        )
+        # Hosted zones can share a name; such a zone is done with its last
+        pending = {}
+        for zone in stale:
+            location = self.zone_location("aws", zone)
+            pending[location] = pending.get(location, 0) + 1
+        workers = max(1, workers)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            fetch = lambda zone: self.__get_aws_records(r53, zone["Id"])
+            for zone, records in completed(pool, fetch, stale, 2 * workers):
+                self.metrics.count("zones", provider="aws", source="fetched")
+                self.metrics.count(
+                    "records", len(records), provider="aws", source="fetched"
+                )
+                name = zone["Name"].rstrip(".")
+                private = zone["Config"]["PrivateZone"]
+                for record in records:
+                    self.__parse_aws_record(name, record, private)
+                location = self.zone_location("aws", zone)
+                pending[location] -= 1
+                if not pending[location]:
+                    self.__zone_done(*location)
 
-    def __get_aws_records(self, r53, zone, zonename, private=False):
-        paginator = r53.get_paginator("list_resource_record_sets")
-        page_iterator = paginator.paginate(HostedZoneId=zone)
-        for page in page_iterator:
-            for record in page["ResourceRecordSets"]:
-                self.__parse_aws_record(zonename, record, private)
+    def __get_aws_records(self, r53, zone):
+        records = []
+        for page in self.__route53_pages(
+            "ListResourceRecordSets",
+            r53.list_resource_record_sets,
+            ROUTE53_RECORD_PAGING,
+            HostedZoneId=zone,
+        ):
+            records.extend(page["ResourceRecordSets"])
+        return records
+
+    def __route53_pages(self, operation, call, paging, **params):
+        """
+        Yield every page of a Route53 listing. Pages are requested one by
+        one rather than through a boto3 paginator so each is scheduled
+        within the account's quota, and a throttled page is retried alone.
+        """
+        while True:
+            try:
+                page = self.scheduler.call(
+                    "route53",
+                    self.__route53_account(),
+                    call,
+                    metrics=self.metrics,
+                    **params
+                )
+            except Exception as e:
+                count_aws_error(self.metrics, "route53", operation, e)
+                raise
+            count_aws_call(self.metrics, "route53", operation, page)
+            yield page
+            if not page.get("IsTruncated"):
+                break
+            params = dict(params)
+            for param, field in paging:
+                params.pop(param, None)
+                if page.get(field):
+                    params[param] = page[field]
 
     def __parse_aws_record(self, zone, record, private=False):
         ttl = ""
@@ -222,6 +1105,7 @@ class DNSMonitor:
                 ttl=ttl,
                 dnstype=record["Type"],
                 private=private,
+                set_identifier=record.get("SetIdentifier"),
             )
         elif "ResourceRecords" in record:
             for x in record["ResourceRecords"]:
@@ -232,13 +1116,25 @@ class DNSMonitor:
                     ttl=ttl,
                     dnstype=record["Type"],
                     private=private,
+                    set_identifier=record.get("SetIdentifier"),
                 )
         else:
             raise InvalidDNSRecord(zone, record)
 
     # ##########################################################################
-    def save_aws_record(self, zone, dnsname, dnstype, target, ttl="", private=False):
+    def save_aws_record(
+        self,
+        zone,
+        dnsname,
+        dnstype,
+        target,
+        ttl="",
+        private=False,
+        set_identifier=None,
+    ):
         dnsentry = "%s %s IN %s %s" % (dnsname, ttl, dnstype, target)
+        if set_identifier is not None:
+            dnsentry += SET_IDENTIFIER + set_identifier
         if private:
             self.__save_private_records_aws(zone, dnsentry)
         else:
@@ -254,17 +1150,18 @@ class DNSMonitor:
         else:
             self.__save_public_records_cloudflare(zone, dnsentry)
 
+    # Records are appended as collected; sort_records orders them afterwards
     def __save_private_records_aws(self, zone, dnsentry):
         if zone not in self.private_records_aws:
-            self.private_records_aws[zone] = SortedList()
-        self.private_records_aws[zone].add(dnsentry)
+            self.private_records_aws[zone] = []
+        self.private_records_aws[zone].append(dnsentry)
 
     def __save_public_records_aws(self, zone, dnsentry):
         if zone not in self.public_records_aws:
-            self.public_records_aws[zone] = SortedList()
-        self.public_records_aws[zone].add(dnsentry)
+            self.public_records_aws[zone] = []
+        self.public_records_aws[zone].append(dnsentry)
 
     def __save_public_records_cloudflare(self, zone, dnsentry):
         if zone not in self.public_records_cloudflare:
-            self.public_records_cloudflare[zone] = SortedList()
-        self.public_records_cloudflare[zone].add(dnsentry)
+            self.public_records_cloudflare[zone] = []
+        self.public_records_cloudflare[zone].append(dnsentry)
@@ -2,51 +2,79 @@ import sys
 
 sys.path.insert(0, "..")
 
-import json
-from difflib import unified_diff
-import uuid
-from .to_slack import To_Slack
-from .to_sumologic import To_Sumologic
+from .whois_parser import diff_whois_records, LOOKUP_FAIL
+from .record_diff import diff_sorted, record_key
+from .change import Change
+from .state_file import RECORD_COLLECTIONS
 import os
+import logging
+
+RECORD_SERVICES = {
+    "public_records_aws": "AWS DNS Record Change (Public) - %s",
+    "public_records_cloudflare": "Cloudflare DNS Record Change (Public) - %s",
+    "private_records_aws": "AWS DNS Record Change (Private) - %s",
+}
 
 
 class DNSMonitor_diff:
-    def __init__(self, new, old, env=os.environ):
+    def __init__(
+        self,
+        new,
+        old,
+        env=os.environ,
+        account=None,
+        pipeline=None,
+        retain=True,
+        metrics=None,
+    ):
+        """
+        With a SinkPipeline, every change is also emitted to it as soon as
+        it is found; retain=False then keeps none of them in self.changes.
+        Metrics are recorded into metrics, by default the new monitor's.
+        """
         self.new = new
         self.old = old
         self.changes = []
         self.env = env
-
-    def log_change(self, service, diff, old, new):
-        """Update log"""
-        # Generate a random ID to make searching for log changes easier
-        changeid = str(uuid.uuid4())
-        cdict = {
-            "id": changeid,
-            "service": service,
-            "diff": diff,
-            "oldstate": old,
-            "newstate": new,
-        }
-        self.changes.append(json.dumps(cdict))
+        self.account = account
+        self.pipeline = pipeline
+        self.retain = retain or pipeline is None
+        self.zones_examined = 0
+        self.zones_skipped = 0
+        self.metrics = metrics if metrics is not None else new.metrics
+
+    def log_change(self, service, diff, old, new, old_hash=None, new_hash=None):
+        """
+        Update log. The change references old and new rather than copying
+        or serializing them; each sink serializes it as it sends.
+        """
+        if self.account is not None:
+            service = "[%s] %s" % (self.account, service)
+        change = Change(service, diff, old, new, old_hash, new_hash)
+        self.metrics.count("changes", stage="found")
+        if self.retain:
+            self.changes.append(change)
+        if self.pipeline is not None:
+            self.pipeline.emit(change)
 
     def run(self):
         """Compare the old and new, and display differences"""
-        self.diff_zones()
-        self.diff_whois()
-        self.diff_records()
-
-    def diff(self, service, old, new):
-        mydiff = []
-        for line in unified_diff(
-            new, old, fromfile="%s - before" % service, tofile="%s - after" % service
-        ):
-            if not line.startswith(
-                (" ", "@@", "+++", "---", "->>>", "+>>>", "+% WHOIS", "-% WHOIS")
-            ):
-                mydiff.append(line.rstrip())
-        if mydiff:
-            self.log_change(service, "\n".join(mydiff), old, new)
+        with self.metrics.timed("diff"):
+            self.diff_zones()
+            self.diff_whois()
+            self.diff_records()
+            self.diff_served()
+
+    def diff(self, service, old, new, key=record_key, old_hash=None, new_hash=None):
+        """
+        Diff two sorted lists and log a change if they differ. key pairs
+        removed and added entries into modifications; None disables that.
+        """
+        result = diff_sorted(old, new, key)
+        if result:
+            self.log_change(
+                service, "\n".join(result.render()), old, new, old_hash, new_hash
+            )
 
     def diff_zones(self):
         self.diff_public_zones_aws()
@@ -59,14 +87,16 @@ class DNSMonitor_diff:
                 "Public Zone created/deleted in AWS",
                 list(self.old.public_zones_aws),
                 list(self.new.public_zones_aws),
+                key=None,
             )
 
     def diff_public_zones_cloudflare(self):
         if self.new.public_zones_cloudflare != self.old.public_zones_cloudflare:
             self.diff(
                 "Public Zone created/deleted in Cloudflare",
-                list(self.old.publipublic_zones_cloudflarec_zones),
+                list(self.old.public_zones_cloudflare),
                 list(self.new.public_zones_cloudflare),
+                key=None,
             )
 
     def diff_private_zones_aws(self):
@@ -75,78 +105,125 @@ class DNSMonitor_diff:
                 "Private Zone created/deleted in AWS",
                 list(self.old.private_zones_aws),
                 list(self.new.private_zones_aws),
+                key=None,
             )
 
     def diff_whois(self):
         service = "WHOIS - %s"
         for domain, whois in self.new.whois.items():
-            if whois != self.old.whois[domain]:
-                if whois == "LOOKUP FAIL" or self.old.whois[domain] == "LOOKUP FAIL":
-                    pass
-                else:
+            old = self.old.whois.get(domain)
+            if old is None or whois == old:
+                continue
+            if whois == LOOKUP_FAIL or old == LOOKUP_FAIL:
+                continue
+            mydiff = diff_whois_records(old, whois)
+            if mydiff:
+                self.log_change(service % domain, "\n".join(mydiff), old, whois)
+
+    def diff_served(self):
+        """
+        Report served DNS mismatches as they appear (+) and clear (-), so a
+        mismatch alerts once rather than on every run
+        """
+        new = self.new.served_mismatches
+        if new is None:
+            return
+        old = getattr(self.old, "served_mismatches", None) or {}
+        for collection in sorted(set(old) | set(new)):
+            old_zones = old.get(collection, {})
+            new_zones = new.get(collection, {})
+            for domain in sorted(set(old_zones) | set(new_zones)):
+                old_lines = old_zones.get(domain, [])
+                new_lines = new_zones.get(domain, [])
+                if old_lines != new_lines:
                     self.diff(
-                        service % domain,
-                        whois.split("\n"),
-                        self.old.whois[domain].split("\n"),
+                        "Served DNS mismatch - %s" % domain,
+                        old_lines,
+                        new_lines,
+                        key=None,
                     )
 
     def diff_records(self):
         self.diff_public_records_aws()
         self.diff_public_records_cloudflare()
         self.diff_private_records_aws()
+        self.__count_zones()
 
     def diff_public_records_aws(self):
-        service = "AWS DNS Record Change (Public) - %s"
-        # Account for deleted domain
-        for domain, _ in self.old.public_records_aws.items():
-            if domain not in self.new.public_records_aws:
-                self.new.public_records_aws[domain] = []
-        for domain, records in self.new.public_records_aws.items():
-            # Account for new domain
-            if domain not in self.old.public_records_aws:
-                self.old.public_records_aws[domain] = []
-            # Account for changed/added/removed entries
-            if domain != self.old.public_records_aws[domain]:
-                self.diff(
-                    service % domain,
-                    list(records),
-                    list(self.old.public_records_aws[domain]),
-                )
+        self.diff_record_collection("public_records_aws")
 
     def diff_public_records_cloudflare(self):
-        service = "Cloudflare DNS Record Change (Public) - %s"
-        # Account for deleted domain
-        for domain, _ in self.old.public_records_cloudflare.items():
-            if domain not in self.new.public_records_cloudflare:
-                self.new.public_records_cloudflare[domain] = []
-        for domain, records in self.new.public_records_cloudflare.items():
-            if domain not in self.old.public_records_cloudflare:
-                self.old.public_records_cloudflare[domain] = []
-            if domain != self.old.public_records_cloudflare[domain]:
-                self.diff(
-                    service % domain,
-                    list(records),
-                    list(self.old.public_records_cloudflare[domain]),
-                )
+        self.diff_record_collection("public_records_cloudflare")
 
     def diff_private_records_aws(self):
-        service = "AWS DNS Record Change (Private) - %s"
-        # Account for deleted domain
-        for domain, _ in self.old.private_records_aws.items():
-            if domain not in self.new.private_records_aws:
-                self.new.private_records_aws[domain] = []
-        for domain, records in self.new.private_records_aws.items():
-            if domain not in self.old.private_records_aws:
-                self.old.private_records_aws[domain] = []
-            if domain != self.old.private_records_aws[domain]:
-                self.diff(
-                    service % domain,
-                    list(records),
-                    list(self.old.private_records_aws[domain]),
-                )
+        self.diff_record_collection("private_records_aws")
+
+    def diff_record_collection(self, collection, service=None):
+        """
+        Diff every zone that was added, deleted or changed. Zones whose
+        content hash matches on both sides are skipped without touching
+        their records.
+        """
+        old_zones = getattr(self.old, collection)
+        new_zones = getattr(self.new, collection)
+        new_hashes = self.new.zone_hashes.get(collection, {})
+        for domain in sorted(set(old_zones) | set(new_zones)):
+            self.diff_zone(
+                collection,
+                domain,
+                new_zones.get(domain, []),
+                new_hashes.get(domain),
+                service,
+            )
 
+    def diff_zone(self, collection, domain, records, new_hash=None, service=None):
+        """Diff one zone's new records against the old snapshot's"""
+        old_hash = self.old.zone_hashes.get(collection, {}).get(domain)
+        if old_hash is not None and old_hash == new_hash:
+            self.zones_skipped += 1
+            return
+        self.zones_examined += 1
+        # The zones' own sorted lists, not copies
+        self.diff(
+            (service or RECORD_SERVICES[collection]) % domain,
+            getattr(self.old, collection).get(domain, []),
+            records,
+            old_hash=old_hash,
+            new_hash=new_hash,
+        )
+
+    def diff_streamed(self, seen):
+        """
+        After zones were diffed one by one with diff_zone, diff the zone
+        lists and whois, and report old zones that were not seen (keyed by
+        collection) as deleted
+        """
+        with self.metrics.timed("diff"):
+            self.diff_zones()
+            self.diff_whois()
+            for collection in RECORD_COLLECTIONS:
+                done = seen.get(collection, ())
+                for domain in sorted(getattr(self.old, collection)):
+                    if domain not in done:
+                        self.diff_zone(collection, domain, [])
+            self.diff_served()
+        self.__count_zones()
+
+    def __count_zones(self):
+        logging.info(
+            "Diffed %i zones, skipped %i unchanged"
+            % (self.zones_examined, self.zones_skipped)
+        )
+        self.metrics.count("zones", self.zones_examined, source="diffed")
+        self.metrics.count("zones", self.zones_skipped, source="unchanged")
+
+    # Sinks pull in requests, so they are only imported when configured
     def to_slack(self):
+        from .to_slack import To_Slack
+
         To_Slack(self.changes, env=self.env)
 
     def to_sumologic(self):
+        from .to_sumologic import To_Sumologic
+
         To_Sumologic(self.changes, env=self.env)
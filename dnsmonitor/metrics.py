@@ -0,0 +1,206 @@
+"""
+Per-run metrics: phase timings, API calls, retries, bytes and volumes
+
+A Metrics registry collects counters and timers, each with labels such as
+the phase, service or provider, and is shared by an account's monitors,
+diff and sink pipeline. At the end of a run publish_metrics writes every
+registry out as CloudWatch Embedded Metric Format lines on stdout (turned
+into CloudWatch metrics straight from the Lambda's logs) and/or as a
+Prometheus text exposition, per METRICS_FORMAT. CloudWatch sums EMF lines
+as separate samples, so they carry what was added since the previous
+publish, while Prometheus counters stay cumulative.
+
+    phase_seconds      time spent per phase: aws, cloudflare, whois,
+                       verify, sort, diff, s3_save, s3_load, file_save,
+                       file_load, per sink, and rate_limit, the time
+                       requests waited for their quota
+    api_calls          provider, storage and sink requests
+    api_retries        retried requests, including those retried by boto3
+    api_throttles      requests answered with a throttling response
+    api_errors         requests that failed for good
+    breaker_rejections requests failed fast by an open circuit breaker
+    bytes              bytes moved, by service and direction
+    zones, records     volumes fetched, reused, diffed and skipped
+    changes            changes found and sent
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_NAMESPACE = "DNSMonitor"
+PROMETHEUS_PREFIX = "dnsmonitor_"
+TIMERS = ("phase_seconds",)
+UNITS = {"phase_seconds": "Seconds", "bytes": "Bytes"}
+
+
+class Metrics:
+    def __init__(self, labels=None):
+        """labels are added to every metric, e.g. {"account": "prod"}"""
+        self.labels = dict(labels or {})
+        self.lock = threading.Lock()
+        # (name, sorted label items) -> value, or [sum, count] for timers
+        self.values = {}
+        # The values as of the last delta(), which accounts publishing at
+        # the same time take in turns
+        self.published = {}
+        self.published_lock = threading.Lock()
+
+    def __key(self, name, labels):
+        merged = dict(self.labels)
+        merged.update((k, str(v)) for k, v in labels.items())
+        return name, tuple(sorted(merged.items()))
+
+    def count(self, name, value=1, **labels):
+        key = self.__key(name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = self.__key(name, labels)
+        with self.lock:
+            total = self.values.setdefault(key, [0.0, 0])
+            total[0] += seconds
+            total[1] += 1
+
+    @contextmanager
+    def timed(self, phase, **labels):
+        """Add the time spent in the block to phase_seconds{phase=...}"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(
+                "phase_seconds", time.monotonic() - start, phase=phase, **labels
+            )
+
+    def get(self, name, **labels):
+        """The current value of one metric; the total seconds for timers"""
+        key = self.__key(name, labels)
+        with self.lock:
+            value = self.values.get(key, 0)
+        return value[0] if isinstance(value, list) else value
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                key: list(value) if isinstance(value, list) else value
+                for key, value in self.values.items()
+            }
+
+    def delta(self):
+        """
+        What was added to each metric since the last delta(), leaving out
+        metrics that did not move
+        """
+        with self.published_lock:
+            current = self.snapshot()
+            delta = {}
+            for key, value in current.items():
+                last = self.published.get(key)
+                if isinstance(value, list):
+                    last = last or [0.0, 0]
+                    if value[1] != last[1]:
+                        delta[key] = [value[0] - last[0], value[1] - last[1]]
+                elif value != (last or 0):
+                    delta[key] = value - (last or 0)
+            self.published = current
+        return delta
+
+    def to_emf(self, namespace=DEFAULT_NAMESPACE, timestamp=None, values=None):
+        """
+        One EMF JSON line per distinct set of labels, of values (such as a
+        delta()) or else of the current totals
+        """
+        if values is None:
+            values = self.snapshot()
+        groups = {}
+        for (name, labels), value in sorted(values.items()):
+            if isinstance(value, list):
+                value = value[0]
+            groups.setdefault(labels, {})[name] = value
+        timestamp = int((timestamp or time.time()) * 1000)
+        lines = []
+        for labels, values in groups.items():
+            metrics = [
+                {"Name": name, "Unit": UNITS.get(name, "Count")} for name in values
+            ]
+            line = {
+                "_aws": {
+                    "Timestamp": timestamp,
+                    "CloudWatchMetrics": [
+                        {
+                            "Namespace": namespace,
+                            "Dimensions": [[k for k, _ in labels]],
+                            "Metrics": metrics,
+                        }
+                    ],
+                }
+            }
+            line.update(labels)
+            line.update(values)
+            lines.append(json.dumps(line, sort_keys=True))
+        return lines
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def to_prometheus(registries):
+    """Text exposition of the metrics of every registry"""
+    samples = {}
+    for registry in registries:
+        for (name, labels), value in registry.snapshot().items():
+            samples.setdefault(name, []).append((labels, value))
+    out = []
+    for name in sorted(samples):
+        metric = PROMETHEUS_PREFIX + name
+        if name in TIMERS:
+            out.append("# TYPE %s summary" % metric)
+        else:
+            metric += "_total"
+            out.append("# TYPE %s counter" % metric)
+        for labels, value in sorted(samples[name]):
+            text = ",".join('%s="%s"' % (k, _escape(v)) for k, v in labels)
+            text = "{%s}" % text if text else ""
+            if isinstance(value, list):
+                out.append("%s_sum%s %s" % (metric, text, repr(float(value[0]))))
+                out.append("%s_count%s %i" % (metric, text, value[1]))
+            else:
+                out.append("%s%s %s" % (metric, text, value))
+    return "\n".join(out) + "\n"
+
+
+# Account threads publish one at a time, so their writes do not interleave
+_publish_lock = threading.Lock()
+
+
+def publish_metrics(registries, env=os.environ):
+    """
+    Write out registries as METRICS_FORMAT asks: emf prints EMF lines of
+    what changed since the last publish to stdout, prometheus writes the
+    totals to METRICS_PROMETHEUS_FILE (atomically, for a node_exporter
+    textfile collector) or prints them to stdout
+    """
+    with _publish_lock:
+        formats = [f.strip() for f in env.get("METRICS_FORMAT", "").split(",")]
+        if "emf" in formats:
+            namespace = env.get("METRICS_NAMESPACE", DEFAULT_NAMESPACE)
+            for registry in registries:
+                for line in registry.to_emf(namespace, values=registry.delta()):
+                    sys.stdout.write(line + "\n")
+            sys.stdout.flush()
+        if "prometheus" in formats:
+            text = to_prometheus(registries)
+            path = env.get("METRICS_PROMETHEUS_FILE")
+            if path:
+                with open(path + ".tmp", "w") as fh:
+                    fh.write(text)
+                os.replace(path + ".tmp", path)
+            else:
+                sys.stdout.write(text)
+                sys.stdout.flush()
@@ -0,0 +1,110 @@
+"""
+Linear diff of sorted record collections
+
+Zones are kept sorted, so old and new can be compared with a single merge
+walk instead of difflib's sequence matching. Records that disappear and
+appear under the same name and type are reported as one modification (a
+TTL or value change) rather than a removal plus an addition.
+"""
+
+# Route53 record sets with a routing policy (weighted, latency, failover,
+# geolocation, multivalue) end in their set identifier, which keeps each set
+# apart from the others of the same name and type
+SET_IDENTIFIER = " ; set-identifier "
+
+
+def record_key(entry):
+    """(name, type) of a "name ttl IN type value" entry"""
+    name, _, rest = entry.partition(" ")
+    _, _, rest = rest.partition(" IN ")
+    return name, rest.partition(" ")[0]
+
+
+def split_record(entry):
+    """Split a "name ttl IN type value" entry into its four fields"""
+    name, _, rest = entry.partition(" ")
+    ttl, _, rest = rest.partition(" IN ")
+    dnstype, _, value = rest.partition(" ")
+    return name, ttl, dnstype, value
+
+
+class RecordDiff:
+    __slots__ = ("added", "removed", "modified")
+
+    def __init__(self, added, removed, modified):
+        self.added = added
+        self.removed = removed
+        self.modified = modified
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.modified)
+
+    def render(self):
+        """Text lines: -removed, +added, ~name ttl IN type value -> ttl value"""
+        lines = ["-%s" % entry for entry in self.removed]
+        lines.extend("+%s" % entry for entry in self.added)
+        for old, new in self.modified:
+            name, old_ttl, dnstype, old_value = split_record(old)
+            _, new_ttl, _, new_value = split_record(new)
+            lines.append(
+                "~%s %s IN %s %s -> %s %s"
+                % (name, old_ttl, dnstype, old_value, new_ttl, new_value)
+            )
+        return lines
+
+
+def _distinct(entries, start):
+    """The entries of a sorted list from start on, each only once"""
+    return [
+        entries[k]
+        for k in range(start, len(entries))
+        if k == 0 or entries[k] != entries[k - 1]
+    ]
+
+
+def diff_sorted(old, new, key=record_key):
+    """
+    Compare two sorted lists in one pass. When key is given, removed and
+    added entries sharing a key are paired up as modifications.
+    """
+    added = []
+    removed = []
+    i = j = 0
+    n_old = len(old)
+    n_new = len(new)
+    while i < n_old and j < n_new:
+        a = old[i]
+        b = new[j]
+        if a == b:
+            i += 1
+            j += 1
+        elif a < b:
+            removed.append(a)
+            i += 1
+        else:
+            added.append(b)
+            j += 1
+        # Collapse duplicates so each distinct entry is compared once
+        while i < n_old and i > 0 and old[i] == old[i - 1]:
+            i += 1
+        while j < n_new and j > 0 and new[j] == new[j - 1]:
+            j += 1
+    removed.extend(_distinct(old, i))
+    added.extend(_distinct(new, j))
+    if key is None or not (added and removed):
+        return RecordDiff(added, removed, [])
+
+    removed_by_key = {}
+    for entry in reversed(removed):
+        removed_by_key.setdefault(key(entry), []).append(entry)
+    modified = []
+    still_added = []
+    for entry in added:
+        candidates = removed_by_key.get(key(entry))
+        if candidates:
+            modified.append((candidates.pop(), entry))
+        else:
+            still_added.append(entry)
+    paired = {old_entry for old_entry, _ in modified}
+    still_removed = [entry for entry in removed if entry not in paired]
+    return RecordDiff(still_added, still_removed, modified)
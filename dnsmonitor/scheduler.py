@@ -0,0 +1,319 @@
+"""
+Quota-aware scheduling of provider requests
+
+Every Route53, Cloudflare and whois request goes through one process-wide
+RequestScheduler, so parallel zone fetches, accounts and lookups share the
+providers' quotas instead of each running into them:
+
+    token buckets     one per host (a Route53 or Cloudflare account, a whois
+                      server) and optionally one per provider across all
+                      hosts; a request waits for a token from both
+    adaptive backoff  a throttled request halves its host's rate and is
+                      retried after a jittered exponential backoff; every
+                      success wins back a little of the configured rate
+    circuit breakers  after a run of failures a host's requests fail fast
+                      for a while, then one trial request is let through
+
+Rates are in requests per second and are read from the environment of the
+first monitor that asks for the scheduler (see shared_scheduler).
+"""
+
+import random
+import socket
+import threading
+import time
+
+# Requests per second per host, and across all hosts of a provider
+DEFAULT_HOST_RATES = {"route53": 5.0, "cloudflare": 4.0, "whois": 10.0}
+DEFAULT_PROVIDER_RATES = {"whois": 50.0}
+HOST_RATE_VARIABLES = {
+    "route53": "ROUTE53_REQUESTS_PER_SECOND",
+    "cloudflare": "CF_REQUESTS_PER_SECOND",
+    "whois": "WHOIS_REQUESTS_PER_SECOND",
+}
+PROVIDER_RATE_VARIABLES = {"whois": "WHOIS_TOTAL_REQUESTS_PER_SECOND"}
+DEFAULT_THROTTLE_RETRIES = 3
+DEFAULT_BREAKER_FAILURES = 5
+DEFAULT_BREAKER_SECONDS = 60
+# A throttled host never drops below this fraction of its configured rate
+MIN_RATE_FRACTION = 1 / 16.0
+RECOVERY_FRACTION = 0.05
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 20.0
+
+THROTTLE_CODES = (
+    "Throttling",
+    "ThrottlingException",
+    "SlowDown",
+    "RequestLimitExceeded",
+    "PriorRequestNotComplete",
+)
+# HTTP 429, and "Please wait and consider throttling your request speed"
+CLOUDFLARE_THROTTLE_CODES = (429, 971)
+
+
+class CircuitOpenError(ConnectionError):
+    pass
+
+
+def is_throttle(provider, error):
+    """Whether error means the provider wants us to slow down"""
+    if provider == "cloudflare":
+        # CloudFlareAPIError converts to the HTTP status, or to Cloudflare's
+        # own error code when the response had a JSON body
+        try:
+            return int(error) in CLOUDFLARE_THROTTLE_CODES
+        except (TypeError, ValueError):
+            return False
+    if provider == "whois":
+        # Whois servers do not answer heavy clients, they drop or ignore them
+        import asyncio
+
+        return isinstance(
+            error, (asyncio.TimeoutError, socket.timeout, ConnectionResetError)
+        )
+    code = getattr(error, "response", {}).get("Error", {}).get("Code")
+    return code in THROTTLE_CODES
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=None, clock=time.monotonic):
+        self.max_rate = float(rate)
+        self.rate = self.max_rate
+        self.burst = burst if burst is not None else max(1.0, self.max_rate)
+        self.tokens = self.burst
+        self.clock = clock
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Take a token and return how many seconds to wait before using it.
+        Tokens may go negative: each caller then waits its turn in line.
+        """
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def throttled(self):
+        with self.lock:
+            self.rate = max(self.max_rate * MIN_RATE_FRACTION, self.rate / 2)
+            # Spend the burst so the next requests are paced at the new rate
+            self.tokens = min(self.tokens, 0.0)
+
+    def succeeded(self):
+        if self.rate < self.max_rate:
+            with self.lock:
+                self.rate = min(
+                    self.max_rate, self.rate + self.max_rate * RECOVERY_FRACTION
+                )
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        failures=DEFAULT_BREAKER_FAILURES,
+        seconds=DEFAULT_BREAKER_SECONDS,
+        clock=time.monotonic,
+    ):
+        self.threshold = failures
+        self.seconds = seconds
+        self.clock = clock
+        self.failures = 0
+        self.opened = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """False while open; once it has cooled down, let one trial through"""
+        with self.lock:
+            if self.opened is None:
+                return True
+            if self.clock() - self.opened < self.seconds:
+                return False
+            # Half open: hold the others back until the trial reports back
+            self.opened = self.clock()
+            return True
+
+    def succeeded(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+
+    def failed(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened = self.clock()
+
+
+class RequestScheduler:
+    def __init__(
+        self,
+        host_rates=None,
+        provider_rates=None,
+        retries=DEFAULT_THROTTLE_RETRIES,
+        breaker_failures=DEFAULT_BREAKER_FAILURES,
+        breaker_seconds=DEFAULT_BREAKER_SECONDS,
+    ):
+        """
+        host_rates and provider_rates map a provider to requests per second;
+        a provider without a rate is not limited at that level
+        """
+        self.host_rates = dict(DEFAULT_HOST_RATES)
+        self.host_rates.update(host_rates or {})
+        self.provider_rates = dict(DEFAULT_PROVIDER_RATES)
+        self.provider_rates.update(provider_rates or {})
+        self.retries = retries
+        self.breaker_failures = breaker_failures
+        self.breaker_seconds = breaker_seconds
+        self.buckets = {}
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, env):
+        host_rates = {
+            provider: float(env[name])
+            for provider, name in HOST_RATE_VARIABLES.items()
+            if env.get(name)
+        }
+        provider_rates = {
+            provider: float(env[name])
+            for provider, name in PROVIDER_RATE_VARIABLES.items()
+            if env.get(name)
+        }
+        return cls(
+            host_rates,
+            provider_rates,
+            retries=int(
+                env.get("SCHEDULER_THROTTLE_RETRIES", DEFAULT_THROTTLE_RETRIES)
+            ),
+            breaker_failures=int(
+                env.get("SCHEDULER_BREAKER_FAILURES", DEFAULT_BREAKER_FAILURES)
+            ),
+            breaker_seconds=float(
+                env.get("SCHEDULER_BREAKER_SECONDS", DEFAULT_BREAKER_SECONDS)
+            ),
+        )
+
+    def __buckets(self, provider, host):
+        buckets = []
+        with self.lock:
+            for key, rate in (
+                ((provider, None), self.provider_rates.get(provider)),
+                ((provider, host), self.host_rates.get(provider)),
+            ):
+                # A rate of 0 turns the limit off
+                if not rate:
+                    continue
+                if key not in self.buckets:
+                    self.buckets[key] = TokenBucket(rate)
+                buckets.append(self.buckets[key])
+        return buckets
+
+    def breaker(self, provider, host):
+        with self.lock:
+            if (provider, host) not in self.breakers:
+                self.breakers[provider, host] = CircuitBreaker(
+                    self.breaker_failures, self.breaker_seconds
+                )
+            return self.breakers[provider, host]
+
+    def __admit(self, provider, host, metrics):
+        """Return the seconds to wait before sending, or raise if open"""
+        if not self.breaker(provider, host).allow():
+            if metrics is not None:
+                metrics.count("breaker_rejections", service=provider)
+            raise CircuitOpenError("Too many failures from %s %s" % (provider, host))
+        return max(
+            [bucket.reserve() for bucket in self.__buckets(provider, host)] + [0]
+        )
+
+    def __failed(self, provider, host, error, attempt, metrics):
+        """Return the seconds to back off before retrying, or None to give up"""
+        if is_throttle(provider, error) and attempt < self.retries:
+            # Only this host slows down; the others may well have quota left
+            for bucket in self.__buckets(provider, host)[-1:]:
+                bucket.throttled()
+            if metrics is not None:
+                metrics.count("api_retries", service=provider, reason="throttle")
+            return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2**attempt))
+        self.breaker(provider, host).failed()
+        return None
+
+    def __succeeded(self, provider, host):
+        for bucket in self.__buckets(provider, host):
+            bucket.succeeded()
+        self.breaker(provider, host).succeeded()
+
+    def __waited(self, provider, seconds, metrics):
+        if metrics is not None and seconds:
+            metrics.observe(
+                "phase_seconds", seconds, phase="rate_limit", service=provider
+            )
+
+    def call(self, provider, host, fn, *args, metrics=None, **kwargs):
+        """
+        fn(*args, **kwargs) within the quota of host at provider, retrying
+        it when throttled
+        """
+        attempt = 0
+        while True:
+            delay = self.__admit(provider, host, metrics)
+            if delay:
+                self.__waited(provider, delay, metrics)
+                time.sleep(delay)
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                backoff = self.__failed(provider, host, e, attempt, metrics)
+                if backoff is None:
+                    raise
+                time.sleep(backoff)
+                attempt += 1
+                continue
+            self.__succeeded(provider, host)
+            return result
+
+    async def call_async(self, provider, host, fn, *args, metrics=None, **kwargs):
+        """call for a coroutine function, waiting without blocking the loop"""
+        import asyncio
+
+        attempt = 0
+        while True:
+            delay = self.__admit(provider, host, metrics)
+            if delay:
+                self.__waited(provider, delay, metrics)
+                await asyncio.sleep(delay)
+            try:
+                result = await fn(*args, **kwargs)
+            except Exception as e:
+                backoff = self.__failed(provider, host, e, attempt, metrics)
+                if backoff is None:
+                    raise
+                await asyncio.sleep(backoff)
+                attempt += 1
+                continue
+            self.__succeeded(provider, host)
+            return result
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def shared_scheduler(env):
+    """
+    The process-wide scheduler, configured from env on first use, so every
+    monitor, account and daemon poll draws from the same buckets
+    """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = RequestScheduler.from_env(env)
+        return _scheduler
@@ -0,0 +1,123 @@
+"""
+Concurrent delivery of changes to the configured sinks
+
+Every sink gets its own bounded queue and worker thread. The diff emits
+each change as it is found, and each worker sends whatever has queued up
+since its last send as one batch, so a slow sink simply batches more and
+the others keep draining at their own pace. The diff only waits when a
+sink falls a whole queue behind.
+"""
+
+import logging
+import os
+import queue
+import threading
+
+from .metrics import Metrics
+
+DEFAULT_QUEUE_SIZE = 1000
+# Running totals every sink keeps, recorded as metrics after each send
+SINK_COUNTERS = (
+    ("posts", "api_calls"),
+    ("retries", "api_retries"),
+    ("throttles", "api_throttles"),
+    ("failures", "api_errors"),
+)
+
+_DONE = object()
+
+
+def configured_sinks(env=os.environ):
+    """An instance of every sink whose environment variable is set"""
+    sinks = []
+    if env.get("SUMO_HTTP_ENDPOINT") is not None:
+        from .to_sumologic import To_Sumologic
+
+        sinks.append(To_Sumologic([], env=env))
+    if env.get("SLACK_WEBHOOK") is not None:
+        from .to_slack import To_Slack
+
+        sinks.append(To_Slack([], env=env))
+    return sinks
+
+
+class SinkPipeline:
+    def __init__(self, sinks, maxsize=DEFAULT_QUEUE_SIZE, metrics=None):
+        self.sinks = sinks
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.queues = []
+        self.workers = []
+        for sink in sinks:
+            q = queue.Queue(maxsize)
+            worker = threading.Thread(
+                target=self.__drain,
+                args=(sink, q),
+                name="sink-%s" % type(sink).__name__,
+                daemon=True,
+            )
+            worker.start()
+            self.queues.append(q)
+            self.workers.append(worker)
+
+    @classmethod
+    def from_env(cls, env=os.environ, metrics=None):
+        return cls(
+            configured_sinks(env),
+            maxsize=int(env.get("SINK_QUEUE_SIZE", DEFAULT_QUEUE_SIZE)),
+            metrics=metrics,
+        )
+
+    def emit(self, change):
+        for q in self.queues:
+            q.put(change)
+
+    def close(self):
+        """Wait for every sink to send everything emitted so far"""
+        for q in self.queues:
+            q.put(_DONE)
+        for worker in self.workers:
+            worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __drain(self, sink, q):
+        done = False
+        while not done:
+            batch = [q.get()]
+            while True:
+                try:
+                    batch.append(q.get_nowait())
+                except queue.Empty:
+                    break
+            if batch[-1] is _DONE:
+                batch.pop()
+                done = True
+            if not batch:
+                continue
+            service = type(sink).__name__.replace("To_", "").lower()
+            before = {attr: getattr(sink, attr, 0) for attr, _ in SINK_COUNTERS}
+            before["bytes_sent"] = getattr(sink, "bytes_sent", 0)
+            try:
+                with self.metrics.timed("sink", service=service):
+                    sink.send(batch)
+            except Exception:
+                logging.exception(
+                    "Sending %i changes to %s failed"
+                    % (len(batch), type(sink).__name__)
+                )
+                self.metrics.count(
+                    "changes", len(batch), stage="failed", service=service
+                )
+            else:
+                self.metrics.count("changes", len(batch), stage="sent", service=service)
+            for attr, name in SINK_COUNTERS:
+                delta = getattr(sink, attr, 0) - before[attr]
+                if delta:
+                    self.metrics.count(name, delta, service=service)
+            sent = getattr(sink, "bytes_sent", 0) - before["bytes_sent"]
+            if sent:
+                self.metrics.count("bytes", sent, service=service, direction="out")
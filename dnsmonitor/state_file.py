@@ -0,0 +1,212 @@
+"""
+Indexed, compressed state file
+
+Layout, written zone by zone by StateWriter:
+
+    MAGIC_APPEND
+    zlib compressed blocks
+    zlib compressed JSON index
+    8 byte big-endian length of the compressed index
+
+Files written before zones could be streamed put the index up front:
+
+    MAGIC
+    8 byte big-endian length of the compressed index
+    zlib compressed JSON index
+    zlib compressed blocks
+
+In both, the index holds the (offset, length) of the metadata block (zones, whois,
+fingerprints, ...) and of one block per zone in each record collection,
+relative to the start of the blocks. Reading maps the file and only
+decompresses a zone's block the first time its records are accessed.
+
+Convert an existing JSON state with:
+
+    python3 -m dnsmonitor.state_file dnsmonitor.json dnsmonitor.state
+"""
+
+from collections.abc import MutableMapping
+import json
+import mmap
+import os
+import struct
+import sys
+import zlib
+
+from sortedcontainers import SortedDict, SortedSet
+
+MAGIC = b"DNSMSTATE1\n"
+MAGIC_APPEND = b"DNSMSTATE2\n"
+MAGICS = (MAGIC, MAGIC_APPEND)
+HEADER = struct.Struct(">Q")
+RECORD_COLLECTIONS = (
+    "public_records_aws",
+    "public_records_cloudflare",
+    "private_records_aws",
+)
+
+
+class MissingZoneError(LookupError):
+    """A zone is listed in the state but its records cannot be found"""
+
+
+class LazyZones(MutableMapping):
+    """Zone -> records mapping that loads each zone's records on first access"""
+
+    def __init__(self, zones, loader):
+        self._loader = loader
+        self._pending = SortedSet(zones)
+        self._loaded = SortedDict()
+
+    def __getitem__(self, zone):
+        if zone in self._loaded:
+            return self._loaded[zone]
+        if zone not in self._pending:
+            raise KeyError(zone)
+        try:
+            records = self._loader(zone)
+        except KeyError as e:
+            # Not a KeyError, so .get() cannot mistake it for an absent zone
+            raise MissingZoneError("Records of zone %s are missing: %s" % (zone, e))
+        records = sorted(set(records))
+        self._pending.discard(zone)
+        self._loaded[zone] = records
+        return records
+
+    def __setitem__(self, zone, records):
+        self._pending.discard(zone)
+        self._loaded[zone] = records
+
+    def __delitem__(self, zone):
+        if zone in self._pending:
+            self._pending.discard(zone)
+        else:
+            del self._loaded[zone]
+
+    def __contains__(self, zone):
+        return zone in self._loaded or zone in self._pending
+
+    def __iter__(self):
+        return iter(SortedSet(self._loaded.keys()) | self._pending)
+
+    def __len__(self):
+        return len(self._loaded) + len(self._pending)
+
+    def is_loaded(self, zone):
+        return zone in self._loaded
+
+    def release(self, zone):
+        """Drop a loaded zone's records; they are loaded again if accessed"""
+        if zone in self._loaded:
+            del self._loaded[zone]
+            self._pending.add(zone)
+
+
+def is_state_file(filename):
+    with open(filename, "rb") as fh:
+        return fh.read(len(MAGIC)) in MAGICS
+
+
+def _block(obj, encoder):
+    return zlib.compress(json.dumps(obj, cls=encoder).encode())
+
+
+class StateWriter:
+    """
+    Write an indexed state one zone at a time, to a filename or a binary
+    file object, so only the zone being added has to be in memory. A file
+    is written beside the target and moved over it when closed, so a state
+    being read from the same file stays intact.
+    """
+
+    def __init__(self, target, encoder=json.JSONEncoder):
+        self.encoder = encoder
+        self.target = target if isinstance(target, str) else None
+        if self.target is not None:
+            self.fh = open(self.target + ".tmp", "wb")
+        else:
+            self.fh = target
+        self.offset = 0
+        self.index = {"zones": {collection: {} for collection in RECORD_COLLECTIONS}}
+        self.fh.write(MAGIC_APPEND)
+
+    def _add(self, obj):
+        block = _block(obj, self.encoder)
+        self.fh.write(block)
+        self.offset += len(block)
+        return [self.offset - len(block), len(block)]
+
+    def add_zone(self, collection, zone, records):
+        self.index["zones"][collection][zone] = self._add(records)
+
+    def close(self, data):
+        """Finish with the metadata of a DNSMonitor.save() dict"""
+        meta = {k: v for k, v in data.items() if k not in RECORD_COLLECTIONS}
+        self.index["meta"] = self._add(meta)
+        compressed_index = zlib.compress(json.dumps(self.index).encode())
+        self.fh.write(compressed_index)
+        self.fh.write(HEADER.pack(len(compressed_index)))
+        if self.target is not None:
+            self.fh.close()
+            os.replace(self.target + ".tmp", self.target)
+
+
+def write_state(data, target, encoder=json.JSONEncoder):
+    """
+    Write a DNSMonitor.save() dict in the indexed format to target, either a
+    filename or a binary file object
+    """
+    writer = StateWriter(target, encoder)
+    for collection in RECORD_COLLECTIONS:
+        zones = data.get(collection, {})
+        for zone in zones:
+            writer.add_zone(collection, zone, zones[zone])
+    writer.close(data)
+
+
+def read_state(source):
+    """
+    Read an indexed state and return a dict shaped like DNSMonitor.save(),
+    with LazyZones for the record collections. source is either a filename,
+    which is memory-mapped, or the state's bytes.
+    """
+    if isinstance(source, str):
+        with open(source, "rb") as fh:
+            mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    else:
+        mm = memoryview(source)
+    if mm[: len(MAGIC)] == MAGIC_APPEND:
+        index_end = len(mm) - HEADER.size
+        (index_length,) = HEADER.unpack_from(mm, index_end)
+        index_start = index_end - index_length
+        base = len(MAGIC_APPEND)
+    elif mm[: len(MAGIC)] == MAGIC:
+        (index_length,) = HEADER.unpack_from(mm, len(MAGIC))
+        index_start = len(MAGIC) + HEADER.size
+        base = index_start + index_length
+    else:
+        raise ValueError("Not an indexed state file")
+    index = json.loads(zlib.decompress(mm[index_start : index_start + index_length]))
+
+    def read_block(location):
+        offset, length = location
+        return json.loads(zlib.decompress(mm[base + offset : base + offset + length]))
+
+    data = read_block(index["meta"])
+    for collection in RECORD_COLLECTIONS:
+        locations = index["zones"].get(collection, {})
+        data[collection] = LazyZones(
+            locations, lambda zone, l=locations: read_block(l[zone])
+        )
+    return data
+
+
+def convert(src, dst):
+    """Convert a JSON state file to the indexed format"""
+    with open(src, "r") as fh:
+        data = json.load(fh)
+    write_state(data, dst)
+
+
+if __name__ == "__main__":
+    convert(sys.argv[1], sys.argv[2])
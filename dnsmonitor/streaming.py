@@ -0,0 +1,36 @@
+"""
+Collect, diff and save one zone at a time
+
+DNSMonitor.run(on_zone=...) hands over each zone as soon as its records are
+complete. Here every such zone is diffed against the old snapshot, written
+to the new state and dropped, so peak memory is bounded by the largest
+zone rather than two full copies of every record. The old snapshot should
+come from an indexed state file or STATE_STORAGE=zones, whose zones load on
+access and are released again once diffed; a JSON state is loaded whole.
+"""
+
+from .state_file import LazyZones
+
+
+def stream_scan(new, writer, old=None, differ=None, whois=True):
+    """
+    Run new zone by zone into writer (a state_file.StateWriter or a begun
+    ZoneStore), diffing each zone against old with differ when given
+    """
+    seen = {}
+
+    def on_zone(collection, name, records, digest):
+        seen.setdefault(collection, set()).add(name)
+        if differ is not None:
+            differ.diff_zone(collection, name, records, digest)
+        writer.add_zone(collection, name, records)
+        if old is not None:
+            old_zones = getattr(old, collection)
+            if isinstance(old_zones, LazyZones):
+                old_zones.release(name)
+
+    new.run(whois=whois, previous=old, on_zone=on_zone)
+    if differ is not None:
+        differ.diff_streamed(seen)
+    writer.close(new.save())
+    return seen
@@ -4,33 +4,144 @@ sys.path.insert(0, "..")
 
 import os
 from datetime import datetime
+import logging
 import requests
+from requests.adapters import HTTPAdapter
 import json
+import time
 from urllib.parse import quote
 
+# Slack renders long messages poorly and cuts them off at 40k characters,
+# and webhooks accept about one message per second
+DEFAULT_MESSAGE_CHARS = 3500
+DEFAULT_MESSAGES_PER_SECOND = 1.0
+DEFAULT_MAX_RETRIES = 5
+
+# One pooled session per process, so every post reuses the same connection
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+
 
 class To_Slack:
     def __init__(self, changes, env=os.environ):
         self.changes = changes
         self.webhook = env["SLACK_WEBHOOK"]
+        self.max_chars = int(env.get("SLACK_MESSAGE_CHARS", DEFAULT_MESSAGE_CHARS))
+        self.interval = 1.0 / float(
+            env.get("SLACK_MESSAGES_PER_SECOND", DEFAULT_MESSAGES_PER_SECOND)
+        )
+        self.max_retries = int(env.get("SLACK_MAX_RETRIES", DEFAULT_MAX_RETRIES))
+        self.last_post = None
+        # Running totals, read by SinkPipeline for metrics
+        self.posts = 0
+        self.bytes_sent = 0
+        self.retries = 0
+        self.throttles = 0
+        self.failures = 0
         self.run()
 
     def run(self):
-        # Post messages
-        for c in self.changes:
-            c = json.loads(c)
+        self.send(self.changes)
+
+    def send(self, changes):
+        # Post messages, packing as many changes into each as fit
+        for msg in self.pack(self.blocks(changes)):
+            self.to_webhook(msg)
+
+    def blocks(self, changes):
+        """One or more message blocks per change, each within max_chars"""
+        for c in changes:
             url = "https://service.us2.sumologic.com/ui/index.html#section/search/@%i,%i@%s"
             start = int(datetime.now().strftime("%s")) - (5 * 60)
             end = int(datetime.now().strftime("%s")) + (30)
-            query = '_sourceHost="dnsmonitor" AND "%s"' % c["id"]
+            query = '_sourceHost="dnsmonitor" AND "%s"' % c.id
             q = quote(query)
             url = url % (start * 1000, end * 1000, q)
-            msg = "*%s*\n\n<%s|Full output in sumologic>\n```%s```" % (
-                c["service"],
-                url,
-                c["diff"],
-            )
-            self.to_webhook(msg)
+            link = "<%s|Full output in sumologic>" % url
+            # Leave room for the title, part counter and code fences
+            room = self.max_chars - len(c.service) - len(link) - 30
+            parts = self.split(c.diff, max(room, 100))
+            for i, part in enumerate(parts):
+                counter = " (%i/%i)" % (i + 1, len(parts)) if len(parts) > 1 else ""
+                yield "*%s%s*\n\n%s\n```%s```" % (c.service, counter, link, part)
+
+    def split(self, diff, size):
+        """Split a diff on line boundaries into chunks of at most size chars"""
+        chunks = []
+        current = []
+        length = 0
+        for line in diff.split("\n"):
+            while len(line) > size:
+                # A single line too long to fit is cut where it must be
+                if current:
+                    chunks.append("\n".join(current))
+                    current, length = [], 0
+                chunks.append(line[:size])
+                line = line[size:]
+            if current and length + len(line) + 1 > size:
+                chunks.append("\n".join(current))
+                current, length = [], 0
+            current.append(line)
+            length += len(line) + 1
+        if current:
+            chunks.append("\n".join(current))
+        return chunks
+
+    def pack(self, blocks):
+        """Join blocks into messages of at most max_chars"""
+        msg = ""
+        for block in blocks:
+            if msg and len(msg) + 2 + len(block) > self.max_chars:
+                yield msg
+                msg = ""
+            msg = msg + "\n\n" + block if msg else block
+        if msg:
+            yield msg
 
     def to_webhook(self, msg):
-        requests.post(self.webhook, data=json.dumps({"text": msg}))
+        """Post one message at the configured rate, retrying on throttling"""
+        data = json.dumps({"text": msg})
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self.retries += 1
+            self.pace()
+            try:
+                response = _session.post(self.webhook, data=data, timeout=30)
+            except requests.RequestException as e:
+                delay = 2**attempt
+                logging.warning("Slack post failed (%s), retrying in %is" % (e, delay))
+            else:
+                self.posts += 1
+                self.bytes_sent += len(data)
+                if response.status_code < 400:
+                    return
+                if response.status_code == 429:
+                    self.throttles += 1
+                    delay = float(response.headers.get("Retry-After", 2**attempt))
+                elif response.status_code >= 500:
+                    delay = 2**attempt
+                else:
+                    logging.error(
+                        "Slack rejected message: %i %s"
+                        % (response.status_code, response.text)
+                    )
+                    self.failures += 1
+                    return
+                logging.warning(
+                    "Slack returned %i, retrying in %.1fs"
+                    % (response.status_code, delay)
+                )
+            if attempt < self.max_retries:
+                time.sleep(delay)
+        logging.error("Giving up on Slack message after %i tries" % (attempt + 1))
+        self.failures += 1
+
+    def pace(self):
+        """Wait until at least interval seconds have passed since the last post"""
+        now = time.monotonic()
+        if self.last_post is not None:
+            wait = self.last_post + self.interval - now
+            if wait > 0:
+                time.sleep(wait)
+                now += wait
+        self.last_post = now
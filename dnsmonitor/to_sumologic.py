@@ -4,16 +4,39 @@ sys.path.insert(0, "..")
 
 import os
 from datetime import datetime
+import gzip
+import logging
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import calendar
+import time
 from time import gmtime, strftime
+from .change import DEFAULT_STATE_LIMIT
+
+# Sumo recommends keeping HTTP source requests to 100KB-1MB uncompressed
+DEFAULT_BATCH_BYTES = 1000000
+DEFAULT_MAX_RETRIES = 3
+
+# One pooled session per process, so every batch reuses the same connection
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
 
 
 class To_Sumologic:
     def __init__(self, changes, env=os.environ):
         self.changes = changes
         self.endpoint = env["SUMO_HTTP_ENDPOINT"]
+        self.batch_bytes = int(env.get("SUMO_BATCH_BYTES", DEFAULT_BATCH_BYTES))
+        self.max_retries = int(env.get("SUMO_MAX_RETRIES", DEFAULT_MAX_RETRIES))
+        self.state_mode = env.get("SUMO_STATE_MODE", "inline")
+        self.state_limit = int(env.get("SUMO_STATE_LIMIT", DEFAULT_STATE_LIMIT))
+        # Running totals, read by SinkPipeline for metrics
+        self.posts = 0
+        self.bytes_sent = 0
+        self.retries = 0
+        self.throttles = 0
+        self.failures = 0
         self.run()
 
     def getTimeStamp(self):
@@ -22,6 +45,59 @@ class To_Sumologic:
         return timeStamp
 
     def run(self):
-        for c in self.changes:
-            headers = {"Content-Type": "application/json", "Accept": "application/json"}
-            requests.post(self.endpoint, headers=headers, data=c)
+        self.send(self.changes)
+
+    def send(self, changes):
+        # Each change is one line of a newline-delimited batch
+        for batch in self.batches(changes):
+            self.post(gzip.compress(batch))
+
+    def batches(self, changes):
+        """Group changes into batches of at most batch_bytes, one per line"""
+        batch = []
+        size = 0
+        for c in changes:
+            line = c.to_json(self.state_mode, self.state_limit).encode("utf-8")
+            if batch and size + len(line) + 1 > self.batch_bytes:
+                yield b"\n".join(batch)
+                batch, size = [], 0
+            batch.append(line)
+            size += len(line) + 1
+        if batch:
+            yield b"\n".join(batch)
+
+    def post(self, body):
+        """Send one gzipped batch, retrying throttling and server errors"""
+        headers = {
+            "Content-Type": "application/json",
+            "Content-Encoding": "gzip",
+            "Accept": "application/json",
+        }
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self.retries += 1
+            try:
+                response = _session.post(
+                    self.endpoint, headers=headers, data=body, timeout=30
+                )
+            except requests.RequestException as e:
+                logging.warning("Sumo post failed: %s" % e)
+            else:
+                self.posts += 1
+                self.bytes_sent += len(body)
+                if response.status_code < 400:
+                    return
+                if response.status_code == 429:
+                    self.throttles += 1
+                elif response.status_code < 500:
+                    logging.error(
+                        "Sumo rejected batch: %i %s"
+                        % (response.status_code, response.text)
+                    )
+                    self.failures += 1
+                    return
+                logging.warning("Sumo returned %i" % response.status_code)
+            if attempt < self.max_retries:
+                time.sleep(2**attempt)
+        logging.error("Giving up on Sumo batch after %i tries" % (attempt + 1))
+        self.failures += 1
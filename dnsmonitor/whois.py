@@ -34,6 +34,7 @@ import sys
 import socket
 import optparse
 import locale
+import threading
 
 # import pdb
 
@@ -68,13 +69,25 @@ class NICClient(object):
 
     language, encoding = locale.getdefaultlocale()
 
-    def __init__(self):
+    # Process-wide memo shared by every client: TLD -> whois server
+    server_memo = {}
+    memo_lock = threading.Lock()
+
+    def __init__(self, port=43, scheduler=None):
+        """scheduler, a RequestScheduler, paces queries to each server"""
         self.use_qnichost = False
+        self.port = port
+        self.scheduler = scheduler
 
     def findwhois_server(self, buf, hostname):
         """Search the initial TLD lookup results for the regional-specifc
         whois server for getting contact details.
+
+        buf may be the raw response bytes, in which case only the matching
+        line is decoded rather than the whole response.
         """
+        if isinstance(buf, bytes):
+            return self._findwhois_server_bytes(buf, hostname)
         nhost = None
         parts_index = 1
         start = buf.find(NICClient.WHOIS_SERVER_ID)
@@ -94,31 +107,64 @@ class NICClient(object):
                     break
         return nhost
 
-    def whois(self, query, hostname, flags):
-        """Perform initial lookup with TLD whois server
-        then, if the quick flag is false, search that result 
-        for the region-specifc whois server and do a lookup
-        there for contact details
-        """
-        # pdb.set_trace()
+    def _findwhois_server_bytes(self, buf, hostname):
+        """findwhois_server over bytes, decoding only the referral line"""
+        nhost = None
+        parts_index = 1
+        start = buf.find(NICClient.WHOIS_SERVER_ID.encode())
+        if start == -1:
+            start = buf.find(NICClient.WHOIS_ORG_SERVER_ID.encode())
+            parts_index = 2
+
+        if start > -1:
+            end = buf.find(b"\n", start)
+            if end == -1:
+                end = len(buf)
+            whois_line = buf[start:end].decode(errors="replace")
+            nhost = whois_line.split(":")[parts_index].strip()
+        elif hostname == NICClient.ANICHOST:
+            for nichost in NICClient.ip_whois:
+                if buf.find(nichost.encode()) != -1:
+                    nhost = nichost
+                    break
+        return nhost
+
+    def _send_query(self, query, hostname):
+        """Send one query to a whois server and return the raw response"""
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         s.settimeout(5)
-        s.connect((hostname, 43))
+        s.connect((hostname, self.port))
         if hostname == NICClient.GERMNICHOST:
             s.send(("-T dn,ace -C US-ASCII " + query + "\r\n").encode())
         else:
             s.send((query + "\r\n").encode())
-        response = b""
+        # Collect chunks and join once; += on bytes copies the whole buffer
+        chunks = []
         while True:
-            d = s.recv(4096)
-            response += d
+            d = s.recv(65536)
             if not d:
                 break
+            chunks.append(d)
         s.close()
+        return b"".join(chunks)
+
+    def whois(self, query, hostname, flags):
+        """Perform initial lookup with TLD whois server
+        then, if the quick flag is false, search that result 
+        for the region-specifc whois server and do a lookup
+        there for contact details
+        """
+        # pdb.set_trace()
+        if self.scheduler is not None:
+            response = self.scheduler.call(
+                "whois", hostname, self._send_query, query, hostname
+            )
+        else:
+            response = self._send_query(query, hostname)
         # pdb.set_trace()
         nhost = None
         if flags & NICClient.WHOIS_RECURSE and nhost == None:
-            nhost = self.findwhois_server(response.decode(), hostname)
+            nhost = self.findwhois_server(response, hostname)
         if nhost != None:
             response += self.whois(query, nhost, 0)
         return response
@@ -131,6 +177,14 @@ class NICClient(object):
         if pos == -1:
             return None
         tld = domain[pos + 1 :]
+        server = NICClient.server_memo.get(tld)
+        if server is None:
+            server = self._choose_tld_server(tld)
+            with NICClient.memo_lock:
+                server = NICClient.server_memo.setdefault(tld, server)
+        return server
+
+    def _choose_tld_server(self, tld):
         if tld[0].isdigit():
             return NICClient.ANICHOST
         if tld == "plus":
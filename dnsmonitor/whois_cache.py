@@ -0,0 +1,77 @@
+"""
+Expiry-aware scheduling of whois refreshes
+
+Each domain remembers when its whois was last fetched and how long that
+answer is good for. Regular domains get a jittered TTL so refreshes spread
+out over runs instead of all coming due together, while domains close to
+expiring or whose last lookup failed are refreshed much sooner.
+"""
+
+from datetime import datetime, timezone
+import zlib
+
+from .whois_parser import LOOKUP_FAIL
+
+FAIL_TTL = 60 * 60
+NEAR_EXPIRY_TTL = 6 * 60 * 60
+DEFAULT_EXPIRY_WINDOW_DAYS = 30
+
+
+class WhoisCache:
+    def __init__(
+        self,
+        entries=None,
+        ttl=24 * 60 * 60,
+        expiry_window_days=DEFAULT_EXPIRY_WINDOW_DAYS,
+    ):
+        """entries maps domain to {"fetched": epoch seconds, "ttl": seconds}"""
+        self.entries = dict(entries or {})
+        self.ttl = ttl
+        self.expiry_window_days = expiry_window_days
+
+    def jittered_ttl(self, domain):
+        """Spread the base TTL by +/-25%, stable for a given domain"""
+        spread = (zlib.crc32(domain.encode()) % 1000) / 1000.0
+        return int(self.ttl * (0.75 + spread / 2))
+
+    def ttl_for(self, domain, record, now):
+        """record is a parsed whois record or LOOKUP_FAIL"""
+        if record == LOOKUP_FAIL:
+            return min(self.ttl, FAIL_TTL)
+        if record.get("expires"):
+            expiry = datetime.strptime(record["expires"], "%Y-%m-%d")
+            expiry = expiry.replace(tzinfo=timezone.utc)
+            days_left = (expiry.timestamp() - now) / 86400
+            if days_left <= self.expiry_window_days:
+                return min(self.ttl, NEAR_EXPIRY_TTL)
+        return self.jittered_ttl(domain)
+
+    def due(self, domains, cached, now, limit=0):
+        """
+        Return the domains that need a fresh lookup: those without a cached
+        value, then those past their TTL, most overdue first. A positive
+        limit caps how many are returned.
+        """
+        missing = []
+        overdue = []
+        for domain in domains:
+            entry = self.entries.get(domain)
+            if domain not in cached or entry is None:
+                missing.append(domain)
+            elif now >= entry["fetched"] + entry["ttl"]:
+                overdue.append((entry["fetched"] + entry["ttl"], domain))
+        overdue.sort()
+        due = missing + [domain for _, domain in overdue]
+        if limit > 0:
+            due = due[:limit]
+        return due
+
+    def update(self, domain, record, now):
+        self.entries[domain] = {
+            "fetched": int(now),
+            "ttl": self.ttl_for(domain, record, now),
+        }
+
+    def save(self, domains):
+        """Serialize the entries for domains still being monitored"""
+        return {d: self.entries[d] for d in sorted(domains) if d in self.entries}
@@ -0,0 +1,127 @@
+"""
+Normalize raw whois text into a compact record that can be diffed by field
+
+Only the fields we alert on are kept, so volatile lines such as the
+"last update of whois database" banner or registry boilerplate no longer
+show up as changes.
+"""
+
+import re
+from datetime import datetime
+
+LOOKUP_FAIL = "LOOKUP FAIL"
+
+SCALAR_FIELDS = ("registrar", "created", "updated", "expires", "dnssec")
+LIST_FIELDS = ("status", "nameservers")
+WHOIS_FIELDS = (
+    "registrar",
+    "status",
+    "nameservers",
+    "created",
+    "updated",
+    "expires",
+    "dnssec",
+)
+
+# Labels seen across the gTLD and common ccTLD registries, per field
+LABELS = {
+    "registrar": (
+        "Registrar",
+        "Sponsoring Registrar",
+        "Registrar Name",
+    ),
+    "status": ("Domain Status", "Status", "state"),
+    "nameservers": ("Name Server", "Nameserver", "nserver", "Name Servers"),
+    "created": (
+        "Creation Date",
+        "Created On",
+        "Created",
+        "Registered on",
+        "Registration Time",
+        "Domain Registration Date",
+    ),
+    "updated": ("Updated Date", "Last Updated On", "Last Modified", "last-update"),
+    "expires": (
+        "Registry Expiry Date",
+        "Registrar Registration Expiration Date",
+        "Expiration Date",
+        "Expiry Date",
+        "Expiration Time",
+        "Expires On",
+        "Expires",
+        "paid-till",
+        "expire",
+    ),
+    "dnssec": ("DNSSEC",),
+}
+DATE_FIELDS = ("created", "updated", "expires")
+DATE_FORMATS = ("%Y-%m-%d", "%d-%b-%Y", "%Y.%m.%d", "%Y/%m/%d", "%d.%m.%Y")
+
+LINE = re.compile(r"^[ \t]*([A-Za-z][A-Za-z \-/]*?)[ \t]*:[ \t]*(.*?)[ \t\r]*$", re.M)
+FIELD_FOR_LABEL = {
+    label.lower(): field for field, labels in LABELS.items() for label in labels
+}
+
+
+def parse_date(value):
+    """Normalize the date part of a whois timestamp to YYYY-MM-DD, or None"""
+    value = value.strip()
+    if not value:
+        return None
+    candidates = (value[:10], value[:11], value.split()[0])
+    for fmt in DATE_FORMATS:
+        for candidate in candidates:
+            try:
+                return datetime.strptime(candidate, fmt).strftime("%Y-%m-%d")
+            except ValueError:
+                continue
+    return None
+
+
+def parse_whois(text):
+    """
+    Parse raw whois text into a dict of the fields in WHOIS_FIELDS. The
+    first answer wins for single-valued fields; status codes and name
+    servers are merged across the registry and registrar answers.
+    """
+    record = {field: None for field in SCALAR_FIELDS}
+    lists = {field: set() for field in LIST_FIELDS}
+    for label, value in LINE.findall(text):
+        field = FIELD_FOR_LABEL.get(label.lower())
+        if field is None or not value:
+            continue
+        if field == "status":
+            # Drop the trailing ICANN explanation URL
+            lists[field].add(value.split()[0])
+        elif field == "nameservers":
+            lists[field].add(value.split()[0].lower().rstrip("."))
+        elif record[field] is None:
+            if field in DATE_FIELDS:
+                value = parse_date(value)
+            elif field == "dnssec":
+                value = value.lower()
+            record[field] = value
+    for field in LIST_FIELDS:
+        record[field] = sorted(lists[field])
+    return record
+
+
+def diff_whois_records(old, new):
+    """Return "-field: value"/"+field: value" lines for fields that changed"""
+    lines = []
+    for field in WHOIS_FIELDS:
+        before = old.get(field)
+        after = new.get(field)
+        if before == after:
+            continue
+        if field in LIST_FIELDS:
+            before = set(before or ())
+            after = set(after or ())
+            lines.extend("-%s: %s" % (field, v) for v in sorted(before - after))
+            lines.extend("+%s: %s" % (field, v) for v in sorted(after - before))
+        else:
+            if before is not None:
+                lines.append("-%s: %s" % (field, before))
+            if after is not None:
+                lines.append("+%s: %s" % (field, after))
+    return lines
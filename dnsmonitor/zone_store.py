@@ -0,0 +1,172 @@
+"""
+Content-addressed, per-zone state storage
+
+Instead of one monolithic object, the state is stored as:
+
+    <manifest key>                  manifest: metadata hash + zone -> hash
+    <manifest key>.zones/<sha256>   one compressed object per zone block
+
+Saving only uploads blocks whose hash is not already referenced by the
+current manifest, and loading only fetches a zone's block when its records
+are accessed. Blocks the new manifest no longer references are kept until the
+save after it, listed under "retained", so a state loaded before a save can
+still be read (e.g. diffed) after it; older ones are removed once the new
+manifest is written.
+"""
+
+import hashlib
+import json
+import os
+import zlib
+
+from .state_file import LazyZones, RECORD_COLLECTIONS
+
+
+class S3Backend:
+    def __init__(self, client, bucket):
+        self.client = client
+        self.bucket = bucket
+
+    def get(self, key):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=key)
+        except self.client.exceptions.NoSuchKey:
+            raise KeyError(key)
+        return response["Body"].read()
+
+    def put(self, key, body):
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=body)
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+
+class DirectoryBackend:
+    """Local directory standing in for an S3 bucket"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, key):
+        return os.path.join(self.root, *key.split("/"))
+
+    def get(self, key):
+        try:
+            with open(self._path(key), "rb") as fh:
+                return fh.read()
+        except FileNotFoundError:
+            raise KeyError(key)
+
+    def put(self, key, body):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as fh:
+            fh.write(body)
+
+    def delete(self, key):
+        os.remove(self._path(key))
+
+
+class ZoneStore:
+    def __init__(self, backend, manifest_key):
+        self.backend = backend
+        self.manifest_key = manifest_key
+        self.uploaded = 0
+        self.skipped = 0
+
+    def _block_key(self, digest):
+        return "%s.zones/%s" % (self.manifest_key, digest)
+
+    def _read_manifest(self):
+        try:
+            return json.loads(zlib.decompress(self.backend.get(self.manifest_key)))
+        except KeyError:
+            return None
+
+    def _hashes(self, manifest):
+        if manifest is None:
+            return set()
+        hashes = {manifest["meta"]}
+        for zones in manifest["zones"].values():
+            hashes.update(zones.values())
+        return hashes
+
+    def _retained(self, manifest):
+        if manifest is None:
+            return set()
+        return set(manifest.get("retained", ()))
+
+    def save(self, data, encoder=json.JSONEncoder):
+        """Store a DNSMonitor.save() dict, uploading only new zone blocks"""
+        self.begin(encoder)
+        for collection in RECORD_COLLECTIONS:
+            zones = data.get(collection, {})
+            for zone in zones:
+                self.add_zone(collection, zone, zones[zone])
+        return self.close(data)
+
+    def begin(self, encoder=json.JSONEncoder):
+        """Start saving zone by zone with add_zone, finished by close"""
+        try:
+            manifest = self._read_manifest()
+        except (zlib.error, ValueError):
+            # Switching over from a single-object state at the same key
+            manifest = None
+        # Blocks of the state being replaced, which may still be being read
+        self.previous = self._hashes(manifest)
+        self.current = self.previous | self._retained(manifest)
+        self.encoder = encoder
+        self.manifest = {"zones": {c: {} for c in RECORD_COLLECTIONS}}
+        self.uploaded = 0
+        self.skipped = 0
+
+    def _store(self, obj):
+        raw = json.dumps(obj, cls=self.encoder, sort_keys=True).encode()
+        digest = hashlib.sha256(raw).hexdigest()
+        if digest in self.current:
+            self.skipped += 1
+        else:
+            self.backend.put(self._block_key(digest), zlib.compress(raw))
+            self.current.add(digest)
+            self.uploaded += 1
+        return digest
+
+    def add_zone(self, collection, zone, records):
+        self.manifest["zones"][collection][zone] = self._store(records)
+
+    def close(self, data):
+        """
+        Store the metadata of a DNSMonitor.save() dict, then the manifest.
+        Blocks only the replaced manifest referenced are retained until the
+        next save; those retained by the save before are removed.
+        """
+        meta = {k: v for k, v in data.items() if k not in RECORD_COLLECTIONS}
+        manifest = self.manifest
+        manifest["meta"] = self._store(meta)
+        referenced = self._hashes(manifest)
+        manifest["retained"] = sorted(self.previous - referenced)
+        self.backend.put(
+            self.manifest_key, zlib.compress(json.dumps(manifest).encode())
+        )
+        for digest in self.current - referenced - self.previous:
+            self.backend.delete(self._block_key(digest))
+        return manifest
+
+    def load(self):
+        """
+        Return a dict shaped like DNSMonitor.save() whose record collections
+        fetch each zone's block only when it is accessed
+        """
+        manifest = self._read_manifest()
+        if manifest is None:
+            raise KeyError(self.manifest_key)
+        data = self._get_block(manifest["meta"])
+        for collection in RECORD_COLLECTIONS:
+            hashes = manifest["zones"].get(collection, {})
+            data[collection] = LazyZones(
+                hashes, lambda zone, h=hashes: self._get_block(h[zone])
+            )
+        return data
+
+    def _get_block(self, digest):
+        return json.loads(zlib.decompress(self.backend.get(self._block_key(digest))))
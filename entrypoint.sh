@@ -2,4 +2,4 @@
 set -eo pipefail
 
 # Run command
-python3 main.py
+python3 main.py "$@"
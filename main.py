@@ -1,23 +1,95 @@
 #!/usr/bin/env python3
 import dnsmonitor
-import json
 import os
+import signal
+import sys
+import threading
 from base64 import b64decode
-import boto3
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 
+# Plaintexts keyed by ciphertext, kept across warm lambda invocations
+_decrypted = {}
+
+
 def decrypt_environment(env=os.environ):
-    kms = boto3.client("kms")
-    for item in env.copy().keys():
-        if item.endswith("_ENC"):
-            print("Decrypting %s as %s:" % (item, item[:-4]))
-            env[item[:-4]] = kms.decrypt(CiphertextBlob=b64decode(env[item]))[
-                "Plaintext"
-            ].decode("utf-8")
+    """Decrypt every *_ENC variable, in parallel, into the unsuffixed name"""
+    items = [item for item in env if item.endswith("_ENC")]
+    pending = sorted({env[item] for item in items if env[item] not in _decrypted})
+    if pending:
+        import boto3
+
+        kms = boto3.client("kms")
+        decrypt = lambda ciphertext: kms.decrypt(CiphertextBlob=b64decode(ciphertext))[
+            "Plaintext"
+        ].decode("utf-8")
+        with ThreadPoolExecutor(max_workers=len(pending)) as pool:
+            for ciphertext, plaintext in zip(pending, pool.map(decrypt, pending)):
+                _decrypted[ciphertext] = plaintext
+    for item in items:
+        print("Decrypting %s as %s:" % (item, item[:-4]))
+        env[item[:-4]] = _decrypted[env[item]]
+
+
+def scan_lambda_account(name, account_env, env, metrics):
+    """Scan one account and diff it against its own state in S3"""
+    bucket = env["AWS_BUCKET_NAME"]
+    path = dnsmonitor.state_path(env["AWS_OBJECT_PATH"], name)
+
+    old = dnsmonitor.DNSMonitor(env=account_env, storage_env=env, metrics=metrics)
+    try:
+        old.load_from_s3(bucket, path)
+    except:
+        logging.error("Old dns file not found for lambda: %s" % path)
+        old = None
+
+    new = dnsmonitor.DNSMonitor(env=account_env, storage_env=env, metrics=metrics)
+
+    # Check for changes, shipping them out as they are found
+    with dnsmonitor.SinkPipeline.from_env(env, metrics=metrics) as pipeline:
+        differ = None
+        if old is not None:
+            differ = dnsmonitor.DNSMonitor_diff(
+                new=new, old=old, env=env, account=name, pipeline=pipeline, retain=False
+            )
+        if env.get("STREAM_ZONES"):
+            # Collect, diff and save one zone at a time
+            writer = new.s3_state_writer(bucket, path)
+            dnsmonitor.stream_scan(new, writer, old=old, differ=differ)
+        else:
+            new.run(previous=old)
+            # Diff first: old zones are still read lazily from the saved state
+            if differ is not None:
+                differ.run()
+            new.save_to_s3(bucket, path)
+
+
+def scan_accounts(env, scan):
+    """
+    Run scan(name, account_env, env, metrics) for every configured account
+    in parallel, then publish each account's metrics
+    """
+    accounts = dnsmonitor.load_accounts(env)
+    registries = [account_metrics(name) for name, _ in accounts]
+    with ThreadPoolExecutor(max_workers=len(accounts)) as pool:
+        futures = {
+            pool.submit(scan, name, account_env, env, metrics): name
+            for (name, account_env), metrics in zip(accounts, registries)
+        }
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception:
+                logging.exception("Scanning account %s failed" % futures[future])
+    dnsmonitor.publish_metrics(registries, env)
+
+
+def account_metrics(name):
+    return dnsmonitor.Metrics({"account": name} if name else None)
 
 
 def lambda_handler(event, context):
@@ -26,56 +98,133 @@ def lambda_handler(event, context):
     env = os.environ.copy()
     decrypt_environment(env)
 
-    new = dnsmonitor.DNSMonitor(env=env)
-    new.run()
-
-    old = dnsmonitor.DNSMonitor(env=env)
-    try:
-        old.load_from_s3(os.environ["AWS_BUCKET_NAME"], os.environ["AWS_OBJECT_PATH"])
-    except:
-        logging.error("Old dns file not found for lambda")
-        old = new
-
-    new.save_to_s3(os.environ["AWS_BUCKET_NAME"], os.environ["AWS_OBJECT_PATH"])
-
-    # Check for changes
-    differ = dnsmonitor.DNSMonitor_diff(new=new, old=old, env=env)
-    differ.run()
-
-    # Ship out the info!
-    if os.environ.get("SUMO_HTTP_ENDPOINT") is not None:
-        differ.to_sumologic()
-    if os.environ.get("SLACK_WEBHOOK") is not None:
-        differ.to_slack()
+    scan_accounts(env, scan_lambda_account)
 
     print("Lambda done!")
     return None
 
 
-def main():
-    new = dnsmonitor.DNSMonitor()
-    new.run()
-    old = dnsmonitor.DNSMonitor()
-    old.load_from_file("dnsmonitor.json")
-
-    # Check for changes
-    differ = dnsmonitor.DNSMonitor_diff(new=new, old=old)
-    differ.run()
+class PrintingPipeline:
+    """Prints every change as it is emitted, before passing it on"""
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+
+    def emit(self, change):
+        # Debug output
+        print(change.to_dict())
+        self.pipeline.emit(change)
+
+
+def scan_local_account(name, account_env, env, metrics):
+    """Scan one account and diff it against its own local state file"""
+    filename = dnsmonitor.state_path("dnsmonitor.json", name)
+    old = dnsmonitor.DNSMonitor(env=account_env, metrics=metrics)
+    old.load_from_file(filename)
+    new = dnsmonitor.DNSMonitor(env=account_env, metrics=metrics)
+    if os.path.dirname(filename):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+    # Check for changes, shipping them out as they are found
+    with dnsmonitor.SinkPipeline.from_env(env, metrics=metrics) as pipeline:
+        if env.get("STREAM_ZONES"):
+            # Collect, diff and save one zone at a time, keeping no changes
+            differ = dnsmonitor.DNSMonitor_diff(
+                new=new,
+                old=old,
+                env=env,
+                account=name,
+                pipeline=PrintingPipeline(pipeline),
+                retain=False,
+            )
+            writer = new.state_writer(filename)
+            dnsmonitor.stream_scan(new, writer, old=old, differ=differ)
+            return
+        differ = dnsmonitor.DNSMonitor_diff(
+            new=new, old=old, env=env, account=name, pipeline=pipeline
+        )
+        new.run(previous=old)
+        differ.run()
 
     # Debug output
     for change in differ.changes:
-        j = json.loads(change)
-        print(j)
-
-    # Ship out the info!
-    if os.environ.get("SUMO_HTTP_ENDPOINT") is not None:
-        differ.to_sumologic()
-    if os.environ.get("SLACK_WEBHOOK") is not None:
-        differ.to_slack()
+        print(change.to_dict())
 
     # Save this run
-    new.save_to_file("dnsmonitor.json")
+    new.save_to_file(filename)
+
+
+def main():
+    scan_accounts(os.environ, scan_local_account)
+
+
+def run_daemon_account(name, account_env, env, metrics, stop, publish):
+    """
+    Keep polling one account, saving to S3 if a bucket is set, else locally,
+    and publishing metrics after every save
+    """
+    if env.get("AWS_BUCKET_NAME"):
+        bucket = env["AWS_BUCKET_NAME"]
+        path = dnsmonitor.state_path(env["AWS_OBJECT_PATH"], name)
+        load = lambda monitor: monitor.load_from_s3(bucket, path)
+        store = lambda monitor: monitor.save_to_s3(bucket, path)
+    else:
+        filename = dnsmonitor.state_path("dnsmonitor.json", name)
+        if os.path.dirname(filename):
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+        load = lambda monitor: monitor.load_from_file(filename)
+        store = lambda monitor: monitor.save_to_file(filename)
+
+    def save(monitor):
+        store(monitor)
+        publish()
+
+    previous = dnsmonitor.DNSMonitor(env=account_env, storage_env=env, metrics=metrics)
+    try:
+        load(previous)
+    except Exception:
+        logging.error("No saved state for account %s, starting fresh" % name)
+        previous = None
+
+    # One pipeline for the daemon's life, so sinks keep their pacing state
+    with dnsmonitor.SinkPipeline.from_env(env, metrics=metrics) as pipeline:
+
+        def notify(differ):
+            for change in differ.changes:
+                pipeline.emit(change)
+
+        dnsmonitor.Daemon(
+            monitor=dnsmonitor.DNSMonitor(
+                env=account_env, storage_env=env, metrics=metrics
+            ),
+            save=save,
+            notify=notify,
+            previous=previous,
+            env=env,
+            account=name,
+            stop=stop,
+        ).run()
+
+
+def daemon():
+    env = os.environ.copy()
+    decrypt_environment(env)
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+    # Every account's metrics are published together, as one exposition
+    registries = []
+    publish = lambda: dnsmonitor.publish_metrics(list(registries), env)
+
+    def run(name, account_env, env, metrics):
+        registries.append(metrics)
+        run_daemon_account(name, account_env, env, metrics, stop, publish)
+
+    scan_accounts(env, run)
 
 
 if __name__ == "__main__":
-    main()
+    if sys.argv[1:] == ["daemon"]:
+        daemon()
+    else:
+        main()
@@ -0,0 +1,93 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "benchmarks"))
+
+from dns_standin import serve
+from dnsmonitor import DNSMonitor
+from dnsmonitor.dns_verify import AsyncDNSClient, verify_zones
+
+COLLECTION = "public_records_aws"
+NAMESERVERS = ["ns1.example.net.", "ns2.example.net."]
+RECORDS = [
+    "a.example.com. 300 IN A 192.0.2.1",
+    "example.com. 172800 IN NS ns1.example.net.",
+    "example.com. 172800 IN NS ns2.example.net.",
+    "gone.example.com. 300 IN A 192.0.2.2",
+    "mail.example.com. 300 IN MX 10 mx.example.com.",
+]
+# What the nameservers serve: a.example.com points elsewhere and
+# gone.example.com does not exist
+SERVED = [
+    "a.example.com. 300 IN A 192.0.2.9",
+    "example.com. 172800 IN NS ns1.example.net.",
+    "example.com. 172800 IN NS ns2.example.net.",
+    "mail.example.com. 300 IN MX 10 mx.example.com.",
+]
+MISMATCHES = [
+    "a.example.com. A @ns1.example.net expected 192.0.2.1 served 192.0.2.9",
+    "a.example.com. A @ns2.example.net expected 192.0.2.1 served 192.0.2.9",
+    "gone.example.com. A @ns1.example.net expected 192.0.2.2 served NXDOMAIN",
+    "gone.example.com. A @ns2.example.net expected 192.0.2.2 served NXDOMAIN",
+]
+
+
+class DNSVerifyTest(unittest.TestCase):
+    def server(self, records, **kwargs):
+        server = serve({"example.com": records}, **kwargs)
+        self.addCleanup(server.close)
+        return server
+
+    def verify(self, server, records=RECORDS, previous=None, **kwargs):
+        client = AsyncDNSClient(address=server.address, **kwargs)
+        zones = [("example.com", COLLECTION, records, NAMESERVERS)]
+        return verify_zones(zones, client, previous)
+
+    def test_mismatches_detected(self):
+        found = self.verify(self.server(SERVED))
+        self.assertEqual(found, {COLLECTION: {"example.com": MISMATCHES}})
+
+    def test_served_as_expected(self):
+        self.assertEqual(self.verify(self.server(RECORDS)), {})
+
+    def test_truncated_answer_retried_over_tcp(self):
+        records = RECORDS + [
+            "big.example.com. 300 IN A 10.0.%i.%i" % (i // 256, i % 256)
+            for i in range(400)
+        ]
+        server = self.server(records)
+        self.assertEqual(self.verify(server, records), {})
+        self.assertGreater(server.tcp_queries, 0)
+
+    def test_timeout_keeps_previous_mismatches(self):
+        server = self.server(SERVED, drop=1.0)
+        previous = {COLLECTION: {"example.com": MISMATCHES}}
+        found = self.verify(server, previous=previous, timeout=0.1, retries=0)
+        self.assertEqual(found, previous)
+        # Nothing to carry over, and nothing answered to report
+        self.assertEqual(self.verify(server, timeout=0.1, retries=0), {})
+
+    def test_monitor_clears_mismatch_only_when_answered(self):
+        def monitor(server):
+            m = DNSMonitor(
+                env={
+                    "DNS_VERIFY": "1",
+                    "DNS_VERIFY_SERVER": "%s:%i" % server.address,
+                    "DNS_VERIFY_TIMEOUT": "0.1",
+                    "DNS_VERIFY_RETRIES": "0",
+                }
+            )
+            m.served_mismatches = {COLLECTION: {"example.com": list(MISMATCHES)}}
+            return m
+
+        m = monitor(self.server(SERVED, drop=1.0))
+        m.verify_served([(COLLECTION, "example.com", RECORDS)])
+        self.assertEqual(m.served_mismatches[COLLECTION]["example.com"], MISMATCHES)
+        m = monitor(self.server(RECORDS))
+        m.verify_served([(COLLECTION, "example.com", RECORDS)])
+        self.assertNotIn("example.com", m.served_mismatches[COLLECTION])
+
+
+if __name__ == "__main__":
+    unittest.main()
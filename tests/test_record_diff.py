@@ -0,0 +1,88 @@
+import unittest
+
+from dnsmonitor.record_diff import diff_sorted, record_key, split_record
+
+A = "a.example.com. 300 IN A 192.0.2.1"
+A_TTL = "a.example.com. 60 IN A 192.0.2.1"
+A_VALUE = "a.example.com. 300 IN A 192.0.2.9"
+B = "b.example.com. 300 IN A 192.0.2.2"
+C = "c.example.com. 300 IN CNAME a.example.com."
+TXT = 'a.example.com. 300 IN TXT "v=spf1 -all"'
+
+
+class RecordDiffTest(unittest.TestCase):
+    def diff(self, old, new, **kwargs):
+        return diff_sorted(sorted(old), sorted(new), **kwargs)
+
+    def test_identical(self):
+        result = self.diff([A, B, C], [A, B, C])
+        self.assertFalse(result)
+        self.assertEqual(result.render(), [])
+
+    def test_added_and_removed(self):
+        result = self.diff([A, B], [A, C])
+        self.assertEqual(result.added, [C])
+        self.assertEqual(result.removed, [B])
+        self.assertEqual(result.modified, [])
+        self.assertEqual(result.render(), ["-" + B, "+" + C])
+
+    def test_ttl_modification(self):
+        result = self.diff([A, B], [A_TTL, B])
+        self.assertEqual((result.added, result.removed), ([], []))
+        self.assertEqual(result.modified, [(A, A_TTL)])
+        self.assertEqual(
+            result.render(),
+            ["~a.example.com. 300 IN A 192.0.2.1 -> 60 192.0.2.1"],
+        )
+
+    def test_value_modification(self):
+        result = self.diff([A, B], [A_VALUE, B])
+        self.assertEqual(result.modified, [(A, A_VALUE)])
+        self.assertEqual(
+            result.render(),
+            ["~a.example.com. 300 IN A 192.0.2.1 -> 300 192.0.2.9"],
+        )
+
+    def test_modification_needs_same_name_and_type(self):
+        # Same name, different type: a removal and an addition
+        result = self.diff([A], [TXT])
+        self.assertEqual((result.added, result.removed), ([TXT], [A]))
+        self.assertEqual(result.modified, [])
+
+    def test_unpaired_values_stay_added(self):
+        result = self.diff([A], [A_TTL, A_VALUE])
+        self.assertEqual(len(result.modified), 1)
+        self.assertEqual(len(result.added), 1)
+        self.assertEqual(result.removed, [])
+
+    def test_duplicates_compared_once(self):
+        self.assertFalse(self.diff([A, A, B], [A, B, B]))
+        result = self.diff([A, A, B, B], [B])
+        self.assertEqual(result.removed, [A])
+        result = self.diff([A], [A, C, C])
+        self.assertEqual(result.added, [C])
+
+    def test_zone_lists(self):
+        old = ["a.example.com", "b.example.com"]
+        new = ["b.example.com", "c.example.com"]
+        result = diff_sorted(old, new, key=None)
+        self.assertEqual(result.added, ["c.example.com"])
+        self.assertEqual(result.removed, ["a.example.com"])
+        self.assertEqual(result.modified, [])
+        self.assertEqual(result.render(), ["-a.example.com", "+c.example.com"])
+
+    def test_record_fields(self):
+        self.assertEqual(
+            split_record("mail.example.com. 300 IN MX 10 mx.example.com."),
+            ("mail.example.com.", "300", "MX", "10 mx.example.com."),
+        )
+        # Aliases have no TTL
+        self.assertEqual(
+            split_record("www.example.com.  IN A lb.example.net."),
+            ("www.example.com.", "", "A", "lb.example.net."),
+        )
+        self.assertEqual(record_key(TXT), ("a.example.com.", "TXT"))
+
+
+if __name__ == "__main__":
+    unittest.main()
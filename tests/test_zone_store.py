@@ -0,0 +1,105 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from dnsmonitor import DNSMonitor, DNSMonitor_diff
+from dnsmonitor.state_file import MissingZoneError
+from dnsmonitor.zone_store import DirectoryBackend, ZoneStore
+
+ENV = {}
+
+
+def monitor(zones):
+    """A DNSMonitor holding zones, a dict of zone -> list of (name, value)"""
+    m = DNSMonitor(env=ENV)
+    for zone, records in zones.items():
+        m.public_zones.add(zone)
+        m.public_zones_aws.add(zone)
+        for name, value in records:
+            m.save_aws_record(zone, name, "A", value, 300)
+    m.sort_records()
+    m.hash_zones()
+    return m
+
+
+OLD = {
+    "kept.example.com": [("www.kept.example.com.", "10.0.0.1")],
+    "changed.example.com": [
+        ("a.changed.example.com.", "10.0.1.1"),
+        ("b.changed.example.com.", "10.0.1.2"),
+    ],
+    "deleted.example.com": [("www.deleted.example.com.", "10.0.2.1")],
+}
+NEW = {
+    "kept.example.com": OLD["kept.example.com"],
+    "changed.example.com": [
+        ("a.changed.example.com.", "10.0.1.1"),
+        ("b.changed.example.com.", "10.0.1.3"),
+    ],
+}
+
+
+class ZoneStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.backend = DirectoryBackend(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def store(self):
+        return ZoneStore(self.backend, "state/dnsmonitor.json")
+
+    def records_changes(self, differ):
+        return {
+            change.service: change.diff
+            for change in differ.changes
+            if "Record Change" in change.service
+        }
+
+    def test_diff_after_save_sees_replaced_zones(self):
+        monitor(OLD).save_to_store(self.store())
+        old = DNSMonitor(env=ENV)
+        old.load_from_store(self.store())
+        new = monitor(NEW)
+        # Saving before diffing must not lose the old zones' blocks
+        new.save_to_store(self.store())
+        differ = DNSMonitor_diff(new=new, old=old, env=ENV)
+        differ.run()
+        changes = self.records_changes(differ)
+        self.assertEqual(
+            sorted(changes),
+            [
+                "AWS DNS Record Change (Public) - changed.example.com",
+                "AWS DNS Record Change (Public) - deleted.example.com",
+            ],
+        )
+        changed = changes["AWS DNS Record Change (Public) - changed.example.com"]
+        self.assertNotIn("a.changed.example.com", changed)
+        self.assertIn("10.0.1.3", changed)
+        deleted = changes["AWS DNS Record Change (Public) - deleted.example.com"]
+        self.assertTrue(deleted.startswith("-"))
+
+    def test_retained_blocks_removed_by_next_save(self):
+        monitor(OLD).save_to_store(self.store())
+        monitor(NEW).save_to_store(self.store())
+        self.assertTrue(self.store()._read_manifest()["retained"])
+        store = self.store()
+        monitor(NEW).save_to_store(store)
+        manifest = store.manifest
+        self.assertEqual(manifest["retained"], [])
+        blocks = os.listdir(self.backend._path("state/dnsmonitor.json.zones"))
+        self.assertEqual(set(blocks), self.store()._hashes(manifest))
+
+    def test_missing_block_raises(self):
+        monitor(OLD).save_to_store(self.store())
+        old = DNSMonitor(env=ENV)
+        old.load_from_store(self.store())
+        shutil.rmtree(self.backend._path("state/dnsmonitor.json.zones"))
+        with self.assertRaises(MissingZoneError):
+            old.public_records_aws.get("changed.example.com")
+
+
+if __name__ == "__main__":
+    unittest.main()